@@ -1,6 +1,21 @@
+import os
+
 import psycopg
 
 
+CHUNK_SIZE = 1 << 20
+# The columns of each CSV file, in order, in the order they are loaded.
+CSV_COLUMNS = {'report_type': ['report_type_code', 'report_type_description'],
+               'incident_type': ['incident_code', 'incident_category',
+                                 'incident_subcategory',
+                                 'incident_description'],
+               'location': ['longitude', 'latitude', 'supervisor_district',
+                            'police_district', 'neighborhood'],
+               'incident': ['id', 'incident_datetime', 'report_datetime',
+                            'longitude', 'latitude', 'report_type_code',
+                            'incident_code']}
+
+
 # pylint: disable=E1129
 def drop_tables(user, host, dbname):
     """
@@ -109,41 +124,23 @@ def copy_data(user, host, dbname, dir):
     loads data to report_type, incident_type, location and incident
     from report_type.csv, incident_type.csv, location.csv and incident.csv
     located in dir.
+    The files are streamed from the client with COPY FROM STDIN,
+    CHUNK_SIZE bytes at a time, so dir does not have to be
+    on the database server.
     Note: each file includes a header.
     """
     with psycopg.connect(host=host, dbname=dbname, user=user) as conn:
         with conn.cursor() as cur:
-            query = f'''COPY report_type(report_type_code,
-                                         report_type_description)
-                        FROM '{dir}/report_type.csv'
-                        DELIMITER ','
-                        CSV HEADER;
-
-                        COPY incident_type(incident_code,
-                                           incident_category,
-                                           incident_subcategory,
-                                           incident_description)
-                        FROM '{dir}/incident_type.csv'
-                        DELIMITER ','
-                        CSV HEADER;
-
-                        COPY location(longitude, latitude,
-                                      supervisor_district,
-                                      police_district, neighborhood)
-                        FROM '{dir}/location.csv'
-                        DELIMITER ','
-                        CSV HEADER;
-
-                        COPY incident(id, incident_datetime,
-                                      report_datetime, longitude,
-                                      latitude, report_type_code,
-                                      incident_code)
-                        FROM '{dir}/incident.csv'
-                        DELIMITER ','
-                        CSV HEADER;
-                     '''
-
-            cur.execute(query)
+            for table, columns in CSV_COLUMNS.items():
+                query = f'''COPY {table}({', '.join(columns)})
+                            FROM STDIN
+                            DELIMITER ','
+                            CSV HEADER
+                         '''
+                with open(os.path.join(dir, f"{table}.csv"), 'rb') as file:
+                    with cur.copy(query) as copy:
+                        while data := file.read(CHUNK_SIZE):
+                            copy.write(data)
 
 
 def return_distinct_neighborhood_police_district(user, host, dbname, n=None):
@@ -0,0 +1,224 @@
+import statistics
+import time
+
+import psycopg
+
+from hw2 import *
+from pool import connection
+
+from user_definition import *
+
+
+# Candidate indexes: name -> (kind, table, definition after ON table).
+CANDIDATES = {
+    'advisor_incident_datetime':
+        ('btree', 'incident', '(incident_datetime)'),
+    'advisor_incident_datetime_covering':
+        ('covering', 'incident',
+         '(incident_datetime) INCLUDE (longitude, latitude, '
+         'report_type_code, incident_code)'),
+    'advisor_incident_year':
+        ('expression', 'incident',
+         '((EXTRACT(year from incident_datetime)))'),
+    'advisor_incident_datetime_brin':
+        ('brin', 'incident', 'USING brin (incident_datetime)'),
+    'advisor_incident_code':
+        ('btree', 'incident', '(incident_code)'),
+    'advisor_incident_category':
+        ('partial', 'incident_type',
+         '(incident_category) WHERE incident_category IS NOT NULL')}
+
+# The workload: (select_all query function, its arguments, weight).
+WORKLOAD = []
+
+
+def register_query(func, weight=1.0, **kargs):
+    """
+    Adds the select_all query function func, called with kargs
+    besides user, host and dbname, to the workload the advisor
+    measures, counted weight times as often as a query of weight 1.
+    """
+    WORKLOAD.append((func, kargs, weight))
+
+
+def explain(curs, func, kargs, options):
+    """
+    Returns the JSON plan of the query func builds from kargs,
+    explained on curs with options.
+    """
+    query, params = func.__wrapped__(explain=options, **kargs)
+    curs.execute(query, params)
+    return curs.fetchone()[0][0]
+
+
+def estimate(curs, kargs):
+    """
+    Returns the planner's total cost of every workload query.
+    """
+    return [explain(curs, func, dict(kargs, **args),
+                    '(FORMAT JSON)')['Plan']['Total Cost']
+            for func, args, weight in WORKLOAD]
+
+
+def measure(curs, kargs, repeat):
+    """
+    Returns the median EXPLAIN ANALYZE execution time (ms)
+    of every workload query over repeat runs.
+    """
+    return [statistics.median(
+                explain(curs, func, dict(kargs, **args),
+                        '(ANALYZE, FORMAT JSON)')['Execution Time']
+                for i in range(0, repeat))
+            for func, args, weight in WORKLOAD]
+
+
+def write_cost(conn, repeat):
+    """
+    Returns the median time (ms) to insert the rows of advisor_rows
+    into incident, rolling every insert back.
+    """
+    times = []
+    for i in range(0, repeat):
+        with conn.cursor() as curs:
+            start = time.perf_counter()
+            curs.execute("INSERT INTO incident SELECT * FROM advisor_rows")
+            times.append((time.perf_counter() - start) * 1000)
+        conn.rollback()
+    return statistics.median(times)
+
+
+def hypothetical_costs(conn, table, definition, kargs):
+    """
+    Returns the planner's cost of every workload query with
+    a hypothetical index (hypopg) on table and its estimated size,
+    or (None, None) if hypopg cannot simulate it.
+    """
+    with conn.cursor() as curs:
+        try:
+            with conn.transaction():
+                curs.execute("SELECT indexrelid FROM hypopg_create_index(%s)",
+                             [f"CREATE INDEX ON {table} {definition}"])
+                indexrelid = curs.fetchone()[0]
+                costs = estimate(curs, kargs)
+                curs.execute("SELECT hypopg_relation_size(%s)", [indexrelid])
+                size = curs.fetchone()[0]
+        except psycopg.Error:
+            costs, size = None, None
+        curs.execute("SELECT hypopg_reset()")
+    return costs, size
+
+
+def advise(**kargs):
+    """
+    Measures the workload (WORKLOAD, by default Q2-Q6 with
+    the arguments in user_definition) with the current indexes and
+    then with each of candidates (CANDIDATES by default) built
+    in turn, and returns them ranked by the weighted execution time
+    they save, with the planner's estimated speedup (from a
+    hypothetical index when hypopg is installed), the measured speedup
+    of each query, the build time, the size on disk and the extra
+    time taken to insert write_rows (1,000 by default) incident rows.
+    Each candidate is dropped after it is measured, but inserts and
+    queries wait for its build, so run it on a test database.
+    """
+    user = kargs['user']
+    host = kargs['host']
+    dbname = kargs['dbname']
+    candidates = kargs.get('candidates', CANDIDATES)
+    repeat = kargs.get('repeat', 3)
+    args = {'user': user, 'host': host, 'dbname': dbname}
+    recommendations = []
+    with connection(user, host, dbname) as conn:
+        with conn.cursor() as curs:
+            curs.execute(f"""CREATE TEMP TABLE advisor_rows AS
+                             SELECT * FROM incident
+                             LIMIT {int(kargs.get('write_rows', 1000))}""")
+            curs.execute("""UPDATE advisor_rows
+                            SET id = id + (SELECT MAX(id) FROM incident)""")
+            conn.commit()
+            try:
+                curs.execute("CREATE EXTENSION IF NOT EXISTS hypopg")
+                conn.commit()
+                hypopg = True
+            except psycopg.Error:
+                conn.rollback()
+                hypopg = False
+            base_costs = estimate(curs, args)
+            base_times = measure(curs, args, repeat)
+            base_write = write_cost(conn, repeat)
+
+            for name, (kind, table, definition) in candidates.items():
+                costs, estimated_size = \
+                    hypothetical_costs(conn, table, definition, args) \
+                    if hypopg else (None, None)
+                start = time.perf_counter()
+                curs.execute(f"CREATE INDEX {name} ON {table} {definition}")
+                curs.execute(f"ANALYZE {table}")
+                conn.commit()
+                build_seconds = time.perf_counter() - start
+                try:
+                    curs.execute("""SELECT SUM(pg_relation_size(relid))
+                                    FROM pg_partition_tree(%s::regclass)""",
+                                 [name])
+                    size = curs.fetchone()[0]
+                    times = measure(curs, args, repeat)
+                    write = write_cost(conn, repeat)
+                finally:
+                    conn.rollback()
+                    curs.execute(f"DROP INDEX IF EXISTS {name}")
+                    conn.commit()
+                queries = []
+                for i, (func, func_args, weight) in enumerate(WORKLOAD):
+                    queries.append({
+                        'query': func.__name__,
+                        'estimated_speedup':
+                            base_costs[i] / costs[i] if costs else None,
+                        'measured_speedup': base_times[i] / times[i]
+                        if times[i] else None})
+                saved_ms = sum(weight * (base_times[i] - times[i])
+                               for i, (func, func_args, weight)
+                               in enumerate(WORKLOAD))
+                recommendations.append({
+                    'index': name,
+                    'kind': kind,
+                    'statement':
+                        f"CREATE INDEX {name} ON {table} {definition}",
+                    'saved_ms': saved_ms,
+                    'queries': queries,
+                    'build_seconds': build_seconds,
+                    'bytes': size,
+                    'estimated_bytes': estimated_size,
+                    'write_overhead': (write - base_write) / base_write
+                    if base_write else None,
+                    'recommended': saved_ms > 0})
+            curs.execute("DROP TABLE advisor_rows")
+    return sorted(recommendations, key=lambda r: (-r['saved_ms'], r['bytes']))
+
+
+register_query(return_incident_category_count)
+register_query(return_incident_count_by_category_subcategory,
+               count_limit=count_limit)
+register_query(return_count_by_location_report_type_incident_description,
+               year=year)
+register_query(return_avg_interval_days_per_incident_code)
+register_query(return_monthly_count)
+
+
+def main():
+    for rank, recommendation in enumerate(
+            advise(user=user, host=host, dbname=dbname), 1):
+        write_overhead = recommendation['write_overhead']
+        write_overhead = f"{write_overhead:.1%}" \
+            if write_overhead is not None else 'unknown'
+        print(f"{rank}. {recommendation['statement']}")
+        print(f"    saves {recommendation['saved_ms']:.2f} ms per workload, "
+              f"{recommendation['bytes']} bytes, write overhead "
+              f"{write_overhead}")
+        for query in recommendation['queries']:
+            print(f"    {query['query']}: "
+                  f"x{query['measured_speedup'] or 0:.2f} measured, "
+                  f"x{query['estimated_speedup'] or 0:.2f} estimated")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+import asyncio
+import functools
+import time
+from contextlib import asynccontextmanager
+
+import psycopg
+from psycopg_pool import AsyncConnectionPool
+
+from cache import (CACHE_SETTINGS, invalidate, lookup, referenced_tables,
+                   result_size, store, table_versions)
+from metrics import record
+from pool import POOL_SETTINGS, conninfo
+from query import record_execution
+
+
+# Async pools belong to the event loop they were opened in,
+# so they are keyed by (user, host, dbname, loop).
+_async_pools = {}
+
+
+async def _reset(conn):
+    await conn.set_isolation_level(None)
+
+
+async def get_async_pool(user, host, dbname):
+    """
+    Returns the async pool for (user, host, dbname) in the running
+    event loop, opening it on first use with the POOL_SETTINGS
+    of the synchronous pools.
+    """
+    key = (user, host, dbname, asyncio.get_running_loop())
+    pool = _async_pools.get(key)
+    if pool is None:
+        check = AsyncConnectionPool.check_connection \
+            if POOL_SETTINGS['check'] else None
+        pool = AsyncConnectionPool(conninfo(user, host, dbname),
+                                   min_size=POOL_SETTINGS['min_size'],
+                                   max_size=POOL_SETTINGS['max_size'],
+                                   max_idle=POOL_SETTINGS['max_idle'],
+                                   timeout=POOL_SETTINGS['timeout'],
+                                   check=check,
+                                   reset=_reset,
+                                   name=f"async {user}@{host}/{dbname}",
+                                   open=False)
+        _async_pools[key] = pool
+    await pool.open()
+    return pool
+
+
+@asynccontextmanager
+async def async_connection(user, host, dbname):
+    """
+    Yields an async connection for user, host and dbname,
+    like pool.connection(): the transaction is committed when the
+    block exits normally and rolled back on error.
+    """
+    if not POOL_SETTINGS['enabled']:
+        async with await psycopg.AsyncConnection.connect(
+                conninfo(user, host, dbname)) as conn:
+            yield conn
+        return
+    pool = await get_async_pool(user, host, dbname)
+    async with pool.connection() as conn:
+        yield conn
+
+
+async def close_async_pools():
+    """
+    Closes the async pools of the running event loop.
+    Call it before the loop ends, for example at the end
+    of the coroutine given to asyncio.run().
+    """
+    loop = asyncio.get_running_loop()
+    keys = [key for key in _async_pools if key[3] is loop]
+    for key in keys:
+        await _async_pools.pop(key).close()
+
+
+async def async_fetch_all(name, kargs, query, params=None):
+    """
+    The async version of query.fetch_all(), for results as rows:
+    runs query with params on an async pooled connection, prepared
+    unless prepare=False, through the same result cache,
+    recording it in the same query metrics.
+    Streamed and columnar results are not supported and raise
+    ValueError.
+    """
+    if kargs.get('stream', False):
+        raise ValueError("async queries cannot stream their results")
+    if kargs.get('result_format', 'rows') != 'rows':
+        raise ValueError("async queries only return rows")
+    user = kargs['user']
+    host = kargs['host']
+    dbname = kargs['dbname']
+    params = list(params or [])
+    explain = kargs.get('explain', False)
+    prepare = kargs.get('prepare', True) and not explain
+    use_cache = CACHE_SETTINGS['enabled'] and not explain and \
+        kargs.get('cache', True)
+    key = (user, host, dbname, query, tuple(params))
+    if use_cache:
+        tables = referenced_tables(query)
+        hit, rows = lookup(key, tables)
+        if hit:
+            return rows
+        versions = table_versions(key, tables)
+    start = time.perf_counter()
+    async with async_connection(user, host, dbname) as conn:
+        connected = time.perf_counter()
+        async with conn.cursor() as curs:
+            record_execution(conn, query, prepare)
+            if prepare:
+                await curs.execute(query, params, prepare=True)
+            else:
+                await curs.execute(psycopg.AsyncClientCursor(conn).mogrify(
+                    query, params), prepare=False)
+            executed = time.perf_counter()
+            rows = await curs.fetchall()
+            fetched = time.perf_counter()
+    if not explain:
+        # A slow query is explained on a synchronous connection.
+        await asyncio.to_thread(
+            record, name, (connected - start) * 1000,
+            (executed - connected) * 1000, (fetched - executed) * 1000,
+            len(rows), result_size(rows), query, params, kargs)
+    if use_cache:
+        store(name, key, rows, versions)
+    return rows
+
+
+def async_select_all(func):
+    """
+    Returns a coroutine function running the query of the select_all
+    query function func (decorated or not) on an async connection,
+    so independent queries can run at the same time with
+    asyncio.gather(). The query is built in a worker thread,
+    since builders may check the rollups on a synchronous connection.
+    """
+    builder = getattr(func, '__wrapped__', func)
+
+    @functools.wraps(builder)
+    async def execute(**kargs):
+        query, params = await asyncio.to_thread(builder, **kargs)
+        return await async_fetch_all(builder.__name__, kargs, query, params)
+    return execute
+
+
+def async_commit(func):
+    """
+    Returns a coroutine function running the statements of the commit
+    function func (decorated or not) at kargs['isolation_level']
+    on an async connection, committing them and invalidating
+    the cached results that depend on them, like hw3's commit().
+    """
+    builder = getattr(func, '__wrapped__', func)
+
+    @functools.wraps(builder)
+    async def execute(**kargs):
+        user = kargs['user']
+        host = kargs['host']
+        dbname = kargs['dbname']
+        start = time.perf_counter()
+        async with async_connection(user, host, dbname) as conn:
+            connected = time.perf_counter()
+            await conn.set_isolation_level(kargs['isolation_level'])
+            async with conn.cursor() as curs:
+                query = await asyncio.to_thread(builder, **kargs)
+                if isinstance(query, tuple):
+                    query = psycopg.AsyncClientCursor(conn).mogrify(*query)
+                await curs.execute(query)
+                rows = max(curs.rowcount, 0)
+            await conn.commit()
+        committed = time.perf_counter()
+        await asyncio.to_thread(
+            record, builder.__name__, (connected - start) * 1000,
+            (committed - connected) * 1000, 0.0, rows, 0, query)
+        invalidate(user, host, dbname, referenced_tables(query))
+        return None
+    return execute
@@ -0,0 +1,228 @@
+import json
+import math
+import statistics
+import time
+from datetime import datetime, timezone
+
+from pool import connection
+
+
+EXPLAIN_OPTIONS = '(ANALYZE, BUFFERS, FORMAT JSON)'
+PERCENTILES = [50, 95, 99]
+CACHE_MODES = ['warm', 'cold']
+
+
+def time_calls(func, repeat, **kargs):
+    """
+    Calls func(**kargs) repeat times and returns
+    the wall-clock latency of each call in milliseconds.
+    """
+    latencies = []
+    for i in range(0, repeat):
+        start = time.perf_counter()
+        func(**kargs)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def percentile(values, q):
+    """
+    Returns the q-th percentile of values,
+    interpolating linearly between the closest ranks.
+    """
+    values = sorted(values)
+    rank = (len(values) - 1) * q / 100
+    low, high = math.floor(rank), math.ceil(rank)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def summarize(latencies):
+    """
+    Returns the mean, median, min, max, standard deviation
+    and the PERCENTILES (p50, p95, p99) of a list of latencies.
+    """
+    summary = {'mean': statistics.mean(latencies),
+               'median': statistics.median(latencies),
+               'min': min(latencies),
+               'max': max(latencies),
+               'stdev': statistics.stdev(latencies)
+               if len(latencies) > 1 else 0.0}
+    for q in PERCENTILES:
+        summary[f"p{q}"] = percentile(latencies, q)
+    return summary
+
+
+def can_evict_buffers(user, host, dbname):
+    """
+    Returns whether evict_buffers() can run on the server:
+    it needs PostgreSQL 17 or later with pg_buffercache available.
+    """
+    with connection(user, host, dbname) as conn:
+        with conn.cursor() as curs:
+            curs.execute(
+                """
+                SELECT current_setting('server_version_num')::INTEGER
+                       >= 170000
+                AND EXISTS (SELECT 1 FROM pg_available_extensions
+                            WHERE name = 'pg_buffercache')
+                """)
+            return curs.fetchone()[0]
+
+
+def evict_buffers(user, host, dbname):
+    """
+    Evicts the pages of dbname from PostgreSQL's shared buffers with
+    pg_buffercache_evict() (PostgreSQL 17 with pg_buffercache),
+    so the next query reads them again, and raises RuntimeError
+    on servers without it. Pages in the operating
+    system's page cache stay there; for a fully cold cache, pass
+    a cold callable to run_benchmark() that restarts the server
+    and drops the OS cache.
+    """
+    if not can_evict_buffers(user, host, dbname):
+        raise RuntimeError(
+            "Cold runs need pg_buffercache_evict() (PostgreSQL 17 or "
+            "later with pg_buffercache); pass a cold callable or "
+            "use cache_mode='warm'")
+    with connection(user, host, dbname) as conn:
+        with conn.cursor() as curs:
+            curs.execute("CREATE EXTENSION IF NOT EXISTS pg_buffercache")
+            curs.execute(
+                "SELECT to_regproc('pg_buffercache_evict') IS NOT NULL")
+            if not curs.fetchone()[0]:
+                raise RuntimeError(
+                    "pg_buffercache is older than 1.5; run "
+                    "ALTER EXTENSION pg_buffercache UPDATE")
+            curs.execute(
+                """
+                SELECT pg_buffercache_evict(bufferid)
+                FROM pg_buffercache
+                WHERE reldatabase =
+                (SELECT oid FROM pg_database
+                WHERE datname = current_database())
+                """)
+
+
+def explain_calls(func, repeat, **kargs):
+    """
+    Calls the select_all query function func(**kargs) repeat times
+    with EXPLAIN_OPTIONS and returns, for each call, the planning
+    and execution time in milliseconds and the shared buffers hit
+    and read.
+    """
+    calls = []
+    for i in range(0, repeat):
+        plan = func(explain=EXPLAIN_OPTIONS, **kargs)[0][0][0]
+        calls.append({'planning_ms': plan['Planning Time'],
+                      'execution_ms': plan['Execution Time'],
+                      'shared_hit_blocks': plan['Plan']['Shared Hit Blocks'],
+                      'shared_read_blocks':
+                      plan['Plan']['Shared Read Blocks']})
+    return calls
+
+
+def run_benchmark(func, repeat, warmup=2, cache_mode='warm', cold=None,
+                  **kargs):
+    """
+    Calls func(**kargs) warmup times without measuring, and then
+    repeat times, and returns the summary of the wall-clock latency
+    (ms) and, for select_all query functions, of the planning time,
+    execution time and buffer hits and reads of EXPLAIN_OPTIONS.
+    Other functions, such as the hw1 queries, cannot be explained
+    from outside, so only their latency is measured.
+    With cache_mode='cold', cold(**kargs) (by default
+    evict_buffers()) runs before every call, and there is no warmup.
+    Result caching is turned off for select_all query functions.
+    """
+    if cache_mode not in CACHE_MODES:
+        raise ValueError(f"cache_mode must be one of {CACHE_MODES}")
+    select_all = hasattr(func, '__wrapped__')
+    if select_all:
+        kargs = dict(kargs, cache=False)
+    if cache_mode == 'cold':
+        cold = cold or (lambda **kargs: evict_buffers(
+            kargs['user'], kargs['host'], kargs['dbname']))
+        warmup = 0
+    time_calls(func, warmup, **kargs)
+    latencies = []
+    calls = []
+    for i in range(0, repeat):
+        if cold is not None:
+            cold(**kargs)
+        latencies += time_calls(func, 1, **kargs)
+        if select_all:
+            if cold is not None:
+                cold(**kargs)
+            calls += explain_calls(func, 1, **kargs)
+    results = {'latency_ms': summarize(latencies)}
+    if calls:
+        for name in calls[0]:
+            results[name] = summarize([call[name] for call in calls])
+    return results
+
+
+def run_suite(workload, repeat, warmup=2, cache_modes=CACHE_MODES,
+              **kargs):
+    """
+    Runs run_benchmark() for every (func, arguments) in workload
+    in each of cache_modes and returns the results keyed by
+    function name and mode, with the time of the run and the
+    cache modes run. The cold mode is skipped, unless a cold
+    callable is given, on servers where evict_buffers() cannot run.
+    """
+    if 'cold' in cache_modes and kargs.get('cold') is None and \
+            not can_evict_buffers(kargs['user'], kargs['host'],
+                                  kargs['dbname']):
+        cache_modes = [mode for mode in cache_modes if mode != 'cold']
+    results = {'started_at': datetime.now(timezone.utc).isoformat(),
+               'repeat': repeat,
+               'warmup': warmup,
+               'cache_modes': list(cache_modes),
+               'queries': {}}
+    for func, args in workload:
+        for cache_mode in cache_modes:
+            results['queries'].setdefault(func.__name__, {})[cache_mode] =\
+                run_benchmark(func, repeat, warmup, cache_mode,
+                              **kargs, **args)
+    return results
+
+
+def save_results(results, path):
+    """
+    Writes the results of run_suite() to path as JSON.
+    """
+    with open(path, 'w') as file:
+        json.dump(results, file, indent=2)
+
+
+def load_results(path):
+    """
+    Reads the results of run_suite() saved to path.
+    """
+    with open(path) as file:
+        return json.load(file)
+
+
+def compare_results(baseline, results, metric='p50', threshold=0.1):
+    """
+    Returns the regressions of results against baseline: every
+    function, cache mode and measurement whose metric grew by more
+    than threshold (10% by default), with both values and the ratio.
+    """
+    regressions = []
+    for name, modes in results['queries'].items():
+        for mode, measurements in modes.items():
+            before = baseline['queries'].get(name, {}).get(mode, {})
+            for measurement, summary in measurements.items():
+                if measurement not in before:
+                    continue
+                old = before[measurement][metric]
+                new = summary[metric]
+                if old and new > old * (1 + threshold):
+                    regressions.append({'query': name,
+                                        'cache_mode': mode,
+                                        'measurement': measurement,
+                                        'baseline': old,
+                                        'current': new,
+                                        'ratio': new / old})
+    return regressions
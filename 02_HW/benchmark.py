@@ -0,0 +1,585 @@
+import asyncio
+import os
+import resource
+import time
+import tracemalloc
+
+from aio import async_select_all, close_async_pools
+from bench import *
+from cache import invalidate
+from create_index import return_time_measure
+from hw1 import *
+from hw2 import *
+from metrics import query_metrics, write_metrics
+from plans import check_plans
+from pool import configure_pool, connection, pool_stats
+from query import clear_plan_cache_stats, plan_cache_stats
+
+from user_definition import *
+
+
+RESULTS_PATH = 'benchmark_results.json'
+METRICS_PATH = 'query_metrics.prom'
+
+
+def hw1_workload():
+    """
+    Returns the hw1 query functions with the arguments
+    they are benchmarked with.
+    """
+    return [(return_distinct_neighborhood_police_district, {}),
+            (return_distinct_time_taken, {}),
+            (return_incident_with_incident_substring, {'substr': 'theft'}),
+            (return_incident_desc_for_report_type_desc, {'desc': 'initial'}),
+            (search_incident_type, {'text': 'theft'})]
+
+
+def hw2_workload():
+    """
+    Returns the Q2-Q6 query functions with the arguments
+    they are benchmarked with.
+    """
+    return [(return_incident_category_count, {}),
+            (return_incident_count_by_category_subcategory,
+             {'count_limit': count_limit}),
+            (return_count_by_location_report_type_incident_description,
+             {'year': year}),
+            (return_avg_interval_days_per_incident_code, {}),
+            (return_monthly_count, {})]
+
+
+def benchmark_pool(**kargs):
+    """
+    Runs every Q2-Q6 function test_time times with a new connection
+    per call and then through the connection pool,
+    and returns the latency summary of both for each function.
+    """
+    results = {}
+    for enabled in [False, True]:
+        configure_pool(enabled=enabled)
+        mode = 'pooled' if enabled else 'unpooled'
+        for func, args in hw2_workload():
+            latencies = time_calls(func, test_time, cache=False,
+                                   **kargs, **args)
+            results.setdefault(func.__name__, {})[mode] =\
+                summarize(latencies)
+    return results
+
+
+def benchmark_prepared(**kargs):
+    """
+    Runs every Q2-Q6 function test_time times with its arguments
+    inlined into the SQL text and then as a prepared statement
+    with bound parameters, without the result cache,
+    and returns the latency summary of both for each function
+    and the plan cache statistics of each mode under 'plan cache'.
+    """
+    results = {}
+    for prepare in [False, True]:
+        clear_plan_cache_stats()
+        mode = 'prepared' if prepare else 'inlined'
+        for func, args in hw2_workload():
+            latencies = time_calls(func, test_time, cache=False,
+                                   prepare=prepare, **kargs, **args)
+            results.setdefault(func.__name__, {})[mode] =\
+                summarize(latencies)
+        results.setdefault('plan cache', {})[mode] = plan_cache_stats()
+    return results
+
+
+def benchmark_async(**kargs):
+    """
+    Runs all the Q2-Q6 functions one after the other, and then at the
+    same time with asyncio.gather() on the async pool, test_time
+    times each without the result cache, and returns the latency
+    summary of a whole round of queries in both modes.
+    """
+    workload = hw2_workload()
+    sequential = []
+    for i in range(0, test_time):
+        start = time.perf_counter()
+        for func, args in workload:
+            func(cache=False, **kargs, **args)
+        sequential.append((time.perf_counter() - start) * 1000)
+
+    async def gather_rounds():
+        queries = [(async_select_all(func), args) for func, args in workload]
+        latencies = []
+        try:
+            for i in range(0, test_time):
+                start = time.perf_counter()
+                await asyncio.gather(*[func(cache=False, **kargs, **args)
+                                       for func, args in queries])
+                latencies.append((time.perf_counter() - start) * 1000)
+        finally:
+            await close_async_pools()
+        return latencies
+
+    return {'sequential': summarize(sequential),
+            'gather': summarize(asyncio.run(gather_rounds()))}
+
+
+def incident_years(user, host, dbname):
+    """
+    Returns the years of incident_datetime in incident.
+    """
+    with connection(user, host, dbname) as conn:
+        with conn.cursor() as curs:
+            curs.execute("""SELECT DISTINCT
+                            EXTRACT(year from incident_datetime)::INTEGER
+                            FROM incident ORDER BY 1""")
+            return [year for (year,) in curs.fetchall()]
+
+
+def benchmark_fan_out(**kargs):
+    """
+    Runs Q4 for every year in years one year after the other,
+    merging the rows and keeping the first n, and then with
+    return_count_by_location_for_periods(), test_time times each
+    without the result cache, and returns the latency summary
+    of both.
+    """
+    years = kargs.pop('years')
+    n = kargs.pop('n', count_limit)
+    results = {}
+
+    def sequential(**kargs):
+        rows = []
+        for year in years:
+            rows += return_count_by_location_report_type_incident_description(
+                year=year, **kargs)
+        return sorted(rows, key=lambda row: (-row[7], row[0], row[1]))[:n]
+
+    for mode, func, args in [('sequential', sequential, {}),
+                             ('fan-out', return_count_by_location_for_periods,
+                              {'years': years, 'n': n})]:
+        results[mode] = summarize(time_calls(func, test_time, cache=False,
+                                             **kargs, **args))
+    return results
+
+
+def benchmark_suite(**kargs):
+    """
+    Runs the hw1 and hw2 query functions with run_suite() (warm
+    cache, and cold where the server can evict buffers, test_time
+    measured calls each), saves the results to path (RESULTS_PATH
+    by default) and returns them with the regressions against the
+    results previously saved there. Only the hw2 functions have
+    an EXPLAIN breakdown; the hw1 ones are timed end to end.
+    """
+    path = kargs.pop('path', RESULTS_PATH)
+    results = run_suite(hw1_workload() + hw2_workload(), test_time,
+                        **kargs)
+    regressions = compare_results(load_results(path), results) \
+        if os.path.exists(path) else []
+    save_results(results, path)
+    return results, regressions
+
+
+def benchmark_load(**kargs):
+    """
+    Loads the data in dir with constraints in place
+    (drop_tables, create_tables and copy_data) and then with
+    fast_load(), logged and unlogged,
+    and returns the total seconds taken by each path.
+    """
+    user = kargs['user']
+    host = kargs['host']
+    dbname = kargs['dbname']
+    dir = kargs['dir']
+
+    start = time.perf_counter()
+    drop_tables(user, host, dbname)
+    create_tables(user, host, dbname)
+    copy_data(user, host, dbname, dir)
+    results = {'constraints first': time.perf_counter() - start}
+
+    for unlogged in [False, True]:
+        start = time.perf_counter()
+        fast_load(user, host, dbname, dir, unlogged=unlogged)
+        mode = 'fast load (unlogged)' if unlogged else 'fast load'
+        results[mode] = time.perf_counter() - start
+    return results
+
+
+def benchmark_partitioning(**kargs):
+    """
+    For every data directory in dirs (for example copies of
+    incident.csv at different sizes), loads incident unpartitioned
+    and partitioned by year and by month, and returns the latency
+    summary of Q4 and Q6 for each layout.
+    """
+    user = kargs['user']
+    host = kargs['host']
+    dbname = kargs['dbname']
+    results = {}
+    for dir in kargs['dirs']:
+        for partition_by in [None, 'year', 'month']:
+            fast_load(user, host, dbname, dir, partition_by=partition_by)
+            layout = partition_by or 'unpartitioned'
+            for func, args in [
+                    (return_count_by_location_report_type_incident_description,
+                     {'year': kargs['year']}),
+                    (return_monthly_count, {})]:
+                latencies = time_calls(func, test_time, user=user,
+                                       host=host, dbname=dbname,
+                                       cache=False, **args)
+                results.setdefault(dir, {}).setdefault(layout, {})[
+                    func.__name__] = summarize(latencies)
+    return results
+
+
+@select_all
+def legacy_count_by_location_report_type_incident_description(**kargs):
+    """
+    Q4 as it was written before it filtered on a range
+    of incident_datetime, kept to measure the difference.
+    """
+    query = """
+        SELECT EXTRACT(year from incident.incident_datetime)::INTEGER AS year,
+            EXTRACT(month from incident.incident_datetime)::INTEGER AS month,
+            incident.longitude,
+            incident.latitude,
+            neighborhood,
+            report_type_description,
+            incident_description,
+            COUNT(*)
+        FROM incident
+        JOIN location
+        ON incident.latitude = location.latitude AND
+            incident.longitude = location.longitude
+        JOIN incident_type
+        ON incident.incident_code = incident_type.incident_code
+        JOIN report_type
+        ON report_type.report_type_code = incident.report_type_code
+        WHERE EXTRACT(year from incident.incident_datetime) = %s
+        GROUP BY EXTRACT(year from incident.incident_datetime),
+                EXTRACT(month from incident.incident_datetime),
+                incident.longitude,
+                incident.latitude,
+                neighborhood,
+                report_type_description,
+                incident_description
+        ORDER BY count DESC, year, month, incident.longitude,
+                incident.latitude, neighborhood, report_type_description,
+                incident_description
+            """
+    return check_query_args(query=query, params=[int(kargs['year'])],
+                            **kargs)
+
+
+@select_all
+def legacy_monthly_count(**kargs):
+    """
+    Q6 as it was written before it became a single-pass aggregate,
+    kept to measure the difference.
+    """
+    query = """
+    SELECT cohort.year,
+    SUM(CASE WHEN EXTRACT(month from incident_datetime) = 1 THEN 1 END) AS JAN,
+    SUM(CASE WHEN EXTRACT(month from incident_datetime) = 2 THEN 1 END) AS FEB,
+    SUM(CASE WHEN EXTRACT(month from incident_datetime) = 3 THEN 1 END) AS MAR,
+    SUM(CASE WHEN EXTRACT(month from incident_datetime) = 4 THEN 1 END) AS APR,
+    SUM(CASE WHEN EXTRACT(month from incident_datetime) = 5 THEN 1 END) AS MAY,
+    SUM(CASE WHEN EXTRACT(month from incident_datetime) = 6 THEN 1 END) AS JUN,
+    SUM(CASE WHEN EXTRACT(month from incident_datetime) = 7 THEN 1 END) AS JUL,
+    SUM(CASE WHEN EXTRACT(month from incident_datetime) = 8 THEN 1 END) AS AUG,
+    SUM(CASE WHEN EXTRACT(month from incident_datetime) = 9 THEN 1 END) AS SEP,
+    SUM(CASE WHEN EXTRACT(month from incident_datetime) = 10 THEN 1 END)
+    AS OCT,
+    SUM(CASE WHEN EXTRACT(month from incident_datetime) = 11 THEN 1 END)
+    AS NOV,
+    SUM(CASE WHEN EXTRACT(month from incident_datetime) = 12 THEN 1 END) AS DEC
+    FROM
+        (SELECT DISTINCT EXTRACT(year from incident_datetime) AS year
+        FROM incident
+        GROUP BY year) AS cohort
+    JOIN incident
+    ON EXTRACT(year from incident.incident_datetime) = cohort.year
+    GROUP BY cohort.year
+    ORDER BY cohort.year
+    """
+    return check_query_args(query=query, **kargs)
+
+
+def benchmark_location_id(**kargs):
+    """
+    Loads the data in dir with the composite (longitude, latitude)
+    location key and with the integer location_id, and returns
+    the load time and the latency summary of Q4 for each schema.
+    """
+    user = kargs['user']
+    host = kargs['host']
+    dbname = kargs['dbname']
+    results = {}
+    for location_id in [False, True]:
+        schema = 'location_id' if location_id else '(longitude, latitude)'
+        start = time.perf_counter()
+        fast_load(user, host, dbname, kargs['dir'], location_id=location_id)
+        load_seconds = time.perf_counter() - start
+        latencies = time_calls(
+            return_count_by_location_report_type_incident_description,
+            test_time, user=user, host=host, dbname=dbname,
+            year=kargs['year'], location_id=location_id, cache=False)
+        results[schema] = {'load_seconds': load_seconds,
+                           'Q4': summarize(latencies)}
+    return results
+
+
+def benchmark_streaming_memory(**kargs):
+    """
+    Runs Q4 for year without n, streamed through a server-side cursor
+    and then fetched all at once, and returns the rows, the peak
+    Python memory (tracemalloc) and the process peak RSS in bytes
+    of each mode. Use a large incident table, for example one
+    generated at scale, to see the difference.
+    """
+    results = {}
+    for stream in [True, False]:
+        tracemalloc.start()
+        rows = return_count_by_location_report_type_incident_description(
+            user=kargs['user'], host=kargs['host'], dbname=kargs['dbname'],
+            year=kargs['year'], stream=stream, cache=False)
+        count = sum(1 for row in rows)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del rows
+        mode = 'stream' if stream else 'fetchall'
+        results[mode] = {'rows': count,
+                         'peak_python_bytes': peak,
+                         'peak_rss_bytes':
+                         resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                         * 1024}
+    return results
+
+
+SEARCH_INDEXES = ['incident_description_trgm',
+                  'report_type_description_trgm',
+                  'incident_code_report_type_index',
+                  'incident_description_fts']
+
+
+def add_synthetic_incident_types(user, host, dbname, rows):
+    """
+    Adds rows incident types after the largest incident_code,
+    whose descriptions are the existing ones followed by
+    a random-looking suffix, and returns that largest incident_code
+    so they can be deleted afterwards.
+    """
+    with connection(user, host, dbname) as conn:
+        with conn.cursor() as curs:
+            curs.execute("SELECT MAX(incident_code) FROM incident_type")
+            max_code = curs.fetchone()[0]
+            curs.execute(
+                """
+                WITH base AS
+                (SELECT array_agg(incident_description) AS descriptions
+                FROM incident_type
+                WHERE incident_description IS NOT NULL)
+                INSERT INTO incident_type
+                (incident_code, incident_description)
+                SELECT %s + g,
+                descriptions[1 + g %% cardinality(descriptions)]
+                || ' ' || md5(g::text)
+                FROM base, generate_series(1, %s) AS g
+                """, [max_code, rows])
+            curs.execute("ANALYZE incident_type")
+    invalidate(user, host, dbname, ['incident_type'])
+    return max_code
+
+
+def benchmark_search(**kargs):
+    """
+    Adds synthetic incident types (100,000 by default, or rows)
+    and returns the latency summary of the substring,
+    report type and full-text searches of hw1 without
+    the search indexes and after create_search_index(),
+    with the seconds taken to build them, and of the substring
+    and report type searches answered from the dimension cache.
+    The synthetic rows are deleted at the end.
+    """
+    user = kargs['user']
+    host = kargs['host']
+    dbname = kargs['dbname']
+    searches = [(return_incident_with_incident_substring,
+                 {'substr': 'theft', 'n': 100, 'dimension_cache': False}),
+                (return_incident_desc_for_report_type_desc,
+                 {'desc': 'initial', 'dimension_cache': False}),
+                (search_incident_type, {'text': 'vehicle theft', 'n': 100})]
+    max_code = add_synthetic_incident_types(user, host, dbname,
+                                            kargs.get('rows', 100000))
+    results = {}
+    try:
+        with connection(user, host, dbname) as conn:
+            conn.execute("DROP INDEX IF EXISTS " + ', '.join(SEARCH_INDEXES))
+        for indexed in [False, True]:
+            if indexed:
+                start = time.perf_counter()
+                create_search_index(user, host, dbname, full_text=True)
+                results['index_seconds'] = time.perf_counter() - start
+            mode = 'indexed' if indexed else 'scan'
+            for func, args in searches:
+                latencies = time_calls(func, test_time, user=user,
+                                       host=host, dbname=dbname, **args)
+                results.setdefault(func.__name__, {})[mode] =\
+                    summarize(latencies)
+        for func, args in searches[:2]:
+            latencies = time_calls(func, test_time, user=user, host=host,
+                                   dbname=dbname,
+                                   **dict(args, dimension_cache=True))
+            results[func.__name__]['dimension cache'] = summarize(latencies)
+    finally:
+        with connection(user, host, dbname) as conn:
+            conn.execute("DELETE FROM incident_type WHERE incident_code > %s",
+                         [max_code])
+        invalidate(user, host, dbname, ['incident_type'])
+    return results
+
+
+def benchmark_brin(**kargs):
+    """
+    Loads the data in dir afresh for the btree + CLUSTER strategy
+    of create_index() and for BRIN with each of pages_per_range
+    ([16, 32, 128] by default), and returns the build time,
+    the index size in bytes and the latency summary of Q4 and Q6
+    for each, with the correlation of incident_datetime to the
+    physical order of incident, which decides how selective BRIN is.
+    Use a large incident table.
+    """
+    user = kargs['user']
+    host = kargs['host']
+    dbname = kargs['dbname']
+    strategies = [('btree + CLUSTER', {'strategy': 'btree'})] + \
+        [(f"brin ({pages} pages per range)",
+          {'strategy': 'brin', 'pages_per_range': pages})
+         for pages in kargs.get('pages_per_range', [16, 32, 128])]
+    results = {}
+    for mode, args in strategies:
+        fast_load(user, host, dbname, kargs['dir'])
+        start = time.perf_counter()
+        create_index(user=user, host=host, dbname=dbname, **args)
+        build_seconds = time.perf_counter() - start
+        name = 'incident_datetime_brin' if args['strategy'] == 'brin' \
+            else 'incident_datetime_index'
+        with connection(user, host, dbname) as conn:
+            with conn.cursor() as curs:
+                curs.execute("ANALYZE incident")
+                curs.execute("""SELECT SUM(pg_relation_size(relid))
+                                FROM pg_partition_tree(%s::regclass)""",
+                             [name])
+                size = curs.fetchone()[0]
+                curs.execute("""SELECT correlation FROM pg_stats
+                                WHERE tablename = 'incident'
+                                AND attname = 'incident_datetime'""")
+                correlation = curs.fetchone()
+        results[mode] = {'build_seconds': build_seconds,
+                         'bytes': size,
+                         'correlation': correlation and correlation[0]}
+        for func, func_args in [
+                (return_count_by_location_report_type_incident_description,
+                 {'year': kargs['year']}),
+                (return_monthly_count, {'rollups': False})]:
+            latencies = time_calls(func, test_time, user=user, host=host,
+                                   dbname=dbname, cache=False, **func_args)
+            results[mode][func.__name__] = summarize(latencies)
+    return results
+
+
+def benchmark_sargable():
+    """
+    Returns the average EXPLAIN ANALYZE execution time (ms) of
+    Q4 and Q6 written with EXTRACT() predicates (before)
+    and with incident_datetime ranges and FILTER clauses (after),
+    measured with return_time_measure() from create_index.py.
+    Both run without the rollups and the result cache, so the after
+    time is that of the rewritten query over incident.
+    Run it after create_index() so Q4 can use the btree
+    on incident_datetime.
+    """
+    pairs = {'Q4': (legacy_count_by_location_report_type_incident_description,
+                    return_count_by_location_report_type_incident_description),
+             'Q6': (legacy_monthly_count, return_monthly_count)}
+    return {name: {'before': return_time_measure(before, rollups=False,
+                                                 cache=False),
+                   'after': return_time_measure(after, rollups=False,
+                                                cache=False)}
+            for name, (before, after) in pairs.items()}
+
+
+def main():
+    results, regressions = benchmark_suite(user=user, host=host,
+                                           dbname=dbname)
+    for name, modes in results['queries'].items():
+        print(name)
+        for mode, measurements in modes.items():
+            latency = measurements['latency_ms']
+            print(f"    {mode:>4}: p50 {latency['p50']:.2f} ms, "
+                  f"p95 {latency['p95']:.2f} ms, "
+                  f"p99 {latency['p99']:.2f} ms, "
+                  f"stdev {latency['stdev']:.2f} ms")
+    for regression in regressions:
+        print(f"Regression: {regression['query']} "
+              f"({regression['cache_mode']}) {regression['measurement']} "
+              f"x{regression['ratio']:.2f}")
+    for name, result in check_plans(hw2_workload(), user=user, host=host,
+                                    dbname=dbname).items():
+        for change in result['changes']:
+            print(f"Plan change: {name} {change['change']} at "
+                  f"{change['path']}: {change.get('before', '')} -> "
+                  f"{change.get('after', '')}")
+        for warning in result['warnings']:
+            print(f"Plan warning: {name} {warning['kind']} in "
+                  f"{warning['node']}")
+
+    results = benchmark_pool(user=user, host=host, dbname=dbname)
+    for name, modes in results.items():
+        print(name)
+        for mode, summary in modes.items():
+            print(f"    {mode:>8}: mean {summary['mean']:.2f} ms, "
+                  f"median {summary['median']:.2f} ms")
+    print(pool_stats())
+
+    results = benchmark_prepared(user=user, host=host, dbname=dbname)
+    print(results.pop('plan cache'))
+    for name, modes in results.items():
+        print(name)
+        for mode, summary in modes.items():
+            print(f"    {mode:>8}: mean {summary['mean']:.2f} ms, "
+                  f"median {summary['median']:.2f} ms")
+
+    for mode, summary in benchmark_async(user=user, host=host,
+                                         dbname=dbname).items():
+        print(f"{mode:>10}: mean {summary['mean']:.2f} ms, "
+              f"median {summary['median']:.2f} ms")
+
+    years = incident_years(user, host, dbname)
+    for mode, summary in benchmark_fan_out(user=user, host=host,
+                                           dbname=dbname,
+                                           years=years).items():
+        print(f"{mode:>10}: mean {summary['mean']:.2f} ms, "
+              f"median {summary['median']:.2f} ms")
+
+    load = benchmark_load(user=user, host=host, dbname=dbname, dir=data_dir)
+    for mode, seconds in load.items():
+        print(f"{mode:>20}: {seconds:.2f} s")
+
+    create_index(user=user, host=host, dbname=dbname)
+    for name, times in benchmark_sargable().items():
+        print(f"{name}: before {times['before']:.2f} ms, "
+              f"after {times['after']:.2f} ms")
+
+    for name, metric in sorted(query_metrics().items(),
+                               key=lambda item: -item[1]['calls'] *
+                               item[1]['total_ms']['mean']):
+        print(f"{name}: {metric['calls']} calls, "
+              f"total p95 {metric['total_ms']['p95']:.2f} ms "
+              f"(connect {metric['connect_ms']['p95']:.2f}, "
+              f"execute {metric['execute_ms']['p95']:.2f}, "
+              f"fetch {metric['fetch_ms']['p95']:.2f}), "
+              f"{metric['rows']} rows, {metric['bytes']} bytes, "
+              f"{metric['slow']} slow")
+    write_metrics(METRICS_PATH)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+CACHE_SETTINGS = {'enabled': True,
+                  'max_bytes': 64 << 20,
+                  'ttl': 60.0}
+
+BASE_TABLES = ['report_type', 'incident_type', 'location', 'incident']
+# Objects computed from the base tables, and the tables they read.
+DERIVED_TABLES = {'incident_with_details': BASE_TABLES,
+                  'incident_daily_rollup': ['incident'],
+                  'incident_monthly_rollup': ['incident'],
+                  'incident_code_rollup': ['incident', 'incident_type'],
+                  'incident_report_type_rollup': ['incident',
+                                                  'report_type']}
+
+_ttls = {}
+_entries = OrderedDict()
+_versions = {}
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0,
+          'invalidations': 0, 'bytes': 0}
+_lock = threading.Lock()
+
+
+def configure_cache(**settings):
+    """
+    Updates the cache settings (enabled, max_bytes and ttl,
+    the default time to live in seconds) and empties the cache.
+    """
+    unknown = set(settings) - set(CACHE_SETTINGS)
+    if unknown:
+        raise ValueError(f"Unknown cache settings: {sorted(unknown)}")
+    CACHE_SETTINGS.update(settings)
+    clear_cache()
+
+
+def set_ttl(name, seconds):
+    """
+    Sets the time to live of the results of the query function name.
+    """
+    _ttls[name] = seconds
+
+
+def referenced_tables(query):
+    """
+    Returns the base tables query depends on: the base tables it names
+    and the base tables behind the views and rollups it names.
+    """
+    words = set(re.findall(r'[a-z_][a-z0-9_]*', query.lower()))
+    tables = words & set(BASE_TABLES)
+    for derived in words & set(DERIVED_TABLES):
+        tables.update(DERIVED_TABLES[derived])
+    return sorted(tables)
+
+
+def result_size(rows):
+    """
+    Returns an estimate of the memory used by a list of rows
+    (or by a columnar result that knows its nbytes) in bytes.
+    """
+    if hasattr(rows, 'nbytes'):
+        return rows.nbytes
+    return sys.getsizeof(rows) + sum(
+        sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+        for row in rows)
+
+
+def table_versions(key, tables):
+    """
+    Returns the current version of each table in the database of key.
+    """
+    user, host, dbname = key[:3]
+    return tuple(_versions.get((host, dbname, table), 0)
+                 for table in tables)
+
+
+def copy_rows(rows):
+    """
+    Returns a shallow copy of a list of rows, so the caller
+    can change the list without changing the cached result.
+    Columnar results (Arrow tables) are immutable and returned as is.
+    """
+    return list(rows) if isinstance(rows, list) else rows
+
+
+def lookup(key, tables):
+    """
+    Returns (True, rows) if the result of key is cached, has not
+    expired and none of tables has been written since,
+    and (False, None) otherwise. The rows are a copy of the cached
+    list.
+    """
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None:
+            rows, size, expires, versions = entry
+            if expires > time.monotonic() and \
+                    versions == table_versions(key, tables):
+                _entries.move_to_end(key)
+                _stats['hits'] += 1
+                return True, copy_rows(rows)
+            del _entries[key]
+            _stats['bytes'] -= size
+        _stats['misses'] += 1
+    return False, None
+
+
+def store(name, key, rows, versions):
+    """
+    Caches a copy of rows as the result of key, valid for the time
+    to live of the query function name as long as the tables keep
+    versions, evicting the least recently used results beyond
+    max_bytes.
+    """
+    size = result_size(rows)
+    if size > CACHE_SETTINGS['max_bytes']:
+        return
+    rows = copy_rows(rows)
+    expires = time.monotonic() + _ttls.get(name, CACHE_SETTINGS['ttl'])
+    with _lock:
+        old = _entries.pop(key, None)
+        if old is not None:
+            _stats['bytes'] -= old[1]
+        _entries[key] = (rows, size, expires, versions)
+        _stats['bytes'] += size
+        while _stats['bytes'] > CACHE_SETTINGS['max_bytes']:
+            _, evicted = _entries.popitem(last=False)
+            _stats['bytes'] -= evicted[1]
+            _stats['evictions'] += 1
+
+
+def cached(name, key, query, run):
+    """
+    Returns the rows of query for key, calling run() to fetch them
+    from the database when they are not cached. The list returned
+    is never the cached one, so callers may sort or extend it.
+    """
+    if not CACHE_SETTINGS['enabled']:
+        return run()
+    tables = referenced_tables(query)
+    hit, rows = lookup(key, tables)
+    if hit:
+        return rows
+    with _lock:
+        versions = table_versions(key, tables)
+    rows = run()
+    store(name, key, rows, versions)
+    return rows
+
+
+def invalidate(user, host, dbname, tables):
+    """
+    Records a write to tables (base tables, views or rollups)
+    in dbname, so the cached results that depend on them are
+    fetched again.
+    """
+    tables = referenced_tables(' '.join(tables))
+    with _lock:
+        for table in tables:
+            version_key = (host, dbname, table)
+            _versions[version_key] = _versions.get(version_key, 0) + 1
+        _stats['invalidations'] += 1
+
+
+def cache_stats():
+    """
+    Returns the number of hits, misses, evictions and invalidations,
+    the hit rate, the number of cached results
+    and their estimated size in bytes.
+    """
+    with _lock:
+        stats = dict(_stats)
+        stats['entries'] = len(_entries)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+    return stats
+
+
+def clear_cache():
+    """
+    Removes every cached result.
+    """
+    with _lock:
+        _entries.clear()
+        _stats['bytes'] = 0
@@ -2,52 +2,66 @@ import time
 
 import streamlit as st
 
+from bench import run_benchmark
 from hw1 import *
 from hw2 import *
+from plans import check_plans
 
 from user_definition import *
 
 
-def retrieve_time_val(input):
-    print(input[-1][0])
-    return float(input[-1][0].split("Execution Time: ")[1].split(" ")[0])
-
-
-def return_time_measure():
-    return_count_by_location_report_type_incident_description_time = 0
-    for i in range(0, test_time):
-        time_measure =\
-            return_count_by_location_report_type_incident_description(user=user,
-                                                                      host=host,
-                                                                      dbname=dbname,
-                                                                      year=year,
-                                                                      explain=True)
-        return_count_by_location_report_type_incident_description_time +=\
-            retrieve_time_val(time_measure)
-    return_count_by_location_report_type_incident_description_time /= test_time
-
-    return return_count_by_location_report_type_incident_description_time
+def return_time_measure(
+        func=return_count_by_location_report_type_incident_description,
+        **kargs):
+    """
+    Returns the mean EXPLAIN ANALYZE execution time (ms) of func
+    (Q4 by default), called with kargs, over test_time runs after
+    a warmup, measured by run_benchmark() from bench.py.
+    """
+    results = run_benchmark(func, test_time, user=user, host=host,
+                            dbname=dbname, year=year, **kargs)
+    return results['execution_ms']['mean']
 
 
 def calculate_index_improvement(**kargs):
+    """
+    Loads the data in dir, measures Q4, creates the indexes and
+    measures Q4 again. Returns the decrease of the execution time
+    of Q4 in percent.
+    With plans=True, it also captures the plan of Q4 before and after
+    the indexes and returns a tuple (improvement, plans), plans being
+    the result of check_plans() for Q4 after the indexes with the plan
+    before them as the baseline: the plan changes and the problems
+    left in the new plan.
+    """
     user = kargs['user']
     host = kargs['host']
     dbname = kargs['dbname']
     dir = kargs['dir']
+    parallelism = kargs.get('parallelism', 1)
+    capture = kargs.get('plans', False)
 
     drop_tables(user, host, dbname)
     create_tables(user, host, dbname)
-    copy_data(user, host, dbname, dir)
+    copy_data(user, host, dbname, dir, parallelism)
     before_time = return_time_measure()
+    workload = [(return_count_by_location_report_type_incident_description,
+                 {'year': year})]
+    if capture:
+        check_plans(workload, update=True, user=user, host=host,
+                    dbname=dbname)
 
     drop_tables(user, host, dbname)
 
     create_tables(user, host, dbname)
-    copy_data(user, host, dbname, dir)
+    copy_data(user, host, dbname, dir, parallelism)
     create_index(**kargs)
     after_time = return_time_measure()
-
-    return (before_time-after_time)/before_time*100
+    improvement = (before_time-after_time)/before_time*100
+    if capture:
+        plans = check_plans(workload, user=user, host=host, dbname=dbname)
+        return improvement, plans
+    return improvement
 
 
 def main():
@@ -60,14 +74,21 @@ def main():
         st.write('You entered: ', folder_path)
         st.session_state.dir = folder_path
 
-        improvement = calculate_index_improvement(user=user,
-                                                  host=host,
-                                                  dbname=dbname,
-                                                  dir=st.session_state.dir)
+        improvement, plans = calculate_index_improvement(
+            user=user, host=host, dbname=dbname,
+            dir=st.session_state.dir, parallelism=parallelism,
+            plans=True)
 
         st.divider()
         st.write(
             f"Q4 Improvement: {improvement} %")
+        for name, result in plans.items():
+            for change in result['changes']:
+                st.write(f"{name} plan {change['change']} at "
+                         f"{change['path']}: {change.get('before', '')} "
+                         f"-> {change.get('after', '')}")
+            for warning in result['warnings']:
+                st.write(f"{name}: {warning['kind']} in {warning['node']}")
         st.divider()
 
 
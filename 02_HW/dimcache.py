@@ -0,0 +1,112 @@
+import threading
+import time
+from array import array
+
+from cache import table_versions
+from pool import connection
+
+
+DIMENSION_TTL = 300.0
+DIMENSION_QUERIES = {
+    'report_type':
+        """
+        SELECT report_type_code, report_type_description
+        FROM report_type
+        """,
+    'incident_type':
+        """
+        SELECT incident_code, incident_category,
+        incident_subcategory, incident_description
+        FROM incident_type
+        """,
+    'location':
+        """
+        SELECT longitude, latitude, supervisor_district,
+        police_district, neighborhood
+        FROM location
+        """}
+
+_dimensions = {}
+_lock = threading.Lock()
+
+
+def load_dimension(user, host, dbname, table):
+    """
+    Reads table and returns its rows with the lookup structures
+    built from them: for incident_type the incident codes as an array
+    and the lowercased descriptions (None if NULL) in the same order,
+    for report_type
+    the report_type_codes of each lowercased description.
+    """
+    with connection(user, host, dbname) as conn:
+        with conn.cursor() as curs:
+            curs.execute(DIMENSION_QUERIES[table])
+            rows = curs.fetchall()
+    dimension = {'rows': rows}
+    if table == 'incident_type':
+        dimension['codes'] = array('i', [row[0] for row in rows])
+        dimension['descriptions'] = [row[3].lower() if row[3] is not None
+                                     else None for row in rows]
+    elif table == 'report_type':
+        codes = {}
+        for code, description in rows:
+            codes.setdefault(description.lower(), []).append(code)
+        dimension['codes'] = codes
+    return dimension
+
+
+def dimension(user, host, dbname, table):
+    """
+    Returns the cached rows and lookups of the dimension table,
+    loading it on first use, after a write recorded by
+    cache.invalidate() and at least every DIMENSION_TTL seconds.
+    """
+    key = (user, host, dbname, table)
+    with _lock:
+        versions = table_versions(key, [table])
+        entry = _dimensions.get(key)
+        if entry is not None and entry[0] == versions and \
+                entry[1] > time.monotonic():
+            return entry[2]
+    data = load_dimension(user, host, dbname, table)
+    with _lock:
+        _dimensions[key] = (versions, time.monotonic() + DIMENSION_TTL,
+                            data)
+    return data
+
+
+def dimension_rows(user, host, dbname, table):
+    """
+    Returns the rows of the dimension table from the cache.
+    """
+    return dimension(user, host, dbname, table)['rows']
+
+
+def incident_codes_like(user, host, dbname, substr):
+    """
+    Returns the incident codes whose incident_description contains
+    substr, case-insensitively, from the cached incident_type.
+    Like ILIKE, a NULL incident_description never matches.
+    """
+    incident_type = dimension(user, host, dbname, 'incident_type')
+    substr = substr.lower()
+    return [code for code, description
+            in zip(incident_type['codes'], incident_type['descriptions'])
+            if description is not None and substr in description]
+
+
+def report_type_codes(user, host, dbname, desc):
+    """
+    Returns the report_type_codes whose report_type_description
+    is desc, case-insensitively, from the cached report_type.
+    """
+    return dimension(user, host, dbname, 'report_type')['codes'].get(
+        desc.lower(), [])
+
+
+def clear_dimensions():
+    """
+    Removes every cached dimension table.
+    """
+    with _lock:
+        _dimensions.clear()
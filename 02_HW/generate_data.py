@@ -0,0 +1,213 @@
+import argparse
+import csv
+import gzip
+import io
+import os
+
+import numpy as np
+
+from loader import CHUNK_SIZE
+from pool import connection
+
+from user_definition import *
+
+
+HEADER = ('Incident ID,Incident Datetime,Report Datetime,'
+          'Longitude,Latitude,Report Type Code,Incident Code\n')
+CHUNK_ROWS = 1 << 20
+# Relative number of incidents on Monday to Sunday.
+WEEKDAY_WEIGHTS = np.array([1.0, 0.97, 0.98, 1.0, 1.08, 1.05, 0.92])
+# Relative number of incidents in each hour of the day.
+HOUR_WEIGHTS = np.array([4.0, 3.0, 2.5, 2.0, 1.5, 1.5, 2.0, 3.0,
+                         4.0, 4.5, 5.0, 5.0, 6.5, 5.5, 5.5, 5.5,
+                         6.0, 6.5, 6.5, 6.0, 5.5, 5.0, 4.5, 4.5])
+REPORT_TYPE_WEIGHTS = {'II': 0.62, 'IS': 0.18, 'VI': 0.14, 'VS': 0.06}
+
+
+def read_columns(path, columns):
+    """
+    Returns the given columns of the CSV file at path (without
+    its header) as object arrays of the text as written in the file.
+    """
+    with open(path, newline='') as file:
+        reader = csv.reader(file)
+        next(reader)
+        rows = [row for row in reader if row]
+    return [np.array([row[i] for row in rows], dtype=object)
+            for i in columns]
+
+
+def zipf_weights(rng, size, exponent):
+    """
+    Returns probabilities for size items following Zipf's law
+    with exponent, assigned to the items in a random order.
+    """
+    weights = 1.0 / (rng.permutation(size) + 1.0) ** exponent
+    return weights / weights.sum()
+
+
+def load_dimensions(dir, rng, code_skew=1.1, location_skew=0.8):
+    """
+    Reads the incident codes, locations and report types in dir
+    and returns them with the probability of each in an incident:
+    Zipf-distributed for codes and locations, REPORT_TYPE_WEIGHTS
+    for report types.
+    Longitudes and latitudes keep the text of location.csv,
+    so incident rows reference location rows exactly.
+    """
+    codes, = read_columns(os.path.join(dir, 'incident_type.csv'), [0])
+    longitudes, latitudes = read_columns(
+        os.path.join(dir, 'location.csv'), [0, 1])
+    report_types, = read_columns(os.path.join(dir, 'report_type.csv'), [0])
+    report_weights = np.array([REPORT_TYPE_WEIGHTS.get(code, 0.01)
+                               for code in report_types])
+    return {'codes': codes,
+            'code_p': zipf_weights(rng, len(codes), code_skew),
+            'longitudes': longitudes,
+            'latitudes': latitudes,
+            'location_p': zipf_weights(rng, len(longitudes),
+                                       location_skew),
+            'report_types': report_types,
+            'report_type_p': report_weights / report_weights.sum()}
+
+
+def daily_counts(rng, rows, start, end, amplitude=0.15, peak=200):
+    """
+    Splits rows incidents over the days from start to end (exclusive,
+    'YYYY-MM-DD') with a yearly cycle of the given amplitude peaking
+    on day of the year peak, and WEEKDAY_WEIGHTS.
+    Returns the days and the number of incidents on each.
+    """
+    days = np.arange(start, end, dtype='datetime64[D]')
+    day_of_year = (days - days.astype('datetime64[Y]')).astype(np.int64)
+    weekday = (days.astype(np.int64) + 3) % 7
+    weights = (1 + amplitude * np.cos(
+        2 * np.pi * (day_of_year - peak) / 365.25)) * \
+        WEEKDAY_WEIGHTS[weekday]
+    return days, rng.multinomial(rows, weights / weights.sum())
+
+
+def incident_lines(rng, dimensions, days, counts, first_id,
+                   null_location=0.05):
+    """
+    Returns the CSV lines of the incidents on days, counts[i] of them
+    on days[i], in incident_datetime order, with ids from first_id.
+    Report delays are log-normal around six hours, up to a year,
+    and a null_location fraction of incidents have no coordinates.
+    """
+    size = int(counts.sum())
+    day_index = np.repeat(np.arange(len(days)), counts)
+    hours = rng.choice(24, size, p=HOUR_WEIGHTS / HOUR_WEIGHTS.sum())
+    seconds = hours * 3600 + rng.integers(0, 3600, size)
+    # day_index is already sorted, so this sorts seconds within each day.
+    seconds = seconds[np.lexsort((seconds, day_index))]
+    incident = days[day_index].astype('datetime64[s]') + \
+        seconds.astype('timedelta64[s]')
+    delay = np.minimum(rng.lognormal(np.log(6 * 3600), 1.5, size),
+                       365 * 86400).astype(np.int64)
+    report = incident + delay.astype('timedelta64[s]')
+
+    location = rng.choice(len(dimensions['longitudes']), size,
+                          p=dimensions['location_p'])
+    longitudes = dimensions['longitudes'][location]
+    latitudes = dimensions['latitudes'][location]
+    missing = rng.random(size) < null_location
+    longitudes[missing] = ''
+    latitudes[missing] = ''
+    report_types = dimensions['report_types'][rng.choice(
+        len(dimensions['report_types']), size,
+        p=dimensions['report_type_p'])]
+    codes = dimensions['codes'][rng.choice(
+        len(dimensions['codes']), size, p=dimensions['code_p'])]
+
+    table = np.column_stack([np.arange(first_id, first_id + size),
+                             np.datetime_as_string(incident),
+                             np.datetime_as_string(report),
+                             longitudes, latitudes, report_types, codes])
+    lines = io.StringIO()
+    np.savetxt(lines, table, fmt='%s', delimiter=',')
+    return lines.getvalue()
+
+
+def generate_incidents(dir, rows, start, end, seed=0, amplitude=0.15,
+                       peak=200, chunk_rows=CHUNK_ROWS, null_location=0.05):
+    """
+    Yields the CSV text (without a header) of rows synthetic
+    incidents between start and end over the dimension tables in dir,
+    about chunk_rows rows at a time, in incident_datetime order,
+    so memory stays the same whatever rows is.
+    The same seed gives the same incidents.
+    """
+    rng = np.random.default_rng(seed)
+    dimensions = load_dimensions(dir, rng)
+    days, counts = daily_counts(rng, rows, start, end, amplitude, peak)
+    first_id = 1
+    begin = 0
+    while begin < len(days):
+        end_day = begin + 1
+        total = counts[begin]
+        while end_day < len(days) and total + counts[end_day] <= chunk_rows:
+            total += counts[end_day]
+            end_day += 1
+        yield incident_lines(rng, dimensions, days[begin:end_day],
+                             counts[begin:end_day], first_id, null_location)
+        first_id += int(total)
+        begin = end_day
+
+
+def write_incident_csv(dir, rows, start, end, path=None, **kargs):
+    """
+    Writes rows synthetic incidents (see generate_incidents())
+    to path, incident.csv in dir by default, with a header,
+    gzip-compressed if path ends with .gz.
+    Returns the path.
+    """
+    path = path or os.path.join(dir, 'incident.csv')
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'wt', newline='') as file:
+        file.write(HEADER)
+        for lines in generate_incidents(dir, rows, start, end, **kargs):
+            file.write(lines)
+    return path
+
+
+def copy_incidents(user, host, dbname, dir, rows, start, end, **kargs):
+    """
+    Streams rows synthetic incidents (see generate_incidents())
+    straight into incident with COPY FROM STDIN, without a file.
+    Returns the number of rows copied.
+    """
+    with connection(user, host, dbname) as conn:
+        with conn.cursor() as curs:
+            with curs.copy("COPY incident FROM STDIN (FORMAT CSV)") as copy:
+                for lines in generate_incidents(dir, rows, start, end,
+                                                **kargs):
+                    data = lines.encode()
+                    for i in range(0, len(data), CHUNK_SIZE):
+                        copy.write(data[i:i + CHUNK_SIZE])
+            return curs.rowcount
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generates synthetic SF crime incidents.')
+    parser.add_argument('rows', type=int)
+    parser.add_argument('--start', default='2018-01-01')
+    parser.add_argument('--end', default='2024-01-01')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--amplitude', type=float, default=0.15)
+    parser.add_argument('--output',
+                        help='CSV path (incident.csv in data_dir by '
+                             'default), or "copy" to COPY into incident')
+    args = parser.parse_args()
+    kargs = {'seed': args.seed, 'amplitude': args.amplitude}
+    if args.output == 'copy':
+        copy_incidents(user, host, dbname, data_dir, args.rows,
+                       args.start, args.end, **kargs)
+    else:
+        write_incident_csv(data_dir, args.rows, args.start, args.end,
+                           args.output, **kargs)
+
+
+if __name__ == '__main__':
+    main()
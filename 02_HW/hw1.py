@@ -1,4 +1,112 @@
-import psycopg
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import BASE_TABLES, invalidate
+from dimcache import incident_codes_like, report_type_codes
+from loader import DIMENSION_TABLES, copy_file, file_checksum, find_input,\
+    load_tables
+from partition import create_partitions, scan_months
+from pool import connection
+from query import execute_query, stream_rows
+from rollup import ROLLUP_TABLES
+from validate import INCIDENT_COLUMNS, REJECTS_FILE, copy_validated
+
+
+PRIMARY_KEYS = {'report_type': 'PRIMARY KEY (report_type_code)',
+                'incident_type': 'PRIMARY KEY (incident_code)',
+                'location': 'PRIMARY KEY (longitude, latitude)',
+                'incident': 'PRIMARY KEY (id)'}
+FOREIGN_KEYS =\
+    """
+    ADD FOREIGN KEY (report_type_code)
+    REFERENCES  report_type (report_type_code)
+    ON UPDATE CASCADE,
+    ADD FOREIGN KEY (incident_code)
+    REFERENCES  incident_type (incident_code)
+    ON UPDATE CASCADE,
+    """
+# The columns of each CSV file, in order.
+CSV_COLUMNS = {'report_type': ['report_type_code', 'report_type_description'],
+               'incident_type': ['incident_code', 'incident_category',
+                                 'incident_subcategory',
+                                 'incident_description'],
+               'location': ['longitude', 'latitude', 'supervisor_district',
+                            'police_district', 'neighborhood'],
+               'incident': INCIDENT_COLUMNS}
+# The columns ingest_batch() matches existing rows on.
+UPSERT_KEYS = {'report_type': ['report_type_code'],
+               'incident_type': ['incident_code'],
+               'location': ['longitude', 'latitude'],
+               'incident': ['id']}
+# ingest_watermark records every batch ingested by ingest_batch().
+WATERMARK_TABLE =\
+    """
+    CREATE TABLE IF NOT EXISTS ingest_watermark
+    (
+        checksum TEXT NOT NULL,
+        batch TEXT NOT NULL,
+        rows INTEGER NULL,
+        max_id INTEGER NULL,
+        max_incident_datetime TIMESTAMP NULL,
+        loaded_at TIMESTAMPTZ NOT NULL,
+        PRIMARY KEY (checksum)
+    )
+    """
+# Numbers the staged locations that are not in location yet
+# after the last location_id, for the location_id schema.
+NUMBER_STAGED_LOCATIONS =\
+    """
+    UPDATE location_stage AS stage
+    SET location_id = location.location_id
+    FROM location
+    WHERE stage.longitude = location.longitude
+    AND stage.latitude = location.latitude;
+    UPDATE location_stage AS stage
+    SET location_id = numbered.location_id
+    FROM (SELECT longitude, latitude,
+          (SELECT COALESCE(MAX(location_id), 0) FROM location) +
+          DENSE_RANK() OVER (ORDER BY longitude, latitude) AS location_id
+          FROM location_stage
+          WHERE location_id IS NULL) AS numbered
+    WHERE stage.longitude = numbered.longitude
+    AND stage.latitude = numbered.latitude
+    AND stage.location_id IS NULL;
+    """
+LOCATION_FOREIGN_KEYS =\
+    {False: """
+            ADD FOREIGN KEY (longitude, latitude)
+            REFERENCES  location (longitude, latitude)
+            ON UPDATE CASCADE
+            """,
+     True: """
+           ADD FOREIGN KEY (location_id)
+           REFERENCES  location (location_id)
+           ON UPDATE CASCADE
+           """}
+
+
+def primary_keys(partitioned=False, location_id=False):
+    """
+    Returns the primary key of each table.
+    A partitioned incident has to include the partition key,
+    incident_datetime, in its primary key.
+    With location_id, location is keyed by its integer location_id
+    and (longitude, latitude) only has to be unique.
+    """
+    keys = dict(PRIMARY_KEYS)
+    if partitioned:
+        keys['incident'] = 'PRIMARY KEY (id, incident_datetime)'
+    if location_id:
+        keys['location'] = ('PRIMARY KEY (location_id), '
+                            'ADD UNIQUE (longitude, latitude)')
+    return keys
+
+
+def foreign_keys(location_id=False):
+    """
+    Returns the foreign keys of incident as ALTER TABLE clauses.
+    """
+    return FOREIGN_KEYS + LOCATION_FOREIGN_KEYS[location_id]
 
 
 def drop_tables(user, host, dbname):
@@ -9,22 +117,26 @@ def drop_tables(user, host, dbname):
     report_type, incident_type, location and incident.
     This function should work regardless of
     the existence of the table without any errors.
+    The rollups and derived_state, which are computed from
+    these tables, and the ingest_watermark of the batches
+    ingested into them are dropped with them.
     """
-    with psycopg.connect(f"user='{user}' \
-                         host='{host}' \
-                         dbname='{dbname}'") as conn:
+    with connection(user, host, dbname) as conn:
         with conn.cursor() as curs:
             drop_tables =\
-                """
+                f"""
                 DROP TABLE IF EXISTS
-                report_type, incident_type, location, incident
+                report_type, incident_type, location, incident,
+                {', '.join(ROLLUP_TABLES)}, derived_state, ingest_watermark
                 CASCADE;
                 """
             curs.execute(drop_tables)
         conn.commit()
+    invalidate(user, host, dbname, BASE_TABLES)
 
 
-def create_tables(user, host, dbname):
+def create_tables(user, host, dbname, constraints=True,
+                  unlogged=False, partition_by=None, location_id=False):
     """
     For the given user, host, and dbname,
     this function creates 4 different tables including
@@ -61,46 +173,60 @@ def create_tables(user, host, dbname):
     primary key - id
     foreign key - report_type_code, incident_code and
                   (longitude, latitude) pair.
+    If constraints is False, the tables are created without
+    their primary and foreign keys, which add_constraints() adds later.
+    If unlogged is True, the tables are created as UNLOGGED.
+    If partition_by is 'year' or 'month', incident is created
+    as a table range-partitioned by incident_datetime
+    with a default partition, and copy_data() creates
+    the other partitions from the data it loads.
+    If location_id is True, location gets an integer key, location_id,
+    which incident references instead of (longitude, latitude);
+    copy_data(location_id=True) fills it in.
     """
-    with psycopg.connect(f"user='{user}' \
-                         host='{host}' \
-                         dbname='{dbname}'") as conn:
+    if partition_by is not None and unlogged:
+        raise ValueError("A partitioned incident cannot be UNLOGGED")
+    table = 'CREATE UNLOGGED TABLE' if unlogged else 'CREATE TABLE'
+    partitioning = '' if partition_by is None \
+        else 'PARTITION BY RANGE (incident_datetime)'
+    location_column = ',\n location_id INTEGER NOT NULL' \
+        if location_id else ''
+    incident_location_column = ',\n location_id INTEGER NULL' \
+        if location_id else ''
+    with connection(user, host, dbname) as conn:
         with conn.cursor() as curs:
             report_type =\
-                """
-                CREATE TABLE report_type
+                f"""
+                {table} report_type
                 (
                     report_type_code VARCHAR(2) NOT NULL,
-                    report_type_description VARCHAR(100) NOT NULL,
-                    PRIMARY KEY (report_type_code)
+                    report_type_description VARCHAR(100) NOT NULL
                 )
                 """
             incident_type =\
-                """
-                CREATE TABLE incident_type
+                f"""
+                {table} incident_type
                 (
                     incident_code INTEGER NOT NULL,
                     incident_category VARCHAR(100) NULL,
                     incident_subcategory VARCHAR(100) NULL,
-                    incident_description VARCHAR(200) NULL,
-                    PRIMARY KEY (incident_code)
+                    incident_description VARCHAR(200) NULL
                 );
                 """
             location =\
-                """
-                CREATE TABLE location
+                f"""
+                {table} location
                 (
                     longitude REAL NOT NULL,
                     latitude REAL NOT NULL,
                     supervisor_district REAL NULL,
                     police_district VARCHAR(100) NOT NULL,
-                    neighborhood VARCHAR(100) NULL,
-                    PRIMARY KEY(longitude, latitude)
+                    neighborhood VARCHAR(100) NULL{location_column}
                 );
                 """
             incident =\
-                """
-                CREATE TABLE incident
+                f"""
+                {table} incident
                 (
                     id INTEGER NOT NULL,
                     incident_datetime TIMESTAMP NOT NULL,
@@ -108,72 +234,366 @@ def create_tables(user, host, dbname):
                     longitude REAL NULL,
                     latitude REAL NULL,
                     report_type_code VARCHAR(2) NOT NULL,
-                    incident_code INTEGER NOT NULL,
-                    PRIMARY KEY (id),
-                    FOREIGN KEY (report_type_code)
-                    REFERENCES  report_type (report_type_code)
-                    ON UPDATE CASCADE,
-                    FOREIGN KEY (incident_code)
-                    REFERENCES  incident_type (incident_code)
-                    ON UPDATE CASCADE,
-                    FOREIGN KEY (longitude, latitude)
-                    REFERENCES  location (longitude, latitude)
-                    ON UPDATE CASCADE
-                );
+                    incident_code INTEGER NOT NULL{incident_location_column}
+                ) {partitioning};
                 """
             curs.execute(report_type)
             curs.execute(incident_type)
             curs.execute(location)
             curs.execute(incident)
+            if partition_by is not None:
+                curs.execute("""CREATE TABLE incident_default
+                                PARTITION OF incident DEFAULT""")
+            if constraints:
+                keys = primary_keys(partition_by is not None, location_id)
+                for table, key in keys.items():
+                    curs.execute(f"ALTER TABLE {table} ADD {key}")
+                curs.execute(
+                    f"ALTER TABLE incident {foreign_keys(location_id)}")
+        conn.commit()
+    invalidate(user, host, dbname, BASE_TABLES)
+
+
+def add_constraints(user, host, dbname, parallel_workers=4):
+    """
+    Adds the primary and foreign keys to tables created by
+    create_tables(constraints=False) once the data is loaded,
+    turning UNLOGGED tables into logged ones first.
+    The primary key indexes are built at the same time on
+    separate connections, each using up to parallel_workers
+    parallel maintenance workers where the server allows it,
+    and the foreign keys are then validated in one pass
+    over incident.
+    """
+    def add_primary_key(table, key):
+        with connection(user, host, dbname) as conn:
+            with conn.cursor() as curs:
+                curs.execute(f"""SET max_parallel_maintenance_workers
+                                 = {int(parallel_workers)}""")
+                curs.execute(f"ALTER TABLE {table} ADD {key}")
+            conn.commit()
+
+    with connection(user, host, dbname) as conn:
+        with conn.cursor() as curs:
+            curs.execute(
+                """
+                SELECT relname FROM pg_class
+                WHERE relname IN
+                ('report_type', 'incident_type', 'location', 'incident')
+                AND relpersistence = 'u'
+                """)
+            for (table,) in curs.fetchall():
+                curs.execute(f"ALTER TABLE {table} SET LOGGED")
+            curs.execute("SELECT relkind FROM pg_class "
+                         "WHERE relname = 'incident'")
+            partitioned = curs.fetchone()[0] == 'p'
+            curs.execute("""SELECT COUNT(*) FROM information_schema.columns
+                            WHERE table_name = 'incident'
+                            AND column_name = 'location_id'""")
+            location_id = curs.fetchone()[0] > 0
+            keys = primary_keys(partitioned, location_id)
+        conn.commit()
+
+    with ThreadPoolExecutor(max_workers=len(keys)) as executor:
+        futures = [executor.submit(add_primary_key, table, key)
+                   for table, key in keys.items()]
+        for future in futures:
+            future.result()
+
+    with connection(user, host, dbname) as conn:
+        with conn.cursor() as curs:
+            curs.execute(f"ALTER TABLE incident {foreign_keys(location_id)}")
         conn.commit()
 
 
-def copy_data(user, host, dbname, dir):
+def migrate_location_id(user, host, dbname):
+    """
+    Moves tables created by create_tables() with the composite
+    (longitude, latitude) key of location to the location_id schema
+    of create_tables(location_id=True): location rows are numbered,
+    incident.location_id is resolved by joining on the pair,
+    and the keys are swapped in a single transaction.
+    """
+    with connection(user, host, dbname) as conn:
+        with conn.cursor() as curs:
+            query =\
+                """
+                ALTER TABLE location ADD COLUMN location_id INTEGER;
+                UPDATE location
+                SET location_id = numbered.location_id
+                FROM (SELECT longitude, latitude,
+                      ROW_NUMBER() OVER (ORDER BY longitude, latitude)
+                      AS location_id
+                      FROM location) AS numbered
+                WHERE location.longitude = numbered.longitude
+                AND location.latitude = numbered.latitude;
+                ALTER TABLE location ALTER COLUMN location_id SET NOT NULL;
+
+                ALTER TABLE incident ADD COLUMN location_id INTEGER NULL;
+                UPDATE incident
+                SET location_id = location.location_id
+                FROM location
+                WHERE incident.longitude = location.longitude
+                AND incident.latitude = location.latitude;
+
+                ALTER TABLE incident
+                DROP CONSTRAINT incident_longitude_latitude_fkey;
+                ALTER TABLE location DROP CONSTRAINT location_pkey;
+                """
+            curs.execute(query)
+            curs.execute(f"ALTER TABLE location "
+                         f"ADD {primary_keys(location_id=True)['location']}")
+            curs.execute(f"ALTER TABLE incident "
+                         f"{LOCATION_FOREIGN_KEYS[True]}")
+        conn.commit()
+    invalidate(user, host, dbname, ['location', 'incident'])
+
+
+def copy_data(user, host, dbname, dir, parallelism=1, partition_by=None,
+              location_id=False, validate=False, rejects_path=REJECTS_FILE):
     """
     Using user, host, dbname, and dir,
     this function connects to the database and
     loads data to report_type, incident_type, location and incident
     from report_type.csv, incident_type.csv, location.csv and incident.csv
     located in dir.
+    The files are streamed from the client with COPY FROM STDIN,
+    so dir does not have to be on the database server,
+    and may also be gzip (.csv.gz) or zstd (.csv.zst) compressed.
+    If parallelism is more than 1, incident.csv is split into
+    that many line-aligned ranges that are copied in parallel,
+    and either all of them are loaded or none.
+    If incident was created with partition_by, pass the same value
+    to create the partitions for the months in incident.csv first.
+    If the tables were created with location_id, pass it as well
+    to number the locations and resolve the location_id of each
+    incident while the files are streamed.
+    If validate is True, incident.csv is checked and normalized
+    by validate.copy_validated() in parallelism processes (every core
+    if parallelism is 1) before it reaches COPY, and the rows that
+    would abort it are written to rejects_path instead.
+    It returns the rows/s and bytes/s of each table
+    (and of each incident worker).
     Note: each file includes a header.
     """
-    with psycopg.connect(f"user='{user}' \
-                         host='{host}' \
-                         dbname='{dbname}'") as conn:
+    if validate and location_id:
+        raise ValueError("location_id loads incident with copy_location_ids")
+    if partition_by is not None:
+        months = scan_months(find_input(dir, 'incident'))
+        create_partitions(user, host, dbname, months, partition_by)
+    copy_incident = None
+    if validate:
+        def copy_incident(path):
+            return copy_validated(user, host, dbname, dir, path,
+                                  rejects_path,
+                                  parallelism if parallelism > 1 else None)
+    stats = load_tables(user, host, dbname, dir, parallelism=parallelism,
+                        location_id=location_id, copy_incident=copy_incident)
+    invalidate(user, host, dbname, BASE_TABLES)
+    return stats
+
+
+def fast_load(user, host, dbname, dir, unlogged=False, parallel_workers=4,
+              parallelism=1, partition_by=None, location_id=False):
+    """
+    Using user, host, dbname, and dir,
+    this function recreates the tables without constraints
+    (as UNLOGGED if unlogged is True), loads the data in dir
+    with copy_data() and then adds the primary and foreign keys
+    in bulk with add_constraints(), so that incident rows are not
+    checked and indexed one at a time while they are copied.
+    parallelism, partition_by and location_id are passed on
+    to create_tables() and copy_data().
+    It returns the load statistics of each table together with
+    the seconds spent loading and adding the constraints.
+    """
+    drop_tables(user, host, dbname)
+    create_tables(user, host, dbname, constraints=False, unlogged=unlogged,
+                  partition_by=partition_by, location_id=location_id)
+    start = time.perf_counter()
+    tables = copy_data(user, host, dbname, dir, parallelism, partition_by,
+                       location_id)
+    load_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    add_constraints(user, host, dbname, parallel_workers)
+    return {'tables': tables,
+            'load_seconds': load_seconds,
+            'constraint_seconds': time.perf_counter() - start}
+
+
+def upsert_batch(curs, table, columns, keys, updates, select,
+                 replace_on=None):
+    """
+    Inserts the rows of select, which gives columns, into table,
+    updates the columns updates of the rows with the same keys where
+    they differ, and returns the number of rows inserted and updated.
+    The rows are updated by their own UPDATE, which sets only the
+    columns that changed and only runs if any did, so a batch of new
+    rows fires no UPDATE trigger of table (such as the one marking
+    the rollups stale). With replace_on, the rows of table with
+    the same replace_on columns as a row of select but different keys
+    are deleted first, and the row inserted in their place.
+    """
+    curs.execute(f"CREATE TEMP TABLE {table}_batch ON COMMIT DROP AS "
+                 f"{select}")
+    match = ' AND '.join(f"{table}.{key} = batch.{key}" for key in keys)
+    moved = 0
+    if replace_on:
+        same = ' AND '.join(f"{table}.{column} = batch.{column}"
+                            for column in replace_on)
+        moved_keys = [key for key in keys if key not in replace_on]
+        differ = ' OR '.join(f"{table}.{key} <> batch.{key}"
+                             for key in moved_keys)
+        curs.execute(f"""SELECT EXISTS (SELECT 1 FROM {table}
+                         JOIN {table}_batch AS batch ON {same}
+                         WHERE {differ})""")
+        if curs.fetchone()[0]:
+            curs.execute(f"""DELETE FROM {table}
+                             USING {table}_batch AS batch
+                             WHERE {same} AND ({differ})""")
+            moved = curs.rowcount
+    changed = []
+    if updates:
+        curs.execute(f"""SELECT {', '.join(
+                             f"COALESCE(bool_or({table}.{column} IS "
+                             f"DISTINCT FROM batch.{column}), FALSE)"
+                             for column in updates)}
+                         FROM {table} JOIN {table}_batch AS batch
+                         ON {match}""")
+        changed = [column for column, differs
+                   in zip(updates, curs.fetchone()) if differs]
+    updated = 0
+    if changed:
+        assignments = ', '.join(f"{column} = batch.{column}"
+                                for column in changed)
+        current = ', '.join(f"{table}.{column}" for column in changed)
+        new = ', '.join(f"batch.{column}" for column in changed)
+        curs.execute(f"""UPDATE {table} SET {assignments}
+                         FROM {table}_batch AS batch
+                         WHERE {match}
+                         AND ROW({current}) IS DISTINCT FROM ROW({new})""")
+        updated = curs.rowcount
+    curs.execute(f"""INSERT INTO {table} ({', '.join(columns)})
+                     SELECT {', '.join(columns)} FROM {table}_batch
+                     ON CONFLICT ({', '.join(keys)}) DO NOTHING""")
+    return curs.rowcount - moved, updated + moved
+
+
+def ingest_batch(user, host, dbname, dir, partition_by=None, force=False):
+    """
+    Adds a batch of new or corrected incidents, incident.csv in dir,
+    to the loaded tables without reloading them, together with
+    the report_type.csv, incident_type.csv and location.csv rows in
+    dir, if any, that the batch references.
+    Each file is copied into a temporary staging table and upserted
+    in bulk by upsert_batch(): new rows are inserted and existing rows
+    updated where they differ, matched on UPSERT_KEYS. If incident is
+    partitioned, an incident whose incident_datetime changed is
+    deleted from its old partition and inserted into the new one.
+    Within a file, the last row with a key wins. Indexes and
+    statistics are kept, new incidents are added to the rollups by
+    their triggers and corrections mark them stale, so the work is
+    proportional to the batch.
+    The checksum of the files is recorded in ingest_watermark with
+    the rows, the largest id and incident_datetime of the batch,
+    in the same transaction, and a batch that was already ingested
+    is skipped unless force is True.
+    If incident was created with partition_by, pass the same value
+    to create the partitions for the months in the batch first.
+    It returns the rows inserted and updated in each table.
+    """
+    paths = {}
+    for table in DIMENSION_TABLES + ['incident']:
+        try:
+            paths[table] = find_input(dir, table)
+        except FileNotFoundError:
+            if table == 'incident':
+                raise
+    checksum = file_checksum(paths.values())
+    stats = {'batch': dir, 'checksum': checksum, 'skipped': False,
+             'tables': {}}
+    start = time.perf_counter()
+    if partition_by is not None:
+        create_partitions(user, host, dbname, scan_months(paths['incident']),
+                          partition_by)
+    with connection(user, host, dbname) as conn:
         with conn.cursor() as curs:
-            report_type =\
-                f"""
-                COPY report_type
-                FROM '{dir}/report_type.csv'
-                DELIMITER ','
-                CSV HEADER;
-                """
-            incident_type =\
-                f"""
-                COPY incident_type
-                FROM '{dir}/incident_type.csv'
-                DELIMITER ','
-                CSV HEADER;
-                """
-            location =\
-                f"""
-                COPY location
-                FROM '{dir}/location.csv'
-                DELIMITER ','
-                CSV HEADER;
-                """
-            incident =\
-                f"""
-                COPY incident
-                FROM '{dir}/incident.csv'
-                DELIMITER ','
-                CSV HEADER;
-                """
-            curs.execute(report_type)
-            curs.execute(incident_type)
-            curs.execute(location)
-            curs.execute(incident)
+            curs.execute(WATERMARK_TABLE)
+            curs.execute("""INSERT INTO ingest_watermark
+                            (checksum, batch, loaded_at)
+                            VALUES (%s, %s, now())
+                            ON CONFLICT (checksum) DO NOTHING""",
+                         [checksum, dir])
+            if curs.rowcount == 0 and not force:
+                conn.rollback()
+                stats['skipped'] = True
+                return stats
+            curs.execute("SELECT relkind = 'p' FROM pg_class "
+                         "WHERE relname = 'incident'")
+            partitioned = curs.fetchone()[0]
+            curs.execute("""SELECT COUNT(*) > 0
+                            FROM information_schema.columns
+                            WHERE table_name = 'location'
+                            AND column_name = 'location_id'""")
+            location_id = curs.fetchone()[0]
+
+            for table, path in paths.items():
+                curs.execute(f"""CREATE TEMP TABLE {table}_stage
+                                 ON COMMIT DROP
+                                 AS SELECT * FROM {table} WITH NO DATA""")
+                copy_file(curs,
+                          f"{table}_stage ({', '.join(CSV_COLUMNS[table])})",
+                          path)
+                staged = curs.rowcount
+                keys = UPSERT_KEYS[table]
+                replace_on = None
+                if table == 'incident' and partitioned:
+                    replace_on = keys
+                    keys = keys + ['incident_datetime']
+                columns = list(CSV_COLUMNS[table])
+                updates = [column for column in columns
+                           if column not in keys]
+                selected = [f"stage.{column}" for column in columns]
+                source = f"{table}_stage AS stage"
+                if location_id and table == 'location':
+                    curs.execute(NUMBER_STAGED_LOCATIONS)
+                    columns.append('location_id')
+                    selected.append('stage.location_id')
+                elif location_id and table == 'incident':
+                    columns.append('location_id')
+                    updates.append('location_id')
+                    selected.append('location.location_id')
+                    source += """
+                        LEFT JOIN location
+                        ON stage.longitude = location.longitude
+                        AND stage.latitude = location.latitude"""
+                distinct = ', '.join(f"stage.{key}"
+                                     for key in UPSERT_KEYS[table])
+                inserted, updated = upsert_batch(
+                    curs, table, columns, keys, updates,
+                    f"""SELECT DISTINCT ON ({distinct}) {', '.join(selected)}
+                        FROM {source}
+                        ORDER BY {distinct}, stage.ctid DESC""",
+                    replace_on)
+                stats['tables'][table] = {'staged': staged,
+                                          'inserted': inserted,
+                                          'updated': updated}
+
+            curs.execute("""UPDATE ingest_watermark
+                            SET rows = stage.rows,
+                                max_id = stage.max_id,
+                                max_incident_datetime = stage.max_datetime,
+                                loaded_at = now()
+                            FROM (SELECT COUNT(*) AS rows,
+                                  MAX(id) AS max_id,
+                                  MAX(incident_datetime) AS max_datetime
+                                  FROM incident_stage) AS stage
+                            WHERE checksum = %s""",
+                         [checksum])
         conn.commit()
+    invalidate(user, host, dbname, list(paths))
+    stats['seconds'] = time.perf_counter() - start
+    return stats
 
 
 def return_distinct_neighborhood_police_district(user, host, dbname, n=None):
@@ -187,9 +607,7 @@ def return_distinct_neighborhood_police_district(user, host, dbname, n=None):
     in ascending order.
     If n is not given, it returns all the rows.
     """
-    with psycopg.connect(f"user='{user}' \
-                         host='{host}' \
-                         dbname='{dbname}'") as conn:
+    with connection(user, host, dbname) as conn:
         with conn.cursor() as curs:
             query =\
                 """
@@ -198,9 +616,11 @@ def return_distinct_neighborhood_police_district(user, host, dbname, n=None):
                 WHERE neighborhood IS NOT NULL
                 ORDER BY neighborhood, police_district
                 """
+            params = []
             if n is not None:
-                query = query + f" LIMIT {n}"
-            curs.execute(query)
+                query = query + " LIMIT %s"
+                params.append(int(n))
+            execute_query(curs, query, params)
             return curs.fetchall()
 
 
@@ -213,9 +633,7 @@ def return_distinct_time_taken(user, host, dbname, n=None):
     in descending order.
     If n is not given, it returns all the rows.
     """
-    with psycopg.connect(f"user='{user}' \
-                         host='{host}' \
-                         dbname='{dbname}'") as conn:
+    with connection(user, host, dbname) as conn:
         with conn.cursor() as curs:
             query =\
                 """
@@ -225,17 +643,68 @@ def return_distinct_time_taken(user, host, dbname, n=None):
                 FROM incident
                 ORDER BY time DESC
                 """
+            params = []
             if n is not None:
-                query = query + f" LIMIT {n}"
-            curs.execute(query)
+                query = query + " LIMIT %s"
+                params.append(int(n))
+            execute_query(curs, query, params)
             return curs.fetchall()
 
 
+def like_pattern(substr):
+    """
+    Returns substr with the LIKE wildcards and escape character
+    escaped, so it only matches itself.
+    """
+    for char in ['\\', '%', '_']:
+        substr = substr.replace(char, '\\' + char)
+    return substr
+
+
+def create_search_index(user, host, dbname, full_text=False):
+    """
+    Using user, host and dbname, this function creates
+    the pg_trgm GIN indexes that let ILIKE searches on
+    incident_description and report_type_description use an index
+    instead of scanning and lowering every row, and an index on
+    incident (incident_code, report_type_code) for the EXISTS
+    probes from incident_type into incident.
+    If full_text is True, it also creates the GIN index on the
+    English tsvector of incident_description used by
+    search_incident_type().
+    """
+    with connection(user, host, dbname) as conn:
+        with conn.cursor() as curs:
+            query =\
+                """
+                CREATE EXTENSION IF NOT EXISTS pg_trgm;
+                CREATE INDEX IF NOT EXISTS incident_description_trgm
+                ON incident_type USING GIN
+                (incident_description gin_trgm_ops);
+                CREATE INDEX IF NOT EXISTS report_type_description_trgm
+                ON report_type USING GIN
+                (report_type_description gin_trgm_ops);
+                CREATE INDEX IF NOT EXISTS incident_code_report_type_index
+                ON incident (incident_code, report_type_code);
+                """
+            if full_text:
+                query = query +\
+                    """
+                    CREATE INDEX IF NOT EXISTS incident_description_fts
+                    ON incident_type USING GIN
+                    (to_tsvector('english', incident_description));
+                    """
+            curs.execute(query)
+            curs.execute("ANALYZE incident_type, report_type, incident")
+
+
 def return_incident_with_incident_substring(user,
                                             host,
                                             dbname,
                                             substr,
-                                            n=None):
+                                            n=None,
+                                            stream=False,
+                                            dimension_cache=True):
     """
     Using user, host, dbname, dir, substr, and n,
     this function connects to the database and
@@ -245,24 +714,43 @@ def return_incident_with_incident_substring(user,
     The search for the existence of the given substring
     should be case-insensitive.
     If n is not given, it returns all the rows.
+    If stream is True, it returns a generator that fetches the rows
+    through a server-side cursor instead of a list.
+    The matching incident codes are found in the client-side
+    dimension cache and sent as a list, so incident_type is not read;
+    with dimension_cache=False, the search is an ILIKE that can use
+    the trigram index of create_search_index().
     """
-    with psycopg.connect(f"user='{user}' \
-                         host='{host}' \
-                         dbname='{dbname}'") as conn:
+    if dimension_cache:
+        query =\
+            """
+            SELECT id, incident_datetime
+            FROM incident
+            WHERE incident_code = ANY(%s::INTEGER[])
+            ORDER BY id
+            """
+        params = [incident_codes_like(user, host, dbname, substr)]
+    else:
+        query =\
+            """
+            SELECT id, incident_datetime
+            FROM incident
+            WHERE EXISTS
+            (SELECT 1
+            FROM incident_type
+            WHERE incident_type.incident_code = incident.incident_code
+            AND incident_description ILIKE %s)
+            ORDER BY id
+            """
+        params = [f"%{like_pattern(substr)}%"]
+    if n is not None:
+        query = query + " LIMIT %s"
+        params.append(int(n))
+    if stream:
+        return stream_rows(user, host, dbname, query, params)
+    with connection(user, host, dbname) as conn:
         with conn.cursor() as curs:
-            query =\
-                f"""
-                SELECT DISTINCT id, incident_datetime
-                FROM incident
-                WHERE incident_code IN
-                (SELECT DISTINCT incident_code
-                FROM incident_type
-                WHERE LOWER(incident_description) LIKE '%{substr.lower()}%')
-                ORDER BY id
-                """
-            if n is not None:
-                query = query + f" LIMIT {n}"
-            curs.execute(query)
+            execute_query(curs, query, params)
             return curs.fetchall()
 
 
@@ -270,7 +758,8 @@ def return_incident_desc_for_report_type_desc(user,
                                               host,
                                               dbname,
                                               desc,
-                                              n=None):
+                                              n=None,
+                                              dimension_cache=True):
     """
     Using user, host, dbname, dir, substr, and n,
     this function connects to the database and
@@ -280,29 +769,81 @@ def return_incident_desc_for_report_type_desc(user,
     The search of the report_type_description
     should be case-insensitive.
     If n is not given, it returns all the rows.
+    The report_type_codes of desc are found in the client-side
+    dimension cache and sent as a list, so report_type is not read;
+    with dimension_cache=False, the match is an ILIKE without
+    wildcards, which can use the trigram index of
+    create_search_index().
+    """
+    if dimension_cache:
+        query =\
+            """
+            SELECT DISTINCT incident_description
+            FROM incident_type
+            WHERE EXISTS
+            (
+                SELECT 1
+                FROM incident
+                WHERE incident.incident_code = incident_type.incident_code
+                AND report_type_code = ANY(%s::VARCHAR[])
+            )
+            ORDER BY incident_description
+            """
+        params = [report_type_codes(user, host, dbname, desc)]
+    else:
+        query =\
+            """
+            SELECT DISTINCT incident_description
+            FROM incident_type
+            WHERE EXISTS
+            (
+                SELECT 1
+                FROM incident
+                JOIN report_type
+                ON report_type.report_type_code = incident.report_type_code
+                WHERE incident.incident_code = incident_type.incident_code
+                AND report_type_description ILIKE %s
+            )
+            ORDER BY incident_description
+            """
+        params = [like_pattern(desc)]
+    if n is not None:
+        query = query + " LIMIT %s"
+        params.append(int(n))
+    with connection(user, host, dbname) as conn:
+        with conn.cursor() as curs:
+            execute_query(curs, query, params)
+            return curs.fetchall()
+
+
+def search_incident_type(user, host, dbname, text, n=None):
+    """
+    Using user, host, dbname, text and n, this function connects
+    to the database and returns n rows of incident_code,
+    incident_description and rank of the incident types whose
+    description matches text as a web search (words, "phrases",
+    or, -excluded) in English, so "theft" also finds "Thefts",
+    ordered by rank in descending order and then by incident_code.
+    It uses the full-text index of create_search_index(full_text=True).
+    If n is not given, it returns all the rows.
     """
-    with psycopg.connect(f"user='{user}' \
-                         host='{host}' \
-                         dbname='{dbname}'") as conn:
+    with connection(user, host, dbname) as conn:
         with conn.cursor() as curs:
             query =\
-                f"""
-                SELECT DISTINCT incident_description
-                FROM incident_type
-                WHERE incident_code IN
-                (
-                    SELECT incident_code
-                    FROM incident
-                    WHERE report_type_code=
-                    (SELECT report_type_code
-                    FROM report_type
-                    WHERE LOWER(report_type_description) = '{desc.lower()}')
-                )
-                ORDER BY incident_description
                 """
+                SELECT incident_code, incident_description,
+                ts_rank(to_tsvector('english', incident_description),
+                        query) AS rank
+                FROM incident_type,
+                websearch_to_tsquery('english', %s) AS query
+                WHERE to_tsvector('english', incident_description) @@ query
+                ORDER BY rank DESC, incident_code
+                """
+            params = [text]
             if n is not None:
-                query = query + f" LIMIT {n}"
-            curs.execute(query)
+                query = query + " LIMIT %s"
+                params.append(int(n))
+            execute_query(curs, query, params)
             return curs.fetchall()
 
 
@@ -313,18 +854,17 @@ def update_report_type(user, host, dbname, from_str, to_str):
     updates report_type_code from from_str to to_str
     on the report_type table.
     """
-    with psycopg.connect(f"user='{user}' \
-                         host='{host}' \
-                         dbname='{dbname}'") as conn:
+    with connection(user, host, dbname) as conn:
         with conn.cursor() as curs:
             query =\
-                f"""
+                """
                 UPDATE report_type
-                SET report_type_code = '{to_str}'
-                WHERE report_type_code = '{from_str}';
+                SET report_type_code = %s
+                WHERE report_type_code = %s
                 """
-            curs.execute(query)
+            curs.execute(query, [to_str, from_str])
         conn.commit()
+    invalidate(user, host, dbname, ['report_type', 'incident'])
 
 
 # def print_count_data(curs):
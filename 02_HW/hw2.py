@@ -1,4 +1,16 @@
-import psycopg
+import functools
+import heapq
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+from partition import period_bounds
+from pool import POOL_SETTINGS, connection
+from query import fetch_all
+from rollup import use_rollups
+
+
+INDEX_STRATEGIES = ['btree', 'brin']
+BRIN_PAGES_PER_RANGE = 32
 
 
 def select_all(func):
@@ -20,28 +32,30 @@ def select_all(func):
     returns [('Other Miscellaneous', 101), ('Larceny Theft', 90),
     ('Robbery', 72), ('Drug Offense', 60), ('Burglary', 52)]
     """
+    @functools.wraps(func)
     def wrapper(**kwargs):
-        user = kwargs['user']
-        host = kwargs['host']
-        dbname = kwargs['dbname']
-        with psycopg.connect(f"user='{user}' \
-                            host='{host}' \
-                            dbname='{dbname}'") as conn:
-            with conn.cursor() as curs:
-                query = func(**kwargs)
-                curs.execute(query)
-                output = curs.fetchall()
-                return output
+        query, params = func(**kwargs)
+        return fetch_all(func.__name__, kwargs, query, params)
     return wrapper
 
 
 def check_query_args(**kargs):
+    """
+    Returns the query and its parameters, with the EXPLAIN prefix
+    if explain is True (or EXPLAIN with the options in explain,
+    such as '(FORMAT JSON)') and a bound LIMIT if n is given,
+    so the SQL text stays the same whatever the arguments.
+    """
     query = kargs['query']
+    params = list(kargs.get('params', []))
     if 'explain' in kargs and kargs['explain'] is True:
         query = 'EXPLAIN ANALYZE VERBOSE ' + query
+    elif kargs.get('explain', False):
+        query = f"EXPLAIN {kargs['explain']} " + query
     if 'n' in kargs:
-        query = query + f" LIMIT {kargs['n']}"
-    return query
+        query = query + " LIMIT %s"
+        params.append(int(kargs['n']))
+    return query, params
 
 
 @select_all
@@ -83,17 +97,32 @@ def return_incident_count_by_category_subcategory(**kargs):
     The output is ordered by occurrence in descending order.
     If there are records with the same count value, they are ordered
     by incident_category alphabetically (ascending).
+    The counts are read from incident_code_rollup when it is fresh.
     """
-    query = f"""
+    if use_rollups(kargs):
+        query = """
+        SELECT incident_category, incident_subcategory,
+            SUM(incident_count)::BIGINT AS count
+        FROM incident_code_rollup
+        LEFT JOIN incident_type
+        ON incident_code_rollup.incident_code = incident_type.incident_code
+        GROUP BY incident_category, incident_subcategory
+        HAVING SUM(incident_count) > %s
+        ORDER BY count DESC, incident_category ASC
+            """
+        return check_query_args(query=query,
+                                params=[int(kargs['count_limit'])], **kargs)
+    query = """
         SELECT incident_category, incident_subcategory, COUNT(*)
         FROM incident
         LEFT JOIN incident_type
         ON incident.incident_code = incident_type.incident_code
         GROUP BY incident_category, incident_subcategory
-        HAVING COUNT(*) > {kargs['count_limit']}
+        HAVING COUNT(*) > %s
         ORDER BY count DESC, incident_category ASC
             """
-    return check_query_args(query=query, **kargs)
+    return check_query_args(query=query,
+                            params=[int(kargs['count_limit'])], **kargs)
 
 
 @select_all
@@ -110,7 +139,19 @@ def return_count_by_location_report_type_incident_description(**kargs):
     and the corresponding count, which is ordered by count in descending order,
     and then by year, month, longitude, latitude, report_type_description,
     and incident_description in ascending order.
+    The year (or the month of the year, if month is given)
+    is filtered as a range of incident_datetime
+    so that a btree on incident_datetime, or partition pruning
+    on a partitioned incident, can serve it.
+    With location_id=True, location is joined on the integer
+    location_id of create_tables(location_id=True).
     """
+    start, end = period_bounds(kargs['year'], kargs.get('month'))
+    if kargs.get('location_id', False):
+        location_join = 'incident.location_id = location.location_id'
+    else:
+        location_join = """incident.latitude = location.latitude AND
+            incident.longitude = location.longitude"""
     query = f"""
         SELECT EXTRACT(year from incident.incident_datetime)::INTEGER AS year,
             EXTRACT(month from incident.incident_datetime)::INTEGER AS month,
@@ -122,13 +163,13 @@ def return_count_by_location_report_type_incident_description(**kargs):
             COUNT(*)
         FROM incident
         JOIN location
-        ON incident.latitude = location.latitude AND
-            incident.longitude = location.longitude
+        ON {location_join}
         JOIN incident_type
         ON incident.incident_code = incident_type.incident_code
         JOIN report_type
         ON report_type.report_type_code = incident.report_type_code
-        WHERE EXTRACT(year from incident.incident_datetime) = {kargs['year']}
+        WHERE incident.incident_datetime >= %s
+            AND incident.incident_datetime < %s
         GROUP BY EXTRACT(year from incident.incident_datetime),
                 EXTRACT(month from incident.incident_datetime),
                 incident.longitude,
@@ -140,7 +181,52 @@ def return_count_by_location_report_type_incident_description(**kargs):
                 incident.latitude, neighborhood, report_type_description,
                 incident_description
             """
-    return check_query_args(query=query, **kargs)
+    return check_query_args(query=query, params=[start, end], **kargs)
+
+
+def return_count_by_location_for_periods(**kargs):
+    """
+    Returns the rows of Q4 for every year in years and every
+    (year, month) pair in months (partition.month_range() returns
+    the months between two), in the order of Q4 and limited to n rows
+    if n is given. It raises ValueError if the periods overlap
+    (a year or month given twice, or a month of one of years),
+    and for stream, result_format and explain, since the rows
+    of the periods are merged as tuples.
+    The query of each period runs on its own pooled connection,
+    up to parallelism (the pool max_size by default) at a time,
+    and fetches at most n rows, since the first n rows overall
+    are among the first n rows of their period. The ordered results
+    are merged on (count, year, month): rows of different periods
+    never share a year and month, so the rest of the order
+    is that of each period.
+    """
+    periods = [(year, None) for year in kargs.pop('years', [])] + \
+        [(year, month) for year, month in kargs.pop('months', [])]
+    if kargs.get('stream', False) or kargs.get('explain', False) or \
+            kargs.get('result_format', 'rows') != 'rows':
+        raise ValueError("the periods can only be merged as rows")
+    years = [year for year, month in periods if month is None]
+    overlapping = len(set(periods)) < len(periods) or any(
+        month is not None and year in years for year, month in periods)
+    if overlapping:
+        raise ValueError("years and months must not overlap")
+    if not periods:
+        return []
+    parallelism = int(kargs.pop('parallelism', POOL_SETTINGS['max_size']))
+
+    def fetch(period):
+        year, month = period
+        return return_count_by_location_report_type_incident_description(
+            **dict(kargs, year=year, month=month))
+
+    with ThreadPoolExecutor(
+            max_workers=min(parallelism, len(periods))) as executor:
+        results = list(executor.map(fetch, periods))
+    rows = heapq.merge(*results, key=lambda row: (-row[7], row[0], row[1]))
+    if 'n' in kargs:
+        rows = itertools.islice(rows, int(kargs['n']))
+    return list(rows)
 
 
 @select_all
@@ -159,7 +245,18 @@ def return_avg_interval_days_per_incident_code(**kargs):
     If there are multiple rows with the same avg_interval_days,
     order by incident_code in ascending order.
     If n is not given, it returns all the rows.
+    The averages are read from incident_code_rollup when it is fresh.
     """
+    if use_rollups(kargs):
+        query = """
+        SELECT inc.incident_code, incident_description,
+                FLOOR(interval_days_sum / incident_count) AS average_response
+        FROM incident_code_rollup AS inc
+        LEFT JOIN incident_type
+        ON incident_type.incident_code = inc.incident_code
+        ORDER BY average_response DESC
+            """
+        return check_query_args(query=query, **kargs)
     query = """
         SELECT inc.incident_code, incident_description,
                 FLOOR(AVG(diff)) AS average_response
@@ -186,31 +283,47 @@ def return_monthly_count(**kargs):
     where each column includes the number of incidents
     for the corresponding year and month, ordered by year in ascending order.
     If `n` is not given, it returns all the rows.
+    The counts are computed in a single pass over incident,
+    and a month without incidents is NULL.
+    They are read from incident_monthly_rollup when it is fresh.
     """
+    if use_rollups(kargs):
+        query = """
+        SELECT year::NUMERIC AS year,
+        SUM(incident_count) FILTER (WHERE month = 1)::BIGINT AS JAN,
+        SUM(incident_count) FILTER (WHERE month = 2)::BIGINT AS FEB,
+        SUM(incident_count) FILTER (WHERE month = 3)::BIGINT AS MAR,
+        SUM(incident_count) FILTER (WHERE month = 4)::BIGINT AS APR,
+        SUM(incident_count) FILTER (WHERE month = 5)::BIGINT AS MAY,
+        SUM(incident_count) FILTER (WHERE month = 6)::BIGINT AS JUN,
+        SUM(incident_count) FILTER (WHERE month = 7)::BIGINT AS JUL,
+        SUM(incident_count) FILTER (WHERE month = 8)::BIGINT AS AUG,
+        SUM(incident_count) FILTER (WHERE month = 9)::BIGINT AS SEP,
+        SUM(incident_count) FILTER (WHERE month = 10)::BIGINT AS OCT,
+        SUM(incident_count) FILTER (WHERE month = 11)::BIGINT AS NOV,
+        SUM(incident_count) FILTER (WHERE month = 12)::BIGINT AS DEC
+        FROM incident_monthly_rollup
+        GROUP BY year
+        ORDER BY year
+        """
+        return check_query_args(query=query, **kargs)
     query = """
-    SELECT cohort.year,
-    SUM(CASE WHEN EXTRACT(month from incident_datetime) = 1 THEN 1 END) AS JAN,
-    SUM(CASE WHEN EXTRACT(month from incident_datetime) = 2 THEN 1 END) AS FEB,
-    SUM(CASE WHEN EXTRACT(month from incident_datetime) = 3 THEN 1 END) AS MAR,
-    SUM(CASE WHEN EXTRACT(month from incident_datetime) = 4 THEN 1 END) AS APR,
-    SUM(CASE WHEN EXTRACT(month from incident_datetime) = 5 THEN 1 END) AS MAY,
-    SUM(CASE WHEN EXTRACT(month from incident_datetime) = 6 THEN 1 END) AS JUN,
-    SUM(CASE WHEN EXTRACT(month from incident_datetime) = 7 THEN 1 END) AS JUL,
-    SUM(CASE WHEN EXTRACT(month from incident_datetime) = 8 THEN 1 END) AS AUG,
-    SUM(CASE WHEN EXTRACT(month from incident_datetime) = 9 THEN 1 END) AS SEP,
-    SUM(CASE WHEN EXTRACT(month from incident_datetime) = 10 THEN 1 END)
-    AS OCT,
-    SUM(CASE WHEN EXTRACT(month from incident_datetime) = 11 THEN 1 END)
-    AS NOV,
-    SUM(CASE WHEN EXTRACT(month from incident_datetime) = 12 THEN 1 END) AS DEC
-    FROM
-        (SELECT DISTINCT EXTRACT(year from incident_datetime) AS year
-        FROM incident
-        GROUP BY year) AS cohort
-    JOIN incident
-    ON EXTRACT(year from incident.incident_datetime) = cohort.year
-    GROUP BY cohort.year
-    ORDER BY cohort.year
+    SELECT EXTRACT(year from incident_datetime) AS year,
+    SUM(1) FILTER (WHERE EXTRACT(month from incident_datetime) = 1) AS JAN,
+    SUM(1) FILTER (WHERE EXTRACT(month from incident_datetime) = 2) AS FEB,
+    SUM(1) FILTER (WHERE EXTRACT(month from incident_datetime) = 3) AS MAR,
+    SUM(1) FILTER (WHERE EXTRACT(month from incident_datetime) = 4) AS APR,
+    SUM(1) FILTER (WHERE EXTRACT(month from incident_datetime) = 5) AS MAY,
+    SUM(1) FILTER (WHERE EXTRACT(month from incident_datetime) = 6) AS JUN,
+    SUM(1) FILTER (WHERE EXTRACT(month from incident_datetime) = 7) AS JUL,
+    SUM(1) FILTER (WHERE EXTRACT(month from incident_datetime) = 8) AS AUG,
+    SUM(1) FILTER (WHERE EXTRACT(month from incident_datetime) = 9) AS SEP,
+    SUM(1) FILTER (WHERE EXTRACT(month from incident_datetime) = 10) AS OCT,
+    SUM(1) FILTER (WHERE EXTRACT(month from incident_datetime) = 11) AS NOV,
+    SUM(1) FILTER (WHERE EXTRACT(month from incident_datetime) = 12) AS DEC
+    FROM incident
+    GROUP BY EXTRACT(year from incident_datetime)
+    ORDER BY year
     """
     return check_query_args(query=query, **kargs)
 
@@ -226,17 +339,39 @@ def create_index(**kargs):
     updates made to the database afterwards.
     Using streamlit, the create_index  will display the query improvement
     after you enter the absolute path of the data directory.
+    With strategy='btree' (the default), it creates a btree on
+    incident_datetime and clusters incident on it, which rewrites
+    the table under an exclusive lock.
+    With strategy='brin', it creates a BRIN index on incident_datetime
+    instead, summarizing pages_per_range pages per entry
+    (BRIN_PAGES_PER_RANGE by default). It is a small fraction of the
+    size of the btree and takes no rewrite, and it serves the
+    incident_datetime range filters of Q4 (and hw3 Q4) as long as
+    incident is loaded roughly in incident_datetime order.
+    Ranges filled by later inserts are summarized by autovacuum.
     """
     user = kargs['user']
     host = kargs['host']
     dbname = kargs['dbname']
-    with psycopg.connect(f"user='{user}' \
-                         host='{host}' \
-                         dbname='{dbname}'") as conn:
+    strategy = kargs.get('strategy', 'btree')
+    if strategy not in INDEX_STRATEGIES:
+        raise ValueError(f"strategy must be one of {INDEX_STRATEGIES}")
+    with connection(user, host, dbname) as conn:
         with conn.cursor() as curs:
-            query = """
-                CREATE INDEX incident_year_index
-                ON incident (EXTRACT(year FROM incident.incident_datetime));
-                CLUSTER incident USING incident_year_index;
-                """
+            if strategy == 'brin':
+                pages_per_range = int(kargs.get('pages_per_range',
+                                                BRIN_PAGES_PER_RANGE))
+                query = f"""
+                    CREATE INDEX incident_datetime_brin
+                    ON incident USING brin (incident_datetime)
+                    WITH (pages_per_range = {pages_per_range},
+                          autosummarize = on);
+                    ANALYZE incident;
+                    """
+            else:
+                query = """
+                    CREATE INDEX incident_datetime_index
+                    ON incident (incident_datetime);
+                    CLUSTER incident USING incident_datetime_index;
+                    """
             curs.execute(query)
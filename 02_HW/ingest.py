@@ -0,0 +1,31 @@
+import argparse
+
+from hw1 import ingest_batch
+from partition import PARTITION_UNITS
+
+from user_definition import *
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Ingests a batch of new SF crime incidents.')
+    parser.add_argument('dir',
+                        help='directory with incident.csv and any new '
+                             'report_type, incident_type or location rows')
+    parser.add_argument('--partition-by', choices=PARTITION_UNITS)
+    parser.add_argument('--force', action='store_true',
+                        help='ingest the batch even if it was ingested')
+    args = parser.parse_args()
+    stats = ingest_batch(user, host, dbname, args.dir,
+                         partition_by=args.partition_by, force=args.force)
+    if stats['skipped']:
+        print(f"{args.dir} was already ingested ({stats['checksum']})")
+        return
+    for table, counts in stats['tables'].items():
+        print(f"{table}: {counts['staged']} staged, "
+              f"{counts['inserted']} inserted, {counts['updated']} updated")
+    print(f"{stats['seconds']:.2f} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+import bisect
+import json
+import os
+import threading
+from collections import deque
+from datetime import datetime, timezone
+
+import psycopg
+
+from bench import summarize
+from pool import connection
+
+
+METRICS_SETTINGS = {'enabled': True,
+                    'window': 1000,
+                    'slow_ms': 500.0,
+                    'slow_log': 'slow_queries.log',
+                    'explain_slow': True}
+
+PHASES = ['connect_ms', 'execute_ms', 'fetch_ms', 'total_ms']
+# Upper bounds (ms) of the histogram buckets of every phase.
+BUCKETS_MS = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+_metrics = {}
+_lock = threading.Lock()
+_log_lock = threading.Lock()
+
+
+def configure_metrics(**settings):
+    """
+    Updates the metrics settings (enabled, window, the number of
+    recent calls kept per function for percentiles, slow_ms,
+    the threshold of the slow-query log, slow_log, its path,
+    and explain_slow, whether slow queries are logged with their
+    EXPLAIN plan) and clears the metrics.
+    """
+    unknown = set(settings) - set(METRICS_SETTINGS)
+    if unknown:
+        raise ValueError(f"Unknown metrics settings: {sorted(unknown)}")
+    METRICS_SETTINGS.update(settings)
+    clear_metrics()
+
+
+def _new_metric():
+    return {'calls': 0,
+            'rows': 0,
+            'bytes': 0,
+            'slow': 0,
+            'sum_ms': {phase: 0.0 for phase in PHASES},
+            'buckets': {phase: [0] * (len(BUCKETS_MS) + 1)
+                        for phase in PHASES},
+            'recent': {phase: deque(maxlen=METRICS_SETTINGS['window'])
+                       for phase in PHASES}}
+
+
+def record(name, connect_ms, execute_ms, fetch_ms, rows, result_bytes,
+           query=None, params=None, kargs=None):
+    """
+    Records a call of the query function name that waited connect_ms
+    for a connection, executed in execute_ms, fetched rows rows
+    (result_bytes bytes) in fetch_ms.
+    Calls slower than slow_ms are appended to the slow-query log
+    with query, params and, if kargs holds the user, host and dbname
+    to run EXPLAIN on, the plan of query.
+    """
+    if not METRICS_SETTINGS['enabled']:
+        return
+    times = {'connect_ms': connect_ms,
+             'execute_ms': execute_ms,
+             'fetch_ms': fetch_ms,
+             'total_ms': connect_ms + execute_ms + fetch_ms}
+    slow = times['total_ms'] > METRICS_SETTINGS['slow_ms']
+    with _lock:
+        metric = _metrics.setdefault(name, _new_metric())
+        metric['calls'] += 1
+        metric['rows'] += rows
+        metric['bytes'] += result_bytes
+        metric['slow'] += slow
+        for phase, ms in times.items():
+            metric['sum_ms'][phase] += ms
+            metric['buckets'][phase][bisect.bisect_left(BUCKETS_MS, ms)] += 1
+            metric['recent'][phase].append(ms)
+    if slow and query is not None:
+        log_slow_query(name, times, rows, query, params,
+                       kargs if METRICS_SETTINGS['explain_slow'] else None)
+
+
+def explain_plan(query, params, kargs):
+    """
+    Returns the JSON plan of query with params, without running it,
+    or the error raised by EXPLAIN.
+    """
+    try:
+        with connection(kargs['user'], kargs['host'],
+                        kargs['dbname']) as conn:
+            with conn.cursor() as curs:
+                curs.execute("EXPLAIN (FORMAT JSON) " + query, params)
+                return curs.fetchone()[0]
+    except psycopg.Error as error:
+        return str(error)
+
+
+def log_slow_query(name, times, rows, query, params, kargs=None):
+    """
+    Appends a slow call of the query function name to the slow-query
+    log as a line of JSON, with its plan explained on the database
+    of kargs if given.
+    """
+    entry = {'at': datetime.now(timezone.utc).isoformat(),
+             'function': name,
+             **times,
+             'rows': rows,
+             'query': ' '.join(query.split()),
+             'params': [str(param) for param in params or []]}
+    if kargs and not query.lstrip().upper().startswith('EXPLAIN'):
+        entry['plan'] = explain_plan(query, params, kargs)
+    with _log_lock:
+        with open(METRICS_SETTINGS['slow_log'], 'a') as file:
+            file.write(json.dumps(entry) + '\n')
+
+
+def query_metrics():
+    """
+    Returns the metrics of every query function: the number of calls,
+    rows, result bytes and slow calls, and the latency summary
+    (mean, median, p50, p95, p99...) of each phase over the last
+    window calls.
+    """
+    with _lock:
+        metrics = {name: {'calls': metric['calls'],
+                          'rows': metric['rows'],
+                          'bytes': metric['bytes'],
+                          'slow': metric['slow'],
+                          'recent': {phase: list(values) for phase, values
+                                     in metric['recent'].items()}}
+                   for name, metric in _metrics.items()}
+    for metric in metrics.values():
+        for phase, values in metric.pop('recent').items():
+            metric[phase] = summarize(values)
+    return metrics
+
+
+def prometheus_text():
+    """
+    Returns the metrics in the Prometheus text exposition format:
+    a histogram (in seconds) per phase and counters of calls, rows,
+    result bytes and slow calls, labelled by function.
+    """
+    with _lock:
+        metrics = {name: {'calls': metric['calls'],
+                          'rows': metric['rows'],
+                          'bytes': metric['bytes'],
+                          'slow': metric['slow'],
+                          'sum_ms': dict(metric['sum_ms']),
+                          'buckets': {phase: list(counts) for phase, counts
+                                      in metric['buckets'].items()}}
+                   for name, metric in sorted(_metrics.items())}
+    lines = []
+    for phase in PHASES:
+        family = f"db_query_{phase[:-3]}_seconds"
+        lines += [f"# HELP {family} Query {phase[:-3]} time in seconds.",
+                  f"# TYPE {family} histogram"]
+        for name, metric in metrics.items():
+            count = 0
+            for bound, bucket in zip(BUCKETS_MS + ['+Inf'],
+                                     metric['buckets'][phase]):
+                count += bucket
+                le = bound if bound == '+Inf' else bound / 1000
+                lines.append(f'{family}_bucket{{function="{name}",'
+                             f'le="{le}"}} {count}')
+            lines += [f'{family}_sum{{function="{name}"}} '
+                      f"{metric['sum_ms'][phase] / 1000}",
+                      f'{family}_count{{function="{name}"}} {count}']
+    for counter, key, description in [
+            ('calls', 'calls', 'Query calls.'),
+            ('rows', 'rows', 'Rows returned.'),
+            ('result_bytes', 'bytes', 'Estimated result size in bytes.'),
+            ('slow', 'slow', 'Calls slower than slow_ms.')]:
+        family = f"db_query_{counter}_total"
+        lines += [f"# HELP {family} {description}",
+                  f"# TYPE {family} counter"]
+        for name, metric in metrics.items():
+            lines.append(f'{family}{{function="{name}"}} {metric[key]}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(path):
+    """
+    Writes prometheus_text() to path, replacing it atomically,
+    for example for the textfile collector of node_exporter.
+    """
+    with open(path + '.tmp', 'w') as file:
+        file.write(prometheus_text())
+    os.replace(path + '.tmp', path)
+
+
+def clear_metrics():
+    """
+    Removes every recorded metric.
+    """
+    with _lock:
+        _metrics.clear()
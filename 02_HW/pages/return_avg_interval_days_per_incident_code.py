@@ -1,4 +1,3 @@
-import pandas as pd
 import streamlit as st
 
 from hw2 import *
@@ -11,22 +10,24 @@ n = st.text_input('Number of data to display:')
 
 if n:
     data = return_avg_interval_days_per_incident_code(
-        user=user, host=host, dbname=dbname, n=n)
+        user=user, host=host, dbname=dbname, n=n,
+        result_format='arrow')
 
-    df = pd.DataFrame(
-        data, columns=['Incident Code',
-                       'Description',
-                       'Average Interval (Days)'])
+    df = data.rename_columns(
+        ['Incident Code',
+         'Description',
+         'Average Interval (Days)']).to_pandas()
     st.bar_chart(df, x='Description', y='Average Interval (Days)')
     st.table(df)
 
 
 else:
     data = return_avg_interval_days_per_incident_code(
-        user=user, host=host, dbname=dbname)
-    df = pd.DataFrame(
-        data, columns=['Incident Category',
-                       'Description',
-                       'Average Interval (Days)'])
+        user=user, host=host, dbname=dbname,
+        result_format='arrow')
+    df = data.rename_columns(
+        ['Incident Category',
+         'Description',
+         'Average Interval (Days)']).to_pandas()
     st.bar_chart(df, x='Description', y='Average Interval (Days)')
     st.table(df)
@@ -1,4 +1,3 @@
-import pandas as pd
 import streamlit as st
 
 from hw2 import *
@@ -14,11 +13,13 @@ strings = input.strip().split(',')
 if input and len(strings) == 1:
     year = strings[0]
     data = return_count_by_location_report_type_incident_description(
-        user=user, host=host, dbname=dbname, year=year)
+        user=user, host=host, dbname=dbname, year=year,
+        result_format='arrow')
 
-    df = pd.DataFrame(data, columns=['Year', 'Month', 'Longitude', 'Latitude',
-                                     'Neighborhood', 'Report Type Description',
-                                     'Incident Description', 'Count'])
+    df = data.rename_columns(
+        ['Year', 'Month', 'Longitude', 'Latitude',
+         'Neighborhood', 'Report Type Description',
+         'Incident Description', 'Count']).to_pandas()
     st.map(df, latitude='Latitude', longitude='Longitude', size='Count')
     st.table(df)
 
@@ -26,10 +27,11 @@ if input and len(strings) == 1:
 elif input and len(strings) > 1:
     year, n = strings[0], strings[1]
     data = return_count_by_location_report_type_incident_description(
-        user=user, host=host, dbname=dbname, year=year, n=n)
-    df = pd.DataFrame(
-        data, columns=['Year', 'Month', 'Longitude', 'Latitude',
-                       'Neighborhood', 'Report Type Description',
-                       'Incident Description', 'Count'])
+        user=user, host=host, dbname=dbname, year=year, n=n,
+        result_format='arrow')
+    df = data.rename_columns(
+        ['Year', 'Month', 'Longitude', 'Latitude',
+         'Neighborhood', 'Report Type Description',
+         'Incident Description', 'Count']).to_pandas()
     st.map(df, latitude='Latitude', longitude='Longitude', size='Count')
     st.table(df)
@@ -1,4 +1,3 @@
-import pandas as pd
 import streamlit as st
 
 from hw2 import *
@@ -13,14 +12,18 @@ if n:
     data = return_incident_category_count(user=user,
                                           host=host,
                                           dbname=dbname,
-                                          n=n)
-    df = pd.DataFrame(data, columns=['Incident Category', 'Count'])
+                                          n=n,
+                                          result_format='arrow')
+    df = data.rename_columns(
+        ['Incident Category', 'Count']).to_pandas()
     st.bar_chart(df, x='Incident Category', y='Count')
     st.table(df)
 
 
 else:
-    data = return_incident_category_count(user=user, host=host, dbname=dbname)
-    df = pd.DataFrame(data, columns=['Incident Category', 'Count'])
+    data = return_incident_category_count(user=user, host=host, dbname=dbname,
+                                          result_format='arrow')
+    df = data.rename_columns(
+        ['Incident Category', 'Count']).to_pandas()
     st.bar_chart(df, x='Incident Category', y='Count')
     st.table(df)
@@ -1,4 +1,3 @@
-import pandas as pd
 import streamlit as st
 
 from hw2 import *
@@ -14,10 +13,11 @@ strings = input.strip().split(',')
 if input and len(strings) == 1:
     count_limit = strings[0]
     data = return_incident_count_by_category_subcategory(
-        user=user, host=host, dbname=dbname, count_limit=count_limit)
+        user=user, host=host, dbname=dbname, count_limit=count_limit,
+        result_format='arrow')
 
-    df = pd.DataFrame(
-        data, columns=['Incident Category', 'Incident Subcategory', 'Count'])
+    df = data.rename_columns(
+        ['Incident Category', 'Incident Subcategory', 'Count']).to_pandas()
     st.bar_chart(df, x='Incident Subcategory', y='Count')
     st.table(df)
 
@@ -25,8 +25,9 @@ if input and len(strings) == 1:
 elif input and len(strings) > 1:
     count_limit, n = strings[0], strings[1]
     data = return_incident_count_by_category_subcategory(
-        user=user, host=host, dbname=dbname, count_limit=count_limit, n=n)
-    df = pd.DataFrame(
-        data, columns=['Incident Category', 'Incident Subcategory', 'Count'])
+        user=user, host=host, dbname=dbname, count_limit=count_limit, n=n,
+        result_format='arrow')
+    df = data.rename_columns(
+        ['Incident Category', 'Incident Subcategory', 'Count']).to_pandas()
     st.bar_chart(df, x='Incident Subcategory', y='Count')
     st.table(df)
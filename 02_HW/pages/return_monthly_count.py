@@ -10,14 +10,16 @@ st.title('Year, Month and Count')
 n = st.text_input('Number of data to display:')
 
 if n:
-    data = return_monthly_count(user=user, host=host, dbname=dbname, n=n)
+    data = return_monthly_count(user=user, host=host, dbname=dbname, n=n,
+                                result_format='arrow')
 
 else:
-    data = return_monthly_count(user=user, host=host, dbname=dbname)
+    data = return_monthly_count(user=user, host=host, dbname=dbname,
+                                result_format='arrow')
 
-df = pd.DataFrame(
-    data, columns=['Year', 'Jan', 'Feb', 'Mar', 'Apr', 'May',
-                   'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'],
-    dtype=pd.Int64Dtype())
+df = data.rename_columns(
+    ['Year', 'Jan', 'Feb', 'Mar', 'Apr', 'May',
+     'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']).to_pandas().astype(
+    pd.Int64Dtype())
 st.bar_chart(df, x='Year')
 st.table(df)
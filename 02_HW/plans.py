@@ -0,0 +1,197 @@
+import json
+import os
+from collections import namedtuple
+
+from bench import EXPLAIN_OPTIONS
+from partition import PARTITION_PATTERN
+
+
+PLANS_DIR = 'plans'
+# Tables whose sequential scans are flagged (with their partitions,
+# named as PARTITION_PATTERN).
+SCAN_TABLES = ['incident']
+# Actual rows off the estimate by this factor or more are flagged.
+MISESTIMATE_RATIO = 10
+
+PlanNode = namedtuple('PlanNode', ['node_type', 'relation', 'index',
+                                   'plan_rows', 'actual_rows', 'loops',
+                                   'details', 'children'])
+
+
+def parse_plan(plan):
+    """
+    Returns the tree of PlanNode of a node of an EXPLAIN (FORMAT JSON)
+    plan ('Plan' of its output), keeping every field of the node
+    in details.
+    """
+    return PlanNode(node_type=plan['Node Type'],
+                    relation=plan.get('Relation Name'),
+                    index=plan.get('Index Name'),
+                    plan_rows=plan.get('Plan Rows'),
+                    actual_rows=plan.get('Actual Rows'),
+                    loops=plan.get('Actual Loops'),
+                    details={key: value for key, value in plan.items()
+                             if key != 'Plans'},
+                    children=[parse_plan(child)
+                              for child in plan.get('Plans', [])])
+
+
+def walk(node):
+    """
+    Yields node and every node under it, depth first.
+    """
+    yield node
+    for child in node.children:
+        yield from walk(child)
+
+
+def describe(node):
+    """
+    Returns a short description of node, such as
+    'Index Scan using incident_datetime_index on incident'.
+    """
+    text = node.node_type
+    if node.index:
+        text += f" using {node.index}"
+    if node.relation:
+        text += f" on {node.relation}"
+    return text
+
+
+def parent_table(relation):
+    """
+    Returns incident if relation is one of its partitions,
+    and relation otherwise.
+    """
+    if relation and PARTITION_PATTERN.match(relation):
+        return 'incident'
+    return relation
+
+
+def _captured(plan):
+    return {'plan': plan,
+            'root': parse_plan(plan['Plan']),
+            'planning_ms': plan['Planning Time'],
+            'execution_ms': plan['Execution Time']}
+
+
+def capture_plan(func, **kargs):
+    """
+    Runs the select_all query function func(**kargs) with
+    EXPLAIN_OPTIONS, without the result cache, and returns the plan
+    as explained ('plan'), its tree of PlanNode ('root'), and the
+    planning and execution time in milliseconds.
+    """
+    return _captured(
+        func(explain=EXPLAIN_OPTIONS, **dict(kargs, cache=False))[0][0][0])
+
+
+def plan_warnings(root, tables=SCAN_TABLES, ratio=MISESTIMATE_RATIO):
+    """
+    Returns the problems in the plan under root: sequential scans
+    of tables or their partitions, nodes whose actual rows per loop
+    are ratio times more or less than estimated, and sorts
+    and hashes that spilled to disk.
+    """
+    warnings = []
+    for node in walk(root):
+        if node.node_type == 'Seq Scan' and \
+                parent_table(node.relation) in tables:
+            warnings.append({'kind': 'seq scan',
+                             'node': describe(node)})
+        if node.actual_rows is not None and node.loops:
+            estimated = max(node.plan_rows, 1)
+            actual = max(node.actual_rows, 1)
+            if max(estimated, actual) / min(estimated, actual) >= ratio:
+                warnings.append({'kind': 'misestimate',
+                                 'node': describe(node),
+                                 'estimated_rows': node.plan_rows,
+                                 'actual_rows': node.actual_rows})
+        if node.details.get('Sort Space Type') == 'Disk':
+            warnings.append({'kind': 'disk sort',
+                             'node': describe(node),
+                             'kb': node.details['Sort Space Used']})
+        if node.details.get('Hash Batches', 1) > 1:
+            warnings.append({'kind': 'disk hash',
+                             'node': describe(node),
+                             'batches': node.details['Hash Batches']})
+    return warnings
+
+
+def diff_plans(before, after, path='0'):
+    """
+    Returns the structural differences between the plan trees
+    before and after: nodes replaced (different node type, relation
+    or index), added or removed, with their path from the root
+    (child positions joined by dots).
+    """
+    if describe(before) != describe(after):
+        return [{'path': path, 'change': 'replaced',
+                 'before': describe(before), 'after': describe(after)}]
+    changes = []
+    for i in range(0, max(len(before.children), len(after.children))):
+        child_path = f"{path}.{i}"
+        if i >= len(after.children):
+            changes.append({'path': child_path, 'change': 'removed',
+                            'before': describe(before.children[i])})
+        elif i >= len(before.children):
+            changes.append({'path': child_path, 'change': 'added',
+                            'after': describe(after.children[i])})
+        else:
+            changes += diff_plans(before.children[i], after.children[i],
+                                  child_path)
+    return changes
+
+
+def baseline_path(name, dir=PLANS_DIR):
+    """
+    Returns the path of the baseline plan of the query function name.
+    """
+    return os.path.join(dir, f"{name}.json")
+
+
+def save_baseline(name, captured, dir=PLANS_DIR):
+    """
+    Saves the plan captured by capture_plan() as the baseline
+    of the query function name in dir.
+    """
+    os.makedirs(dir, exist_ok=True)
+    with open(baseline_path(name, dir), 'w') as file:
+        json.dump(captured['plan'], file, indent=2)
+
+
+def load_baseline(name, dir=PLANS_DIR):
+    """
+    Returns the baseline plan of the query function name saved
+    in dir as capture_plan() returns it, or None if there is none.
+    """
+    path = baseline_path(name, dir)
+    if not os.path.exists(path):
+        return None
+    with open(path) as file:
+        return _captured(json.load(file))
+
+
+def check_plans(workload, dir=PLANS_DIR, update=False, **kargs):
+    """
+    Captures the plan of every (func, arguments) in workload and
+    returns, by function name, its warnings, its differences from
+    the baseline saved in dir and the execution time of both.
+    The plan becomes the baseline if there is none, or if update
+    is True.
+    """
+    results = {}
+    for func, args in workload:
+        name = func.__name__
+        captured = capture_plan(func, **kargs, **args)
+        baseline = load_baseline(name, dir)
+        results[name] = {
+            'warnings': plan_warnings(captured['root']),
+            'changes': diff_plans(baseline['root'], captured['root'])
+            if baseline else [],
+            'execution_ms': captured['execution_ms'],
+            'baseline_execution_ms':
+                baseline['execution_ms'] if baseline else None}
+        if baseline is None or update:
+            save_baseline(name, captured, dir)
+    return results
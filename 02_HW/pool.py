@@ -0,0 +1,109 @@
+import threading
+from contextlib import contextmanager
+
+import psycopg
+from psycopg_pool import ConnectionPool
+
+
+POOL_SETTINGS = {'enabled': True,
+                 'min_size': 1,
+                 'max_size': 10,
+                 'max_idle': 600.0,
+                 'timeout': 30.0,
+                 'check': True}
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def conninfo(user, host, dbname):
+    """
+    Returns the connection string used for user, host and dbname.
+    """
+    return f"user='{user}' host='{host}' dbname='{dbname}'"
+
+
+def configure_pool(**settings):
+    """
+    Updates the pool settings (enabled, min_size, max_size,
+    max_idle, timeout and check).
+    Pools that are already open are closed so that the next
+    connection request creates them with the new settings.
+    Setting enabled to False makes connection() open
+    a new connection for every call, as before pooling.
+    """
+    unknown = set(settings) - set(POOL_SETTINGS)
+    if unknown:
+        raise ValueError(f"Unknown pool settings: {sorted(unknown)}")
+    POOL_SETTINGS.update(settings)
+    close_pools()
+
+
+def _reset(conn):
+    # commit() changes the isolation level of the connection
+    # it borrows, so put it back before anyone else gets it.
+    conn.isolation_level = None
+
+
+def get_pool(user, host, dbname):
+    """
+    Returns the process-wide pool for (user, host, dbname),
+    creating it on first use.
+    """
+    key = (user, host, dbname)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            check = ConnectionPool.check_connection \
+                if POOL_SETTINGS['check'] else None
+            pool = ConnectionPool(conninfo(user, host, dbname),
+                                  min_size=POOL_SETTINGS['min_size'],
+                                  max_size=POOL_SETTINGS['max_size'],
+                                  max_idle=POOL_SETTINGS['max_idle'],
+                                  timeout=POOL_SETTINGS['timeout'],
+                                  check=check,
+                                  reset=_reset,
+                                  name=f"{user}@{host}/{dbname}",
+                                  open=True)
+            _pools[key] = pool
+    return pool
+
+
+@contextmanager
+def connection(user, host, dbname):
+    """
+    Yields a connection for user, host and dbname.
+    The transaction is committed when the block exits normally
+    and rolled back on error, like psycopg.connect() used
+    as a context manager, but the connection goes back to the pool
+    instead of being closed.
+    """
+    if not POOL_SETTINGS['enabled']:
+        with psycopg.connect(conninfo(user, host, dbname)) as conn:
+            yield conn
+        return
+    with get_pool(user, host, dbname).connection() as conn:
+        yield conn
+
+
+def pool_stats():
+    """
+    Returns the statistics of every open pool keyed by
+    (user, host, dbname), including the number of requests,
+    the requests that had to wait (requests_queued),
+    the total wait time (requests_wait_ms) and the connections
+    discarded by the health check (returns_bad, connections_lost).
+    """
+    with _pools_lock:
+        return {key: pool.get_stats() for key, pool in _pools.items()}
+
+
+def close_pools():
+    """
+    Closes every open pool.
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
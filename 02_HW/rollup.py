@@ -0,0 +1,309 @@
+import threading
+import time
+
+from cache import (CACHE_SETTINGS, invalidate, referenced_tables,
+                   table_versions)
+from pool import connection
+
+
+ROLLUP_TABLES = ['incident_daily_rollup', 'incident_monthly_rollup',
+                 'incident_code_rollup', 'incident_report_type_rollup']
+ROLLUP_STATE = 'incident_rollups'
+
+# derived_state records whether each object derived from the base
+# tables (rollups, materialized views) is fresh.
+STATE_TABLE =\
+    """
+    CREATE TABLE IF NOT EXISTS derived_state
+    (
+        name TEXT NOT NULL,
+        fresh BOOLEAN NOT NULL,
+        refreshed_at TIMESTAMPTZ NULL,
+        PRIMARY KEY (name)
+    )
+    """
+
+_freshness = {}
+_lock = threading.Lock()
+
+
+def mark_fresh(name):
+    """
+    Returns the statement that records name as fresh as of now.
+    """
+    return f"""
+        INSERT INTO derived_state VALUES ('{name}', TRUE, now())
+        ON CONFLICT (name) DO UPDATE
+        SET fresh = TRUE, refreshed_at = now()
+        """
+
+
+def mark_stale(name):
+    """
+    Returns the statement that records name as stale.
+    """
+    return f"""
+        UPDATE derived_state SET fresh = FALSE
+        WHERE name = '{name}'
+        """
+
+
+def stale_triggers(name, tables, events='INSERT OR UPDATE OR DELETE'):
+    """
+    Returns the statements that create the triggers marking name
+    stale after any of events or TRUNCATE on each of tables.
+    Once name is stale, writers no longer update (and lock)
+    its row of derived_state.
+    """
+    query = f"""
+        CREATE OR REPLACE FUNCTION {name}_stale()
+        RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            UPDATE derived_state SET fresh = FALSE
+            WHERE name = '{name}' AND fresh;
+            RETURN NULL;
+        END;
+        $$;
+        """
+    for table in tables:
+        query += f"""
+        DROP TRIGGER IF EXISTS {name}_stale ON {table};
+        CREATE TRIGGER {name}_stale
+        AFTER {events} OR TRUNCATE ON {table}
+        FOR EACH STATEMENT
+        EXECUTE FUNCTION {name}_stale();
+        """
+    return query
+
+
+def drop_stale_triggers(name, tables):
+    """
+    Returns the statements that drop the triggers of stale_triggers()
+    from each of tables, their function and the row of name
+    in derived_state.
+    """
+    query = ''
+    for table in tables:
+        query += f"""
+        DROP TRIGGER IF EXISTS {name}_stale ON {table};
+        """
+    return query + f"""
+        DROP FUNCTION IF EXISTS {name}_stale();
+        DO $$
+        BEGIN
+            IF to_regclass('derived_state') IS NOT NULL THEN
+                DELETE FROM derived_state WHERE name = '{name}';
+            END IF;
+        END;
+        $$;
+        """
+
+
+def is_fresh(user, host, dbname, name):
+    """
+    Returns whether the derived object name exists and is fresh.
+    """
+    with connection(user, host, dbname) as conn:
+        with conn.cursor() as curs:
+            curs.execute("SELECT to_regclass('derived_state') IS NOT NULL")
+            if not curs.fetchone()[0]:
+                return False
+            curs.execute("SELECT fresh FROM derived_state WHERE name = %s",
+                         [name])
+            row = curs.fetchone()
+    return row is not None and row[0]
+
+
+def cached_is_fresh(user, host, dbname, name, tables):
+    """
+    Returns is_fresh() of name, kept like a cached query result
+    for CACHE_SETTINGS['ttl'] seconds and until a write to tables
+    (or to the base tables behind them) is recorded
+    by cache.invalidate().
+    """
+    if not CACHE_SETTINGS['enabled']:
+        return is_fresh(user, host, dbname, name)
+    key = (user, host, dbname, name)
+    tables = referenced_tables(' '.join(tables))
+    with _lock:
+        versions = table_versions(key, tables)
+        entry = _freshness.get(key)
+        if entry is not None and entry[0] == versions and \
+                entry[1] > time.monotonic():
+            return entry[2]
+    fresh = is_fresh(user, host, dbname, name)
+    with _lock:
+        _freshness[key] = (versions, time.monotonic() + CACHE_SETTINGS['ttl'],
+                           fresh)
+    return fresh
+
+
+def create_rollups(user, host, dbname):
+    """
+    Creates the rollup tables of incident, fills them from incident
+    and installs the triggers that keep them up to date:
+    incident_daily_rollup - incidents per day
+    incident_monthly_rollup - incidents per year and month
+    incident_code_rollup - incidents and the sum of the days between
+                           incident and report per incident_code,
+                           from which the per-category counts of
+                           incident_type follow
+    incident_report_type_rollup - incidents per day and report_type_code
+    Rows inserted into incident (INSERT or COPY) are added to
+    the rollups by a statement-level trigger in the same transaction.
+    UPDATE of the datetimes or codes, DELETE or TRUNCATE mark
+    the rollups stale until refresh_rollups() rebuilds them;
+    renamed codes cascade from incident_type and report_type.
+    """
+    with connection(user, host, dbname) as conn:
+        with conn.cursor() as curs:
+            curs.execute(STATE_TABLE)
+            curs.execute(
+                """
+                CREATE TABLE IF NOT EXISTS incident_daily_rollup
+                (
+                    day DATE NOT NULL,
+                    incident_count BIGINT NOT NULL,
+                    PRIMARY KEY (day)
+                );
+
+                CREATE TABLE IF NOT EXISTS incident_monthly_rollup
+                (
+                    year INTEGER NOT NULL,
+                    month INTEGER NOT NULL,
+                    incident_count BIGINT NOT NULL,
+                    PRIMARY KEY (year, month)
+                );
+
+                CREATE TABLE IF NOT EXISTS incident_code_rollup
+                (
+                    incident_code INTEGER NOT NULL,
+                    incident_count BIGINT NOT NULL,
+                    interval_days_sum NUMERIC NOT NULL,
+                    PRIMARY KEY (incident_code),
+                    FOREIGN KEY (incident_code)
+                    REFERENCES  incident_type (incident_code)
+                    ON UPDATE CASCADE
+                );
+
+                CREATE TABLE IF NOT EXISTS incident_report_type_rollup
+                (
+                    day DATE NOT NULL,
+                    report_type_code VARCHAR(2) NOT NULL,
+                    incident_count BIGINT NOT NULL,
+                    PRIMARY KEY (day, report_type_code),
+                    FOREIGN KEY (report_type_code)
+                    REFERENCES  report_type (report_type_code)
+                    ON UPDATE CASCADE
+                );
+                """)
+            curs.execute(
+                """
+                CREATE OR REPLACE FUNCTION incident_rollup_insert()
+                RETURNS trigger LANGUAGE plpgsql AS $$
+                BEGIN
+                    INSERT INTO incident_daily_rollup AS r
+                    SELECT date(incident_datetime), COUNT(*)
+                    FROM new_rows
+                    GROUP BY 1 ORDER BY 1
+                    ON CONFLICT (day) DO UPDATE
+                    SET incident_count = r.incident_count
+                                         + EXCLUDED.incident_count;
+
+                    INSERT INTO incident_monthly_rollup AS r
+                    SELECT EXTRACT(year from incident_datetime),
+                           EXTRACT(month from incident_datetime),
+                           COUNT(*)
+                    FROM new_rows
+                    GROUP BY 1, 2 ORDER BY 1, 2
+                    ON CONFLICT (year, month) DO UPDATE
+                    SET incident_count = r.incident_count
+                                         + EXCLUDED.incident_count;
+
+                    INSERT INTO incident_code_rollup AS r
+                    SELECT incident_code, COUNT(*),
+                           SUM(EXTRACT(day from
+                               (report_datetime - incident_datetime)))
+                    FROM new_rows
+                    GROUP BY 1 ORDER BY 1
+                    ON CONFLICT (incident_code) DO UPDATE
+                    SET incident_count = r.incident_count
+                                         + EXCLUDED.incident_count,
+                        interval_days_sum = r.interval_days_sum
+                                            + EXCLUDED.interval_days_sum;
+
+                    INSERT INTO incident_report_type_rollup AS r
+                    SELECT date(incident_datetime), report_type_code,
+                           COUNT(*)
+                    FROM new_rows
+                    GROUP BY 1, 2 ORDER BY 1, 2
+                    ON CONFLICT (day, report_type_code) DO UPDATE
+                    SET incident_count = r.incident_count
+                                         + EXCLUDED.incident_count;
+                    RETURN NULL;
+                END;
+                $$;
+
+                DROP TRIGGER IF EXISTS incident_rollup_insert ON incident;
+                CREATE TRIGGER incident_rollup_insert
+                AFTER INSERT ON incident
+                REFERENCING NEW TABLE AS new_rows
+                FOR EACH STATEMENT
+                EXECUTE FUNCTION incident_rollup_insert();
+                """)
+            curs.execute(stale_triggers(
+                ROLLUP_STATE, ['incident'],
+                'UPDATE OF incident_datetime, report_datetime, '
+                'incident_code, report_type_code OR DELETE'))
+        conn.commit()
+    refresh_rollups(user, host, dbname)
+
+
+def refresh_rollups(user, host, dbname):
+    """
+    Rebuilds every rollup from incident and marks them fresh.
+    """
+    with connection(user, host, dbname) as conn:
+        with conn.cursor() as curs:
+            curs.execute(f"TRUNCATE {', '.join(ROLLUP_TABLES)}")
+            curs.execute(
+                """
+                INSERT INTO incident_daily_rollup
+                SELECT date(incident_datetime), COUNT(*)
+                FROM incident
+                GROUP BY 1;
+
+                INSERT INTO incident_monthly_rollup
+                SELECT EXTRACT(year from incident_datetime),
+                       EXTRACT(month from incident_datetime),
+                       COUNT(*)
+                FROM incident
+                GROUP BY 1, 2;
+
+                INSERT INTO incident_code_rollup
+                SELECT incident_code, COUNT(*),
+                       SUM(EXTRACT(day from
+                           (report_datetime - incident_datetime)))
+                FROM incident
+                GROUP BY 1;
+
+                INSERT INTO incident_report_type_rollup
+                SELECT date(incident_datetime), report_type_code, COUNT(*)
+                FROM incident
+                GROUP BY 1, 2;
+                """)
+            curs.execute(mark_fresh(ROLLUP_STATE))
+        conn.commit()
+    invalidate(user, host, dbname, ROLLUP_TABLES)
+
+
+def use_rollups(kargs):
+    """
+    Returns whether a query function called with kargs should read
+    the rollups: they have to be fresh, and the caller can turn them
+    off with rollups=False. Their freshness is cached with the query
+    results, so a cache hit does not cost a round trip.
+    """
+    return kargs.get('rollups', True) and \
+        cached_is_fresh(kargs['user'], kargs['host'], kargs['dbname'],
+                        ROLLUP_STATE, ROLLUP_TABLES)
@@ -3,4 +3,6 @@ host = 'localhost'
 dbname = 'msds691_HW'
 test_time = 10
 count_limit = 20
-year = 2018
\ No newline at end of file
+year = 2018
+data_dir = '../data'
+parallelism = 4
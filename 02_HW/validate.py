@@ -0,0 +1,379 @@
+import io
+import os
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy as np
+    import pyarrow
+    import pyarrow.compute as pc
+    import pyarrow.csv
+except ImportError:
+    pyarrow = None
+
+from loader import CHUNK_SIZE, find_input, open_input, throughput
+from pool import connection
+
+
+INCIDENT_COLUMNS = ['id', 'incident_datetime', 'report_datetime',
+                    'longitude', 'latitude', 'report_type_code',
+                    'incident_code']
+# The formats incident_datetime and report_datetime are accepted in;
+# the seconds may have a fraction (see parse_timestamps()).
+TIMESTAMP_FORMATS = ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S',
+                     '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M',
+                     '%Y/%m/%d %H:%M:%S', '%Y/%m/%d %I:%M:%S %p',
+                     '%Y/%m/%dT%H:%M:%S', '%Y/%m/%d %H:%M',
+                     '%Y/%m/%d %I:%M %p',
+                     '%m/%d/%Y %H:%M:%S', '%m/%d/%Y %I:%M:%S %p',
+                     '%m/%d/%Y %H:%M', '%m/%d/%Y %I:%M %p',
+                     '%Y-%m-%d', '%Y/%m/%d', '%m/%d/%Y']
+# Fractional seconds, up to microseconds.
+FRACTION_PATTERN = r':\d{2}\.(?P<fraction>\d{1,6})(?P<end>\D|$)'
+INTEGER_PATTERN = r'^\s*-?\d{1,10}\s*$'
+REAL_PATTERN = r'^\s*-?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*$'
+INTEGER_MAX = 2 ** 31 - 1
+VALIDATE_CHUNK_SIZE = 16 * CHUNK_SIZE
+REJECTS_FILE = 'incident_rejects.csv'
+
+# The dimension keys of the worker process, set by _init_worker().
+_dimensions = None
+
+
+def location_keys(longitudes, latitudes):
+    """
+    Returns one 64-bit key per (longitude, latitude) pair, made of
+    the bits of both rounded to REAL, so pairs are compared the way
+    PostgreSQL compares them in the foreign key to location.
+    """
+    longitudes = np.asarray(longitudes, dtype=np.float32)
+    latitudes = np.asarray(latitudes, dtype=np.float32)
+    return (longitudes.view(np.uint32).astype(np.uint64) << 32) | \
+        latitudes.view(np.uint32).astype(np.uint64)
+
+
+def load_dimension_keys(dir):
+    """
+    Returns the report_type codes, incident codes and location pairs
+    (see location_keys()) of report_type.csv, incident_type.csv and
+    location.csv in dir, for the membership tests of the incident
+    foreign keys.
+    """
+    def read(table, columns, types):
+        with open_input(find_input(dir, table)) as file:
+            return pyarrow.csv.read_csv(
+                file,
+                read_options=pyarrow.csv.ReadOptions(
+                    skip_rows=1, column_names=columns),
+                convert_options=pyarrow.csv.ConvertOptions(
+                    include_columns=list(types), column_types=types))
+
+    report_types = read('report_type',
+                        ['report_type_code', 'report_type_description'],
+                        {'report_type_code': pyarrow.string()})
+    codes = read('incident_type',
+                 ['incident_code', 'incident_category',
+                  'incident_subcategory', 'incident_description'],
+                 {'incident_code': pyarrow.int64()})
+    locations = read('location',
+                     ['longitude', 'latitude', 'supervisor_district',
+                      'police_district', 'neighborhood'],
+                     {'longitude': pyarrow.float64(),
+                      'latitude': pyarrow.float64()})
+    return {'report_types': report_types.column(0).combine_chunks(),
+            'incident_codes': np.unique(codes.column(0).to_numpy()),
+            'locations': np.unique(location_keys(
+                locations.column(0).to_numpy(),
+                locations.column(1).to_numpy()))}
+
+
+def _init_worker(dimensions):
+    global _dimensions
+    _dimensions = dimensions
+
+
+def is_member(values, keys):
+    """
+    Returns whether each of values is in the sorted array keys.
+    """
+    if len(keys) == 0:
+        return np.zeros(len(values), dtype=bool)
+    positions = np.searchsorted(keys, values)
+    return keys[np.minimum(positions, len(keys) - 1)] == values
+
+
+def parse_timestamps(column):
+    """
+    Returns column parsed, in microseconds, with the first of
+    TIMESTAMP_FORMATS that matches each value, and null where none
+    does. The seconds may have a fraction of up to six digits,
+    as in '2018-01-01 12:00:00.25'. Values with a time zone or UTC
+    offset, a longer fraction, a two-digit year or the day before
+    the month are rejected.
+    """
+    fraction = pc.struct_field(
+        pc.extract_regex(column, FRACTION_PATTERN), [0])
+    column = pc.replace_substring_regex(
+        column, r'(:\d{2})\.\d{1,6}(\D|$)', r'\1\2')
+    parsed = pc.strptime(column, format=TIMESTAMP_FORMATS[0], unit='us',
+                         error_is_null=True)
+    for format in TIMESTAMP_FORMATS[1:]:
+        parsed = pc.coalesce(parsed, pc.strptime(
+            column, format=format, unit='us', error_is_null=True))
+    micros = pc.fill_null(pc.cast(
+        pc.utf8_rpad(fraction, width=6, padding='0'), pyarrow.int64()), 0)
+    return pc.add(parsed, pc.cast(micros, pyarrow.duration('us')))
+
+
+def parse_numbers(column, pattern, type):
+    """
+    Returns whether each value of column matches pattern, and column
+    cast to type with null where it does not.
+    """
+    valid = pc.fill_null(pc.match_substring_regex(column, pattern), False)
+    values = pc.cast(pc.utf8_trim_whitespace(
+        pc.if_else(valid, column, '0')), type)
+    return valid.to_numpy(zero_copy_only=False), \
+        pc.if_else(valid, values, None)
+
+
+def chunk_lines(data):
+    """
+    Returns the non-empty lines of the CSV data, the rows the CSV
+    reader sees, as an array of bytes.
+    """
+    lines = np.array(data.splitlines(), dtype=object)
+    return lines[lines != b'']
+
+
+def validate_chunk(data):
+    """
+    Validates the incident CSV lines in data, without a header,
+    against the dimension keys of the worker, and returns the clean
+    rows as normalized CSV (ISO timestamps, plain numbers), their ids,
+    their positions in chunk_lines(data), and the rejected rows as
+    (reason, line) pairs with the line as it was in data.
+    A row is rejected for the first of: a wrong number of columns,
+    an id or incident_code that is not an INTEGER, a timestamp in
+    none of TIMESTAMP_FORMATS, a coordinate that is not a number,
+    a report_type_code, incident_code or (longitude, latitude) with
+    no dimension row.
+    """
+    lines = chunk_lines(data)
+    invalid_rows = set()
+
+    def invalid_row(row):
+        invalid_rows.add(row.text.encode().rstrip(b'\r\n'))
+        return 'skip'
+
+    table = pyarrow.csv.read_csv(
+        io.BytesIO(data),
+        read_options=pyarrow.csv.ReadOptions(column_names=INCIDENT_COLUMNS),
+        parse_options=pyarrow.csv.ParseOptions(
+            invalid_row_handler=invalid_row),
+        convert_options=pyarrow.csv.ConvertOptions(
+            column_types={column: pyarrow.string()
+                          for column in INCIDENT_COLUMNS}))
+    columns = {name: table.column(name).combine_chunks()
+               for name in INCIDENT_COLUMNS}
+    # Rows with the same text parse the same, so the skipped rows
+    # are the lines with the text of one of them.
+    parsed = np.ones(len(lines), dtype=bool)
+    if invalid_rows:
+        parsed = np.array([line not in invalid_rows for line in lines],
+                          dtype=bool)
+    positions = np.flatnonzero(parsed)
+    if len(positions) != len(table):
+        raise ValueError("The rows read do not match the lines of the "
+                         "chunk; fields must not contain line breaks")
+    rejects = [('columns', line.decode()) for line in lines[~parsed]]
+
+    id_valid, ids = parse_numbers(columns['id'], INTEGER_PATTERN,
+                                  pyarrow.int64())
+    id_values = np.nan_to_num(ids.to_numpy(zero_copy_only=False), nan=-1)
+    id_valid &= (id_values >= 0) & (id_values <= INTEGER_MAX)
+    incident_datetime = parse_timestamps(columns['incident_datetime'])
+    report_datetime = parse_timestamps(columns['report_datetime'])
+    code_valid, codes = parse_numbers(columns['incident_code'],
+                                      INTEGER_PATTERN, pyarrow.int64())
+    coordinates = {}
+    coordinate_valid = np.ones(len(table), dtype=bool)
+    present = np.ones(len(table), dtype=bool)
+    for name in ['longitude', 'latitude']:
+        empty = pc.equal(pc.utf8_trim_whitespace(columns[name]), '')
+        empty = empty.to_numpy(zero_copy_only=False)
+        valid, coordinates[name] = parse_numbers(
+            columns[name], REAL_PATTERN, pyarrow.float64())
+        coordinate_valid &= valid | empty
+        present &= ~empty
+    located = present & coordinate_valid
+    location_valid = np.ones(len(table), dtype=bool)
+    location_valid[located] = is_member(
+        location_keys(coordinates['longitude'].to_numpy(
+                          zero_copy_only=False)[located],
+                      coordinates['latitude'].to_numpy(
+                          zero_copy_only=False)[located]),
+        _dimensions['locations'])
+    code_member = np.zeros(len(table), dtype=bool)
+    code_member[code_valid] = is_member(
+        codes.to_numpy(zero_copy_only=False)[code_valid].astype(np.int64),
+        _dimensions['incident_codes'])
+
+    checks = [('id', id_valid),
+              ('incident_datetime',
+               incident_datetime.is_valid().to_numpy(zero_copy_only=False)),
+              ('report_datetime',
+               report_datetime.is_valid().to_numpy(zero_copy_only=False)),
+              ('coordinates', coordinate_valid),
+              ('incident_code', code_valid),
+              ('report_type_code',
+               pc.is_in(columns['report_type_code'],
+                        value_set=_dimensions['report_types'])
+               .to_numpy(zero_copy_only=False)),
+              ('incident_type', code_member),
+              ('location', location_valid)]
+    reasons = np.full(len(table), '', dtype=object)
+    for reason, valid in reversed(checks):
+        reasons[~valid] = reason
+    clean = reasons == ''
+
+    rejects += [(reason, line.decode()) for reason, line
+                in zip(reasons[~clean], lines[positions[~clean]])]
+    mask = pyarrow.array(clean)
+    normalized = pyarrow.table({
+        'id': pc.filter(ids, mask),
+        'incident_datetime': pc.filter(pc.strftime(
+            incident_datetime, format='%Y-%m-%dT%H:%M:%S'), mask),
+        'report_datetime': pc.filter(pc.strftime(
+            report_datetime, format='%Y-%m-%dT%H:%M:%S'), mask),
+        'longitude': pc.filter(coordinates['longitude'], mask),
+        'latitude': pc.filter(coordinates['latitude'], mask),
+        'report_type_code': pc.filter(columns['report_type_code'], mask),
+        'incident_code': pc.filter(codes, mask)})
+    buffer = io.BytesIO()
+    pyarrow.csv.write_csv(normalized, buffer,
+                          pyarrow.csv.WriteOptions(include_header=False))
+    return buffer.getvalue(), \
+        normalized.column('id').to_numpy().astype(np.int64), \
+        positions[clean], rejects
+
+
+def mark_duplicates(seen, ids):
+    """
+    Returns whether each of ids is a duplicate, of an earlier id
+    in ids or of an id set in the bitmap seen, and seen with ids set,
+    grown as needed.
+    """
+    if len(ids) == 0:
+        return np.zeros(0, dtype=bool), seen
+    size = int(ids.max()) // 8 + 1
+    if size > len(seen):
+        seen = np.concatenate([seen, np.zeros(max(size - len(seen),
+                                                  len(seen)),
+                                              dtype=np.uint8)])
+    byte = ids >> 3
+    bit = np.left_shift(1, ids & 7).astype(np.uint8)
+    duplicate = (seen[byte] & bit) != 0
+    first = np.unique(ids, return_index=True)[1]
+    repeated = np.ones(len(ids), dtype=bool)
+    repeated[first] = False
+    np.bitwise_or.at(seen, byte, bit)
+    return duplicate | repeated, seen
+
+
+def read_chunks(path, chunk_size=VALIDATE_CHUNK_SIZE):
+    """
+    Yields the lines of the CSV file at path after its header,
+    chunk_size bytes at a time cut at line boundaries.
+    Fields must not contain quoted line breaks.
+    """
+    with open_input(path) as file:
+        file.readline()
+        rest = b''
+        while chunk := file.read(chunk_size):
+            lines, _, rest = (rest + chunk).rpartition(b'\n')
+            if lines:
+                yield lines + b'\n'
+        if rest.strip():
+            yield rest + b'\n'
+
+
+def validated_chunks(dir, path, rejects_path=REJECTS_FILE, workers=None,
+                     chunk_size=VALIDATE_CHUNK_SIZE, stats=None):
+    """
+    Yields the clean rows of the incident CSV file at path
+    as normalized CSV, chunk by chunk in file order, validating the
+    chunks with validate_chunk() against the dimension CSV files
+    in dir in workers processes (every core by default).
+    Rows whose id already appeared are rejected as duplicates.
+    Rejected rows are written to rejects_path as the reason
+    followed by the row as it is in the file, and the rows
+    and reasons counted in stats.
+    At most two chunks per worker are in flight, so memory depends on
+    chunk_size and workers, not on the size of the file, apart from
+    the bitmap of the ids seen (one bit per id up to the largest).
+    """
+    if pyarrow is None:
+        raise ImportError("pyarrow is required to validate incident.csv")
+    workers = workers or os.cpu_count()
+    stats = stats if stats is not None else {}
+    stats.update(rows=0, rejected=0, reasons=Counter())
+    seen = np.zeros(0, dtype=np.uint8)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(load_dimension_keys(dir),)) \
+            as executor, open(rejects_path, 'w') as rejects_file:
+        rejects_file.write('reason,' + ','.join(INCIDENT_COLUMNS) + '\n')
+        pending = deque()
+        chunks = read_chunks(path, chunk_size)
+        while True:
+            for data in chunks:
+                pending.append((data,
+                                executor.submit(validate_chunk, data)))
+                if len(pending) >= 2 * workers:
+                    break
+            if not pending:
+                break
+            data, future = pending.popleft()
+            clean, ids, positions, rejects = future.result()
+            duplicate, seen = mark_duplicates(seen, ids)
+            if duplicate.any():
+                rejects += [('duplicate id', line.decode()) for line
+                            in chunk_lines(data)[positions[duplicate]]]
+                lines = np.array(clean.split(b'\n')[:-1], dtype=object)
+                clean = b''.join(line + b'\n' for line in lines[~duplicate])
+            for reason, line in rejects:
+                rejects_file.write(f"{reason},{line}\n")
+                stats['reasons'][reason] += 1
+            stats['rows'] += len(ids) - int(duplicate.sum())
+            stats['rejected'] += len(rejects)
+            yield clean
+
+
+def copy_validated(user, host, dbname, dir, path,
+                   rejects_path=REJECTS_FILE, workers=None,
+                   chunk_size=VALIDATE_CHUNK_SIZE):
+    """
+    Streams the clean rows of the incident CSV file at path
+    (see validated_chunks()) into incident with COPY FROM STDIN,
+    so one bad row no longer aborts the whole load.
+    Returns the load statistics of incident with the number
+    of rejected rows and of each reason.
+    """
+    start = time.perf_counter()
+    stats = {}
+    size = 0
+    with connection(user, host, dbname) as conn:
+        with conn.cursor() as curs:
+            with curs.copy(f"COPY incident ({', '.join(INCIDENT_COLUMNS)}) "
+                           "FROM STDIN (FORMAT CSV)") as copy:
+                for data in validated_chunks(dir, path, rejects_path,
+                                             workers, chunk_size, stats):
+                    copy.write(data)
+                    size += len(data)
+    result = throughput('incident', stats['rows'], size,
+                        time.perf_counter() - start)
+    result.update(rejected=stats['rejected'],
+                  reasons=dict(stats['reasons']),
+                  rejects_path=rejects_path)
+    return result
@@ -0,0 +1,134 @@
+import os
+
+import psycopg
+
+from bench import *
+from hw1 import *
+from hw3 import *
+from partition import period_bounds
+from plans import check_plans
+
+from user_definition import *
+
+
+RESULTS_PATH = 'benchmark_results.json'
+
+# Each filter is a WHERE clause and its parameters.
+DASHBOARD_FILTERS = {
+    'year': ("incident_datetime >= %s AND incident_datetime < %s",
+             list(period_bounds(year))),
+    'neighborhood': ("neighborhood = %s", ['Mission']),
+    'category': ("incident_category = %s", ['Larceny Theft']),
+    'report type': ("report_type_description = %s", ['Initial']),
+    'id': ("id = %s", [1])}
+
+
+@select_all
+def read_incident_with_details(**kargs):
+    """
+    Returns the rows of incident_with_details matching where,
+    with its parameters in where_params.
+    """
+    query = f"""
+        SELECT * FROM incident_with_details
+        WHERE {kargs['where']}
+        """
+    return check_query_args(query=query, params=kargs['where_params'],
+                            **kargs)
+
+
+def benchmark_view(**kargs):
+    """
+    Creates incident_with_details as a view and then as a
+    materialized view, and returns the latency summary of reading it
+    with each of DASHBOARD_FILTERS, test_time times, for both.
+    """
+    results = {}
+    for materialized in [False, True]:
+        drop_view_incident_with_details(**kargs)
+        create_view_incident_with_details(materialized=materialized,
+                                          **kargs)
+        mode = 'materialized view' if materialized else 'view'
+        for name, (where, params) in DASHBOARD_FILTERS.items():
+            latencies = time_calls(read_incident_with_details, test_time,
+                                   where=where, where_params=params,
+                                   cache=False, **kargs)
+            results.setdefault(name, {})[mode] = summarize(latencies)
+    return results
+
+
+def hw3_workload():
+    """
+    Returns the hw3 query functions with the arguments
+    they are benchmarked with.
+    """
+    return [(daily_average_incident_increase, {}),
+            (three_day_daily_report_type_ct, {'year': year, 'month': 1})]
+
+
+def query_workload():
+    """
+    Returns the hw1 and hw3 query functions with the arguments
+    they are benchmarked with.
+    """
+    return [(return_distinct_neighborhood_police_district, {}),
+            (return_distinct_time_taken, {}),
+            (return_incident_with_incident_substring, {'substr': 'theft'}),
+            (return_incident_desc_for_report_type_desc, {'desc': 'initial'}),
+            (search_incident_type, {'text': 'theft'})] + hw3_workload()
+
+
+def benchmark_suite(**kargs):
+    """
+    Runs query_workload() with run_suite() (warm cache, and cold
+    where the server can evict buffers, test_time measured calls
+    each), saves the results to path (RESULTS_PATH by default) and
+    returns them with the regressions against the results previously
+    saved there. Only the hw3 functions have an EXPLAIN breakdown;
+    the hw1 ones are timed end to end.
+    """
+    path = kargs.pop('path', RESULTS_PATH)
+    results = run_suite(query_workload(), test_time, **kargs)
+    regressions = compare_results(load_results(path), results) \
+        if os.path.exists(path) else []
+    save_results(results, path)
+    return results, regressions
+
+
+def main():
+    results = benchmark_view(
+        user=user, host=host, dbname=dbname,
+        isolation_level=psycopg.IsolationLevel.READ_COMMITTED)
+    for name, modes in results.items():
+        print(name)
+        for mode, summary in modes.items():
+            print(f"    {mode:>17}: mean {summary['mean']:.2f} ms, "
+                  f"median {summary['median']:.2f} ms")
+
+    results, regressions = benchmark_suite(user=user, host=host,
+                                           dbname=dbname)
+    for name, modes in results['queries'].items():
+        print(name)
+        for mode, measurements in modes.items():
+            latency = measurements['latency_ms']
+            print(f"    {mode:>4}: p50 {latency['p50']:.2f} ms, "
+                  f"p95 {latency['p95']:.2f} ms, "
+                  f"p99 {latency['p99']:.2f} ms, "
+                  f"stdev {latency['stdev']:.2f} ms")
+    for regression in regressions:
+        print(f"Regression: {regression['query']} "
+              f"({regression['cache_mode']}) {regression['measurement']} "
+              f"x{regression['ratio']:.2f}")
+    for name, result in check_plans(hw3_workload(), user=user, host=host,
+                                    dbname=dbname).items():
+        for change in result['changes']:
+            print(f"Plan change: {name} {change['change']} at "
+                  f"{change['path']}: {change.get('before', '')} -> "
+                  f"{change.get('after', '')}")
+        for warning in result['warnings']:
+            print(f"Plan warning: {name} {warning['kind']} in "
+                  f"{warning['node']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,39 @@
+import functools
+import time
+
 import psycopg
 
+from cache import invalidate, referenced_tables
+from metrics import record
+from partition import period_bounds
+from pool import connection
+from query import fetch_all, inline
+from rollup import (STATE_TABLE, drop_stale_triggers, mark_fresh, mark_stale,
+                    stale_triggers, use_rollups)
+
+
+VIEW_TABLES = ['incident', 'incident_type', 'report_type', 'location']
+
 
 # pylint: disable=E1129
 def select_all(func):
+    @functools.wraps(func)
     def execute(**kargs):
-        user = kargs["user"]
-        host = kargs["host"]
-        dbname = kargs["dbname"]
-        with psycopg.connect(f"user='{user}' \
-                            host='{host}' \
-                            dbname='{dbname}'") as conn:
-            with conn.cursor() as curs:
-                curs.execute(func(**kargs))
-                return curs.fetchall()
+        return fetch_all(func.__name__, kargs, *func(**kargs))
     return execute
 
 
 def check_query_args(**kargs):
     query = kargs['query']
+    params = list(kargs.get('params', []))
     if 'explain' in kargs and kargs['explain'] is True:
         query = 'EXPLAIN ANALYZE VERBOSE ' + query
+    elif kargs.get('explain', False):
+        query = f"EXPLAIN {kargs['explain']} " + query
     if 'n' in kargs:
-        query = query + f" LIMIT {kargs['n']}"
-    return query
+        query = query + " LIMIT %s"
+        params.append(int(kargs['n']))
+    return query, params
 
 
 def commit(func):
@@ -35,7 +46,13 @@ def commit(func):
        and `dbname`, and set the isolation level.
     c. Execute a SQL query string returned from a function.
     d. Commit the changes.
+    The function returns either SQL, which may hold several statements,
+    or a statement and its parameters from check_query_args(),
+    which are inlined since DDL cannot take parameters.
+    Its connect and execute time and the rows it changed are recorded
+    in the query metrics; slow statements are logged without a plan.
     """
+    @functools.wraps(func)
     def execute(**kargs):
         user = kargs["user"]
         host = kargs["host"]
@@ -45,14 +62,22 @@ def commit(func):
                                psycopg.IsolationLevel.READ_COMMITTED: 2,
                                psycopg.IsolationLevel.REPEATABLE_READ: 3,
                                psycopg.IsolationLevel.SERIALIZABLE: 4}
-        with psycopg.connect(f"user='{user}' \
-                            host='{host}' \
-                            dbname='{dbname}'") as conn:
+        start = time.perf_counter()
+        with connection(user, host, dbname) as conn:
+            connected = time.perf_counter()
             conn._set_isolation_level(isolation_level_dic[isolation_level])
             with conn.cursor() as curs:
-                curs.execute(func(**kargs))
+                query = func(**kargs)
+                if isinstance(query, tuple):
+                    query = inline(conn, *query)
+                curs.execute(query)
                 conn.commit()
-                return None
+                rows = max(curs.rowcount, 0)
+        committed = time.perf_counter()
+        record(func.__name__, (connected - start) * 1000,
+               (committed - connected) * 1000, 0.0, rows, 0, query)
+        invalidate(user, host, dbname, referenced_tables(query))
+        return None
     return execute
 
 
@@ -65,9 +90,19 @@ def create_view_incident_with_details(**kargs):
     latitude, report_datetime, report_type_code, report_type_description,
     supervisor_district, police_district and neighborhood
     for all the rows in incident table.
+    If materialized is True, it is created as a materialized view
+    with a unique index on id, so that
+    refresh_view_incident_with_details() can refresh it concurrently,
+    and triggers on the underlying tables record in derived_state
+    when it goes stale (see incident_with_details_staleness()).
+    With location_id=True, location is joined on the integer
+    location_id of create_tables(location_id=True).
     """
-    query = '''
-        CREATE VIEW incident_with_details AS
+    if kargs.get('location_id', False):
+        location_join = 'l.location_id = i.location_id'
+    else:
+        location_join = 'l.latitude = i.latitude and l.longitude = i.longitude'
+    select = f'''
         SELECT id, incident_datetime, i.incident_code, incident_category,
         incident_subcategory, incident_description, i.longitude, i.latitude,
         report_datetime, i.report_type_code, report_type_description,
@@ -78,11 +113,120 @@ def create_view_incident_with_details(**kargs):
         LEFT JOIN report_type as r
         ON i.report_type_code = r.report_type_code
         LEFT JOIN location as l
-        ON l.latitude = i.latitude and l.longitude = i.longitude
+        ON {location_join}
+        '''
+    if kargs.get('materialized', False):
+        return f'''
+        CREATE MATERIALIZED VIEW incident_with_details AS {select};
+        CREATE UNIQUE INDEX incident_with_details_id
+        ON incident_with_details (id);
+        {STATE_TABLE};
+        {mark_fresh('incident_with_details')};
+        {stale_triggers('incident_with_details', VIEW_TABLES)}
+        '''
+    query = 'CREATE VIEW incident_with_details AS' + select
+    return check_query_args(query=query, **kargs)
+
+
+@commit
+def drop_view_incident_with_details(**kargs):
+    """
+    Drops incident_with_details, whether it is a view
+    or a materialized view, with the triggers that record
+    when the materialized view goes stale.
+    """
+    return f'''
+        DO $$
+        BEGIN
+            DROP VIEW IF EXISTS incident_with_details;
+        EXCEPTION WHEN wrong_object_type THEN
+            DROP MATERIALIZED VIEW incident_with_details;
+        END;
+        $$;
+        {drop_stale_triggers('incident_with_details', VIEW_TABLES)}
+        '''
+
+
+@commit
+def mark_incident_with_details_fresh(**kargs):
+    """
+    Records the materialized incident_with_details as fresh as of now.
+    """
+    return mark_fresh('incident_with_details')
+
+
+@commit
+def mark_incident_with_details_stale(**kargs):
+    """
+    Records the materialized incident_with_details as stale.
+    """
+    return mark_stale('incident_with_details')
+
+
+@commit
+def refresh_materialized_incident_with_details(**kargs):
+    """
+    Refreshes the materialized incident_with_details,
+    concurrently (without blocking readers) unless
+    concurrently is False.
+    """
+    concurrently = 'CONCURRENTLY' \
+        if kargs.get('concurrently', True) else ''
+    return f'''
+        REFRESH MATERIALIZED VIEW {concurrently} incident_with_details;
+        '''
+
+
+def refresh_view_incident_with_details(**kargs):
+    """
+    Refreshes the materialized incident_with_details,
+    concurrently unless concurrently is False, and records it
+    as fresh as of the time before the refresh. The mark is
+    committed on its own first, so a write committed while the
+    refresh runs marks it stale again (the triggers leave a stale
+    view alone, so a mark after the refresh would miss it),
+    and writers do not wait on its row of derived_state until
+    the refresh ends. If the refresh fails, the view is marked
+    stale again and the error raised.
+    """
+    mark_incident_with_details_fresh(**kargs)
+    try:
+        refresh_materialized_incident_with_details(**kargs)
+    except Exception:
+        mark_incident_with_details_stale(**kargs)
+        raise
+
+
+@select_all
+def read_incident_with_details_state(**kargs):
+    """
+    Returns the row of incident_with_details in derived_state,
+    as [(stale, refreshed_at)].
+    """
+    query = '''
+        SELECT NOT fresh, refreshed_at
+        FROM derived_state
+        WHERE name = 'incident_with_details'
         '''
     return check_query_args(query=query, **kargs)
 
 
+def incident_with_details_staleness(**kargs):
+    """
+    Returns whether the materialized incident_with_details is stale
+    and when it was last refreshed, as [(stale, refreshed_at)],
+    or [(None, None)] if it is unknown because no materialized view
+    has created derived_state yet.
+    """
+    with connection(kargs['user'], kargs['host'], kargs['dbname']) as conn:
+        with conn.cursor() as curs:
+            curs.execute("SELECT to_regclass('derived_state') IS NOT NULL")
+            known = curs.fetchone()[0]
+    if not known:
+        return [(None, None)]
+    return read_incident_with_details_state(**kargs)
+
+
 @select_all
 def daily_average_incident_increase(**kargs):
     """
@@ -99,7 +243,21 @@ def daily_average_incident_increase(**kargs):
     The value is rounded to 2 decimal points (as float) and
     the records are ordered by date.
     If the parameter n is not provided, the function returns all rows.
+    The daily counts are read from incident_daily_rollup when it is fresh.
     """
+    if use_rollups(kargs):
+        query = '''
+        SELECT date, round(avg_prev - avg_next, 2)::float as diff
+        FROM(
+        SELECT day as date, incident_count as count,
+        AVG(incident_count) OVER (ORDER BY day
+        RANGE BETWEEN CURRENT ROW AND INTERVAL '6 days' FOLLOWING) as avg_next,
+        AVG(incident_count) OVER (ORDER BY day
+        RANGE BETWEEN INTERVAL '6 days' PRECEDING AND CURRENT ROW) as avg_prev
+        FROM incident_daily_rollup
+        ) as avgs
+        '''
+        return check_query_args(query=query, **kargs)
     query = '''
         SELECT date, round(avg_prev - avg_next, 2)::float as diff
         FROM(
@@ -131,23 +289,45 @@ def three_day_daily_report_type_ct(**kargs):
     and the number of incidents with the corresponding
     report_type_description one day after.
     If the parameter n is not provided, the function returns all rows.
+    The month is filtered as a range of incident_datetime
+    so that only its rows (or partitions) are read,
+    from incident_report_type_rollup when it is fresh.
     """
-    year_month = f"{kargs['year']}-{kargs['month']:02d}"
-    query = f'''
+    start, end = period_bounds(kargs['year'], kargs['month'])
+    if use_rollups(kargs):
+        query = '''
+        SELECT rtype.report_type_description, date,
+            lag(numb_inc, 1) OVER (ORDER BY date) as nextday,
+            numb_inc,
+            lag(numb_inc, -1) OVER (ORDER BY date) as prevday
+        FROM(
+        SELECT day as date, report_type_description,
+            SUM(incident_count)::BIGINT as numb_inc
+        FROM incident_report_type_rollup as i
+        JOIN report_type as r
+        ON i.report_type_code = r.report_type_code
+        WHERE day >= %s AND day < %s
+        GROUP BY day, r.report_type_description
+        HAVING report_type_description = 'Initial'
+        ORDER BY date) as rtype
+        '''
+        return check_query_args(query=query,
+                                params=[start.date(), end.date()], **kargs)
+    query = '''
         SELECT rtype.report_type_description, date,
             lag(numb_inc, 1) OVER (ORDER BY date) as nextday,
             numb_inc,
             lag(numb_inc, -1) OVER (ORDER BY date) as prevday
         FROM(
-        SELECT TO_CHAR(date(i.incident_datetime), 'YYYY-MM') AS year_month,
-            date(i.incident_datetime), report_type_description,
+        SELECT date(i.incident_datetime), report_type_description,
             COUNT(*) as numb_inc
         FROM incident as i
         JOIN report_type as r
         ON i.report_type_code = r.report_type_code
+        WHERE i.incident_datetime >= %s
+            AND i.incident_datetime < %s
         GROUP BY date(i.incident_datetime), r.report_type_description
         HAVING report_type_description = 'Initial'
         ORDER BY date) as rtype
-        WHERE year_month = '{year_month}'
         '''
-    return check_query_args(query=query, **kargs)
+    return check_query_args(query=query, params=[start, end], **kargs)
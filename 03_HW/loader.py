@@ -0,0 +1,326 @@
+import csv
+import gzip
+import hashlib
+import io
+import os
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from pool import POOL_SETTINGS, connection
+
+
+CHUNK_SIZE = 1 << 20
+DIMENSION_TABLES = ['report_type', 'incident_type', 'location']
+EXTENSIONS = ['.csv', '.csv.gz', '.csv.zst']
+REAL_PAIR = struct.Struct('ff')
+
+
+def find_input(dir, table):
+    """
+    Returns the path of table.csv in dir, or of its gzip (.csv.gz)
+    or zstd (.csv.zst) compressed version.
+    """
+    for extension in EXTENSIONS:
+        path = os.path.join(dir, table + extension)
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(f"No {table}.csv(.gz|.zst) in {dir}")
+
+
+def open_input(path):
+    """
+    Opens path for binary reading,
+    decompressing .gz and .zst files on the fly.
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError("zstandard is required to read .zst files")
+        return zstandard.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def throughput(table, rows, size, seconds):
+    """
+    Returns the load statistics of one table.
+    """
+    return {'table': table,
+            'rows': rows,
+            'bytes': size,
+            'seconds': seconds,
+            'rows_per_s': rows / seconds if seconds else 0.0,
+            'bytes_per_s': size / seconds if seconds else 0.0}
+
+
+def copy_table(user, host, dbname, table, path,
+               chunk_size=CHUNK_SIZE, progress=None):
+    """
+    Streams the CSV file at path (with a header) into table
+    with COPY FROM STDIN in chunks of chunk_size bytes,
+    so the file only has to be readable by the client.
+    progress, if given, is called with the table name and
+    the number of bytes sent so far after every chunk.
+    Returns the load statistics of the table.
+    """
+    start = time.perf_counter()
+    with connection(user, host, dbname) as conn:
+        with conn.cursor() as curs:
+            size = copy_file(curs, table, path, chunk_size, progress)
+            rows = curs.rowcount
+    return throughput(table, rows, size, time.perf_counter() - start)
+
+
+def copy_file(curs, table, path, chunk_size=CHUNK_SIZE, progress=None):
+    """
+    Copies the CSV file at path (with a header) into table,
+    which may be followed by a column list, with COPY FROM STDIN
+    on curs in chunks of chunk_size bytes, and returns the bytes sent.
+    progress is called like in copy_table().
+    """
+    size = 0
+    with open_input(path) as file:
+        with curs.copy(f"COPY {table} FROM STDIN "
+                       "(FORMAT CSV, HEADER)") as copy:
+            while chunk := file.read(chunk_size):
+                copy.write(chunk)
+                size += len(chunk)
+                if progress is not None:
+                    progress(table, size)
+    return size
+
+
+def file_checksum(paths, chunk_size=CHUNK_SIZE):
+    """
+    Returns the SHA-256 of the contents of the files at paths,
+    in order, as stored (compressed files are not decompressed).
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as file:
+            while chunk := file.read(chunk_size):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def real_pair(longitude, latitude):
+    """
+    Returns longitude and latitude rounded to REAL,
+    the way PostgreSQL stores them in location.
+    """
+    return REAL_PAIR.unpack(REAL_PAIR.pack(float(longitude),
+                                           float(latitude)))
+
+
+def copy_location_ids(user, host, dbname, table, path, location_ids,
+                      chunk_size=CHUNK_SIZE, progress=None):
+    """
+    Streams the CSV file at path into table like copy_table(),
+    adding the location_id column of the location_id schema.
+    For location, rows are numbered from 1 and recorded in
+    location_ids by their REAL (longitude, latitude).
+    For incident, the (longitude, latitude) of each row is looked up
+    in location_ids, and an incident without coordinates gets NULL.
+    Returns the load statistics of the table.
+    """
+    columns = (0, 1) if table == 'location' else (3, 4)
+    start = time.perf_counter()
+    size = 0
+    rows = 0
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    with connection(user, host, dbname) as conn:
+        with conn.cursor() as curs:
+            with open_input(path) as file:
+                reader = csv.reader(io.TextIOWrapper(file, encoding='utf-8',
+                                                     newline=''))
+                next(reader)
+                with curs.copy(f"COPY {table} FROM STDIN "
+                               "(FORMAT CSV)") as copy:
+                    for row in reader:
+                        longitude, latitude = (row[i] for i in columns)
+                        rows += 1
+                        if table == 'location':
+                            location_id = rows
+                            location_ids[real_pair(longitude,
+                                                   latitude)] = rows
+                        elif longitude == '' or latitude == '':
+                            location_id = None
+                        else:
+                            pair = real_pair(longitude, latitude)
+                            if pair not in location_ids:
+                                raise ValueError(
+                                    f"Incident {row[0]} has no location "
+                                    f"({longitude}, {latitude})")
+                            location_id = location_ids[pair]
+                        writer.writerow(row + [location_id])
+                        if buffer.tell() >= chunk_size:
+                            data = buffer.getvalue().encode()
+                            copy.write(data)
+                            size += len(data)
+                            buffer.seek(0)
+                            buffer.truncate()
+                            if progress is not None:
+                                progress(table, size)
+                    data = buffer.getvalue().encode()
+                    copy.write(data)
+                    size += len(data)
+    return throughput(table, rows, size, time.perf_counter() - start)
+
+
+def split_ranges(path, parts):
+    """
+    Splits the uncompressed CSV file at path into at most parts
+    byte ranges of similar size that start and end on line boundaries,
+    skipping the header, by seeking instead of reading the file.
+    Fields must not contain quoted line breaks.
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as file:
+        file.readline()
+        start = file.tell()
+        bounds = [start]
+        for i in range(1, parts):
+            offset = start + (size - start) * i // parts
+            if offset <= bounds[-1]:
+                continue
+            file.seek(offset - 1)
+            file.readline()
+            bounds.append(min(file.tell(), size))
+        bounds.append(size)
+    return [(begin, end) for begin, end in zip(bounds, bounds[1:])
+            if end > begin]
+
+
+def copy_range(curs, table, path, begin, end, chunk_size=CHUNK_SIZE):
+    """
+    Copies the lines of path between the byte offsets begin and end
+    into table with COPY FROM STDIN and returns the bytes sent.
+    """
+    size = 0
+    with open(path, 'rb') as file:
+        file.seek(begin)
+        with curs.copy(f"COPY {table} FROM STDIN (FORMAT CSV)") as copy:
+            while size < end - begin:
+                chunk = file.read(min(chunk_size, end - begin - size))
+                if not chunk:
+                    break
+                copy.write(chunk)
+                size += len(chunk)
+    return size
+
+
+def parallel_copy(user, host, dbname, table, path,
+                  parallelism=4, chunk_size=CHUNK_SIZE):
+    """
+    Splits the CSV file at path into parallelism byte ranges and
+    COPYs each one into its own UNLOGGED staging table on its own
+    pooled connection in a thread pool, then moves the rows of every
+    staging table into table with one INSERT ... SELECT, so the load
+    is all or nothing: if any range fails to copy, or the INSERT
+    fails, table is left as it was. The staging tables are dropped
+    either way. Reading and parsing the CSV runs in parallel;
+    the writes to table, with its indexes, constraints and triggers,
+    run in the single INSERT.
+    Returns the load statistics of the table with the statistics
+    of each worker under 'workers'.
+    """
+    if path.endswith(('.gz', '.zst')):
+        raise ValueError("Parallel COPY needs an uncompressed CSV file")
+    ranges = split_ranges(path, parallelism)
+    if not ranges:
+        stats = throughput(table, 0, 0, 0.0)
+        stats['workers'] = []
+        return stats
+    if POOL_SETTINGS['enabled'] and len(ranges) > POOL_SETTINGS['max_size']:
+        raise ValueError(f"parallelism {len(ranges)} is larger than the "
+                         f"pool max_size {POOL_SETTINGS['max_size']}")
+    stages = [f"{table}_stage_{os.getpid()}_{index}"
+              for index in range(0, len(ranges))]
+
+    def worker(index, begin, end):
+        start = time.perf_counter()
+        with connection(user, host, dbname) as conn:
+            with conn.cursor() as curs:
+                curs.execute(f"CREATE UNLOGGED TABLE {stages[index]} "
+                             f"(LIKE {table})")
+                size = copy_range(curs, stages[index], path, begin, end,
+                                  chunk_size)
+                rows = curs.rowcount
+            conn.commit()
+        return throughput(f"{table}[{index}]", rows, size,
+                          time.perf_counter() - start)
+
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [executor.submit(worker, index, begin, end)
+                       for index, (begin, end) in enumerate(ranges)]
+            workers = [future.result() for future in futures]
+        with connection(user, host, dbname) as conn:
+            with conn.cursor() as curs:
+                curs.execute(f"INSERT INTO {table} " + ' UNION ALL '.join(
+                    f"SELECT * FROM {stage}" for stage in stages))
+            conn.commit()
+    finally:
+        with connection(user, host, dbname) as conn:
+            with conn.cursor() as curs:
+                curs.execute(f"DROP TABLE IF EXISTS {', '.join(stages)}")
+            conn.commit()
+    stats = throughput(table,
+                       sum(worker['rows'] for worker in workers),
+                       sum(worker['bytes'] for worker in workers),
+                       time.perf_counter() - start)
+    stats['workers'] = workers
+    return stats
+
+
+def load_tables(user, host, dbname, dir, chunk_size=CHUNK_SIZE,
+                progress=None, parallelism=1, location_id=False,
+                copy_incident=None):
+    """
+    Loads report_type, incident_type and location at the same time,
+    each on its own connection, and then incident,
+    which references all three.
+    If parallelism is more than 1, incident is split into that many
+    ranges that are copied in parallel by parallel_copy().
+    If location_id is True, location and incident are loaded with
+    copy_location_ids(), which resolves the location_id of every
+    incident from an in-memory map of the locations.
+    If copy_incident is given, it is called with the path of
+    incident.csv to load incident instead, and returns its statistics.
+    Returns the load statistics of every table.
+    """
+    if location_id and parallelism > 1:
+        raise ValueError("location_id loads incident on one connection")
+    location_ids = {}
+
+    def copy_dimension(table):
+        if location_id and table == 'location':
+            return copy_location_ids(user, host, dbname, table,
+                                     find_input(dir, table), location_ids,
+                                     chunk_size, progress)
+        return copy_table(user, host, dbname, table,
+                          find_input(dir, table), chunk_size, progress)
+
+    with ThreadPoolExecutor(max_workers=len(DIMENSION_TABLES)) as executor:
+        stats = list(executor.map(copy_dimension, DIMENSION_TABLES))
+    path = find_input(dir, 'incident')
+    if copy_incident is not None:
+        stats.append(copy_incident(path))
+    elif location_id:
+        stats.append(copy_location_ids(user, host, dbname, 'incident', path,
+                                       location_ids, chunk_size, progress))
+    elif parallelism > 1:
+        stats.append(parallel_copy(user, host, dbname, 'incident', path,
+                                   parallelism, chunk_size))
+    else:
+        stats.append(copy_table(user, host, dbname, 'incident', path,
+                                chunk_size, progress))
+    return stats
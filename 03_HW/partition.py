@@ -0,0 +1,116 @@
+import re
+from datetime import datetime
+
+from loader import CHUNK_SIZE, open_input
+from pool import connection
+
+
+PARTITION_UNITS = ['year', 'month']
+
+# The year and month of incident_datetime, the second column of
+# incident.csv, written either year first (2018/01/31, 2018-01-31)
+# or month first (01/31/2018).
+DATETIME_PATTERN = re.compile(
+    rb'^[^,\n]*,"?(?:(\d{4})[-/](\d{1,2})|(\d{1,2})[-/]\d{1,2}[-/](\d{4}))',
+    re.MULTILINE)
+# The names of the partitions of incident: partition_name()
+# and the default partition of create_tables().
+PARTITION_PATTERN = re.compile(r'^incident_(y\d{4}(m\d{2})?|default)$')
+
+
+def period_bounds(year, month=None):
+    """
+    Returns the first datetime of the given year (or month of the year)
+    and the first datetime after it, to bind as the parameters of
+    a half-open incident_datetime >= start AND incident_datetime < end
+    predicate that the planner can use to prune partitions.
+    """
+    year = int(year)
+    if month is None:
+        return datetime(year, 1, 1), datetime(year + 1, 1, 1)
+    month = int(month)
+    next_year, next_month = (year + 1, 1) if month == 12 \
+        else (year, month + 1)
+    return datetime(year, month, 1), datetime(next_year, next_month, 1)
+
+
+def period_range(year, month=None):
+    """
+    Returns period_bounds() as timestamp literals,
+    for statements that cannot take parameters (partition bounds).
+    """
+    return tuple(f"'{bound:%Y-%m-%d}'" for bound in period_bounds(year, month))
+
+
+def month_range(start, end):
+    """
+    Returns the (year, month) pairs from start to end,
+    both (year, month) pairs and included.
+    """
+    first = int(start[0]) * 12 + int(start[1]) - 1
+    last = int(end[0]) * 12 + int(end[1]) - 1
+    return [(months // 12, months % 12 + 1)
+            for months in range(first, last + 1)]
+
+
+def add_months(months, lines):
+    """
+    Adds the (year, month) of every incident line in lines to months.
+    """
+    for match in DATETIME_PATTERN.finditer(lines):
+        year, month, month_first, year_last = match.groups()
+        if year is not None:
+            months.add((int(year), int(month)))
+        else:
+            months.add((int(year_last), int(month_first)))
+
+
+def scan_months(path, chunk_size=CHUNK_SIZE):
+    """
+    Returns the set of (year, month) pairs of incident_datetime
+    found in the incident CSV file at path,
+    reading it in chunks of chunk_size bytes.
+    """
+    months = set()
+    with open_input(path) as file:
+        file.readline()
+        rest = b''
+        while chunk := file.read(chunk_size):
+            lines, _, rest = (rest + chunk).rpartition(b'\n')
+            add_months(months, lines)
+        add_months(months, rest)
+    return months
+
+
+def partition_name(partition_by, year, month):
+    """
+    Returns the name of the incident partition holding year/month.
+    """
+    if partition_by == 'year':
+        return f"incident_y{year}"
+    return f"incident_y{year}m{month:02d}"
+
+
+def create_partitions(user, host, dbname, months, partition_by):
+    """
+    Creates the partitions of incident, range-partitioned by year
+    or month of incident_datetime, covering the (year, month) pairs
+    in months.
+    Partitions that already exist are left alone.
+    """
+    if partition_by not in PARTITION_UNITS:
+        raise ValueError(f"partition_by must be one of {PARTITION_UNITS}")
+    periods = {(year, None if partition_by == 'year' else month)
+               for year, month in months}
+    with connection(user, host, dbname) as conn:
+        with conn.cursor() as curs:
+            for year, month in sorted(periods):
+                start, end = period_range(year, month)
+                curs.execute(
+                    f"""
+                    CREATE TABLE IF NOT EXISTS
+                    {partition_name(partition_by, year, month)}
+                    PARTITION OF incident
+                    FOR VALUES FROM ({start}) TO ({end})
+                    """)
+        conn.commit()
@@ -0,0 +1,258 @@
+import io
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+from psycopg import ClientCursor
+
+try:
+    import pyarrow.csv
+except ImportError:
+    pyarrow = None
+
+from cache import cached, result_size
+from metrics import record
+from pool import connection
+
+
+ITERSIZE = 2000
+RESULT_FORMATS = ['rows', 'numpy', 'arrow']
+
+_cursor_ids = itertools.count()
+# The statements each backend has prepared, most recently used last,
+# keyed by (host, dbname, backend pid).
+_prepared = {}
+_plan_stats = {'hits': 0, 'misses': 0, 'unprepared': 0}
+_plan_lock = threading.Lock()
+
+
+def inline(conn, query, params):
+    """
+    Returns query with params bound into the SQL text as literals,
+    for statements that cannot take parameters (COPY)
+    or to run a query the way it was sent before binding.
+    """
+    return ClientCursor(conn).mogrify(query, params)
+
+
+def execute_query(curs, query, params=None, prepare=True):
+    """
+    Executes query on curs with params bound on the server.
+    With prepare=True the statement is prepared on the connection the
+    first time and its plan reused by every later call with the same
+    SQL text, and the plan cache statistics count whether the backend
+    had already prepared it.
+    With prepare=False, params are inlined into the SQL text and the
+    statement is parsed and planned on every call.
+    """
+    record_execution(curs.connection, query, prepare)
+    if prepare:
+        curs.execute(query, params, prepare=True)
+    else:
+        curs.execute(inline(curs.connection, query, params), prepare=False)
+
+
+def record_execution(conn, query, prepare):
+    """
+    Counts an execution of query on conn in the plan cache statistics,
+    as a hit if prepare is True and the backend of conn has already
+    prepared it, as a miss if it has not, or as unprepared.
+    """
+    with _plan_lock:
+        if not prepare:
+            _plan_stats['unprepared'] += 1
+            return
+        info = conn.info
+        statements = _prepared.setdefault(
+            (info.host, info.dbname, info.backend_pid), OrderedDict())
+        if query in statements:
+            statements.move_to_end(query)
+            _plan_stats['hits'] += 1
+        else:
+            statements[query] = True
+            _plan_stats['misses'] += 1
+            # psycopg keeps at most prepared_max statements
+            # per connection and deallocates the oldest.
+            while len(statements) > conn.prepared_max:
+                statements.popitem(last=False)
+
+
+def plan_cache_stats():
+    """
+    Returns the number of prepared executions that reused a statement
+    the backend had already prepared (hits), that had to prepare it
+    (misses), the hit rate, and the number of unprepared executions.
+    """
+    with _plan_lock:
+        stats = dict(_plan_stats)
+    prepared = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / prepared if prepared else 0.0
+    return stats
+
+
+def clear_plan_cache_stats():
+    """
+    Resets the plan cache statistics.
+    """
+    with _plan_lock:
+        _prepared.clear()
+        _plan_stats.update(hits=0, misses=0, unprepared=0)
+
+
+def stream_rows(user, host, dbname, query, params=None,
+                itersize=ITERSIZE, batches=False):
+    """
+    Runs query with params through a named server-side cursor
+    and yields its rows (or lists of up to itersize rows if batches
+    is True), fetching itersize rows from the server at a time,
+    so memory stays the same whatever the size of the result.
+    The pooled connection is held until the generator is exhausted
+    or closed.
+    """
+    with connection(user, host, dbname) as conn:
+        with conn.cursor(name=f"stream_{next(_cursor_ids)}") as curs:
+            curs.itersize = itersize
+            curs.execute(query, params)
+            if batches:
+                while rows := curs.fetchmany(itersize):
+                    yield rows
+            else:
+                yield from curs
+
+
+def arrow_type(type_code):
+    """
+    Returns the Arrow type fetch_arrow() reads a column of
+    the PostgreSQL type OID type_code as: booleans, integers, floats
+    (numeric too), dates and timestamps as themselves, anything else
+    as text.
+    """
+    types = {16: pyarrow.bool_(),
+             20: pyarrow.int64(),
+             21: pyarrow.int16(),
+             23: pyarrow.int32(),
+             700: pyarrow.float32(),
+             701: pyarrow.float64(),
+             1700: pyarrow.float64(),
+             1082: pyarrow.date32(),
+             1114: pyarrow.timestamp('us'),
+             1184: pyarrow.timestamp('us', tz='UTC')}
+    return types.get(type_code, pyarrow.string())
+
+
+def fetch_arrow(user, host, dbname, query, params=None):
+    """
+    Runs query with params inside COPY ... TO STDOUT
+    (FORMAT CSV, HEADER) and parses the output with the Arrow
+    CSV reader, returning a pyarrow.Table with one column per
+    output column of query, so no Python object is built per row.
+    COPY takes no parameters, so they are inlined as literals.
+    The column types come from the result description of query
+    (run with LIMIT 0 first, see arrow_type()) rather than being
+    inferred from the data. Only an unquoted empty field is NULL,
+    so NULL and the empty string are kept apart, and text such as
+    NA or NULL stays text.
+    """
+    if pyarrow is None:
+        raise ImportError("pyarrow is required for columnar results")
+    buffer = io.BytesIO()
+    with connection(user, host, dbname) as conn:
+        with conn.cursor() as curs:
+            query = inline(conn, query, params)
+            curs.execute(f"SELECT * FROM ({query}) AS result LIMIT 0")
+            names = [column.name for column in curs.description]
+            types = {column.name: arrow_type(column.type_code)
+                     for column in curs.description}
+            with curs.copy(f"COPY ({query}) "
+                           "TO STDOUT (FORMAT CSV, HEADER)") as copy:
+                for data in copy:
+                    buffer.write(data)
+    buffer.seek(0)
+    return pyarrow.csv.read_csv(
+        buffer,
+        read_options=pyarrow.csv.ReadOptions(skip_rows=1,
+                                             column_names=names),
+        convert_options=pyarrow.csv.ConvertOptions(
+            column_types=types,
+            null_values=[''],
+            true_values=['t'],
+            false_values=['f'],
+            strings_can_be_null=True,
+            quoted_strings_can_be_null=False))
+
+
+def to_format(table, result_format):
+    """
+    Returns the Arrow table as result_format: the table itself
+    for 'arrow', or a dict of NumPy arrays keyed by column name
+    for 'numpy'.
+    """
+    if result_format == 'arrow':
+        return table
+    return {name: column.to_numpy(zero_copy_only=False)
+            for name, column in zip(table.column_names, table.columns)}
+
+
+def fetch_all(name, kargs, query, params=None):
+    """
+    Runs query with params, built by the query function name
+    from kargs, on a pooled connection for kargs['user'],
+    kargs['host'] and kargs['dbname'] and returns all the rows.
+    The statement is prepared on the connection and reused by later
+    calls, unless the function is called with prepare=False.
+    Results are served from the result cache unless the query
+    is explained or the function is called with cache=False.
+    With stream=True, it returns a generator from stream_rows()
+    instead, using kargs['itersize'] and kargs['batches'] if given;
+    streamed results are not cached.
+    With result_format='arrow' or 'numpy', the result is fetched by
+    fetch_arrow() and returned as a pyarrow.Table or as a dict of
+    NumPy arrays; explained queries always return rows.
+    Every call that reaches the database, unless explained, is recorded
+    in the query metrics under name (see metrics.record()); columnar
+    results count their connect and fetch time as execution.
+    """
+    user = kargs['user']
+    host = kargs['host']
+    dbname = kargs['dbname']
+    params = list(params or [])
+    if kargs.get('stream', False):
+        return stream_rows(user, host, dbname, query, params,
+                           kargs.get('itersize', ITERSIZE),
+                           kargs.get('batches', False))
+    result_format = kargs.get('result_format', 'rows')
+    if result_format not in RESULT_FORMATS:
+        raise ValueError(f"result_format must be one of {RESULT_FORMATS}")
+    explain = kargs.get('explain', False)
+    columnar = result_format != 'rows' and not explain
+
+    def run():
+        start = time.perf_counter()
+        if columnar:
+            result = fetch_arrow(user, host, dbname, query, params)
+            record(name, 0.0, (time.perf_counter() - start) * 1000, 0.0,
+                   result.num_rows, result.nbytes, query, params, kargs)
+            return result
+        with connection(user, host, dbname) as conn:
+            connected = time.perf_counter()
+            with conn.cursor() as curs:
+                execute_query(curs, query, params,
+                              kargs.get('prepare', True) and not explain)
+                executed = time.perf_counter()
+                result = curs.fetchall()
+                fetched = time.perf_counter()
+        if not explain:
+            record(name, (connected - start) * 1000,
+                   (executed - connected) * 1000,
+                   (fetched - executed) * 1000,
+                   len(result), result_size(result), query, params, kargs)
+        return result
+
+    if explain or not kargs.get('cache', True):
+        result = run()
+    else:
+        key = (user, host, dbname, query, tuple(params)) + \
+            (('arrow',) if columnar else ())
+        result = cached(name, key, query, run)
+    return to_format(result, result_format) if columnar else result
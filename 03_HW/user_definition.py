@@ -0,0 +1,5 @@
+user = 'postgres'
+host = 'localhost'
+dbname = 'msds691_HW'
+test_time = 10
+year = 2018